@@ -1,24 +1,45 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
-import google.generativeai as genai
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from PIL import Image
 import io
+import logging
 import os
+import resource
+from log_config import RequestIdMiddleware, REQUEST_ID_HEADER, request_id_var, sample_payload, setup_logging
 from prompts import PROMPTS
-from typing import Literal, List
+from clients import get_model, get_sheets_service, get_supabase, startup_report, warm_up
+from cache import NearDuplicateIndex, ResultCache, make_cache_key, make_scope_key
+from image_processing import MIME_TYPES, ImageData, dhash_async, preprocess_image_async, split_tiles_async
+from jobs import JobQueue, JobWorkerPool, validate_webhook_url
+import uploads
+from uploads import UploadLimitMiddleware, read_upload, transient_memory
+from log_sink import LogSink
+from model_routing import ModelCall, escalation_reason, estimate_cost, is_truncated
+from model_scheduler import ConcurrencyLimit, ModelScheduler, ModelUnavailableError
+from log_store import format_log, iter_logs, log_filters, parse_fields
+from log_archive import LOG_ARCHIVE_DIR, LogArchive
+from stats import StatsAggregator
+from sheets_export import ExportState, export_logs
+from parsing import JSON_PROMPTS, IncrementalParser, ResponseParseError, parse_response, parse_stats
+from replay import ResponseStore, build_record, image_digest
+from shared_state import create_shared_state
+from tiling import merge_tile_results, tile_results_decided
+import metrics
+from metrics import MetricsMiddleware, stage
+from typing import Callable, Literal, List, Optional
 from pydantic import BaseModel
 from pathlib import Path
 import json
+import random
 from datetime import datetime
 import time
-from supabase import create_client
-from google.oauth2.credentials import Credentials
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 import asyncio
 
+setup_logging()
+logger = logging.getLogger(__name__)
+
 # Classes para requisição e resposta
 class Produto(BaseModel):
     nome: str
@@ -30,12 +51,48 @@ class ValidationResult(BaseModel):
     posicionamento: bool
     organizacao: bool
 
+class ImageStats(BaseModel):
+    source_format: str
+    output_format: str
+    original_size: List[int]
+    output_size: List[int]
+    bytes_in: int
+    bytes_out: int
+    decoded_bytes: Optional[int] = None
+    preprocessing_time: float
+
+class ProductValidation(BaseModel):
+    nome: str
+    status: str
+    validation: ValidationResult
+    details: str
+
+class NearDuplicate(BaseModel):
+    distance: int
+    age_seconds: float
+    request_id: Optional[str] = None
+    reused: bool
+
+class TileSummary(BaseModel):
+    grid: List[int]
+    total: int
+    analyzed: int
+    skipped: int
+    cancelled: int = 0
+
 class AnalysisResponse(BaseModel):
     status: str
     details: str
     validation: ValidationResult
     execution_time: float
     cost: float
+    cached: bool = False
+    model: Optional[str] = None
+    escalation_reason: Optional[str] = None
+    near_duplicate: Optional[NearDuplicate] = None
+    image: Optional[ImageStats] = None
+    produtos: Optional[List[ProductValidation]] = None
+    tiles: Optional[TileSummary] = None
 
 # Inicialização da API
 app = FastAPI(
@@ -55,18 +112,24 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         "url": str(request.url)
     }
     
-    print("\n=== Erro de Validação ===")
-    print(f"URL: {request.url}")
-    print(f"Método: {request.method}")
-    print("Headers:", dict(request.headers))
-    print("Detalhes do erro:", exc.errors())
-    print("=== Fim do Erro ===\n")
+    logger.warning("Erro de validação em %s %s", request.method, request.url.path,
+                   extra={"errors": exc.errors()})
+    if sample_payload(logger):
+        logger.info("Headers da requisição inválida", extra={"headers": error_details["headers"]})
     
     return JSONResponse(
         status_code=422,
         content=error_details
     )
 
+# Limite do corpo das requisições (413 antes de ler o formulário) e memória por requisição.
+# O último middleware adicionado é o mais externo: este vem antes do CORS para que o 413
+# também leve os cabeçalhos CORS e o navegador consiga ler o erro
+REQUEST_MAX_BYTES = int(os.environ.get("REQUEST_MAX_BYTES", str(uploads.UPLOAD_MAX_BYTES + 1024 * 1024)))
+BATCH_REQUEST_MAX_BYTES = int(os.environ.get("BATCH_REQUEST_MAX_BYTES", str(200 * 1024 * 1024)))
+app.add_middleware(UploadLimitMiddleware, max_bytes=REQUEST_MAX_BYTES,
+                   path_limits={"/analyze/batch": BATCH_REQUEST_MAX_BYTES})
+
 # Configuração CORS
 app.add_middleware(
     CORSMiddleware,
@@ -74,11 +137,84 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Next-Before-Id", "X-Peak-Memory-Bytes", REQUEST_ID_HEADER],
 )
 
-# Configuração do Gemini
-genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
-model = genai.GenerativeModel('gemini-1.5-pro-latest')
+# Métricas por requisição e cabeçalho Server-Timing
+app.add_middleware(MetricsMiddleware)
+
+# ID de correlação dos logs (cabeçalho X-Request-ID); adicionado por último para envolver os demais
+app.add_middleware(RequestIdMiddleware)
+
+# Formato de resposta pedido ao modelo: 'json' (estruturado) ou 'text' (formato livre original)
+RESPONSE_FORMAT = os.environ.get("RESPONSE_FORMAT", "json")
+
+# Modelos: 'single' usa sempre GEMINI_MODEL; 'tiered' tenta GEMINI_FAST_MODEL primeiro e
+# repete no GEMINI_MODEL apenas se o resultado não passar na heurística de confiança
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-1.5-pro-latest")
+GEMINI_FAST_MODEL = os.environ.get("GEMINI_FAST_MODEL", "gemini-1.5-flash-latest")
+MODEL_ROUTING = os.environ.get("MODEL_ROUTING", "single")
+ESCALATE_ON_MIXED = os.environ.get("ESCALATE_ON_MIXED", "1") == "1"
+# Prazo do modelo rápido, para sobrar tempo de escalar se ele falhar ou demorar
+GEMINI_FAST_TIMEOUT = float(os.environ.get("GEMINI_FAST_TIMEOUT", "30"))
+
+# Fotos panorâmicas: com TILE_AUTO=1, fotos largas ou grandes são divididas em trechos mesmo sem
+# `panorama` na requisição; TILE_CONCURRENCY limita os trechos analisados ao mesmo tempo
+TILE_AUTO = os.environ.get("TILE_AUTO", "0") == "1"
+TILE_CONCURRENCY = int(os.environ.get("TILE_CONCURRENCY", "4"))
+
+# Configuração das análises em lote
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "16"))
+BATCH_ITEM_TIMEOUT = float(os.environ.get("BATCH_ITEM_TIMEOUT", "120"))
+BATCH_MAX_IMAGES = int(os.environ.get("BATCH_MAX_IMAGES", "100"))
+
+# Estado compartilhado entre workers: 'memory' (padrão, um processo) ou 'sqlite' (vários workers
+# na mesma máquina; o gunicorn.conf.py o ativa quando há mais de um worker)
+shared_state = create_shared_state(
+    os.environ.get("SHARED_STATE_BACKEND", "memory"),
+    os.environ.get("SHARED_STATE_PATH", "shared_state.db")
+)
+# Componentes com estado próprio só usam o backend quando ele é visto pelos outros processos
+cross_process_state = shared_state if shared_state.multiprocess else None
+parse_stats.shared = cross_process_state
+
+
+async def read_shared(func, *args):
+    """Executa uma leitura que pode consultar o estado compartilhado (bloqueante no SQLite) fora do event loop"""
+    if cross_process_state is None:
+        return func(*args)
+    return await asyncio.to_thread(func, *args)
+
+# Fila de análises assíncronas (modo async do /analyze)
+job_queue = JobQueue(os.environ.get("JOBS_DB_PATH", "jobs.db"))
+
+# Cache de resultados (memória + disco opcional)
+result_cache = ResultCache(
+    max_entries=int(os.environ.get("CACHE_MAX_ENTRIES", "512")),
+    ttl_seconds=float(os.environ.get("CACHE_TTL_SECONDS", "3600")),
+    disk_dir=os.environ.get("CACHE_DIR"),
+    shared=cross_process_state
+) if os.environ.get("CACHE_ENABLED", "1") == "1" else None
+
+# Quase duplicatas (fotos da mesma gôndola tiradas em sequência): 'flag' apenas sinaliza na
+# resposta, 'reuse' reaproveita a análise anterior sem chamar o Gemini, 'off' desativa
+NEAR_DUP_MODE = os.environ.get("NEAR_DUP_MODE", "flag")
+near_dup_index = NearDuplicateIndex(
+    max_distance=int(os.environ.get("NEAR_DUP_MAX_DISTANCE", "5")),
+    window_seconds=float(os.environ.get("NEAR_DUP_WINDOW_SECONDS", "300")),
+    shared=cross_process_state
+) if NEAR_DUP_MODE in ("flag", "reuse") else None
+
+# Gravação das respostas do modelo para reexecutar o parser offline (replay.py)
+RECORD_RESPONSES = os.environ.get("RECORD_RESPONSES", "0") == "1"
+RECORD_SAMPLE_RATE = float(os.environ.get("RECORD_SAMPLE_RATE", "1"))
+response_store = ResponseStore(os.environ.get("RECORD_DB_PATH", "responses.db")) if RECORD_RESPONSES else None
+response_recorder = LogSink(
+    response_store.insert_many,
+    flush_interval=5,
+    spill_path=os.environ.get("RECORD_SPILL_PATH", "responses_spill.jsonl")
+) if response_store else None
 
 # Rota raiz
 @app.get("/", include_in_schema=True)
@@ -91,156 +227,807 @@ async def read_root():
         "documentation": "/docs",
         "endpoints": {
             "analyze_shelf": "/analyze",
+            "analyze_batch": "/analyze/batch",
+            "get_job": "/jobs/{job_id}",
+            "get_job_stats": "/jobs/stats",
             "export_to_sheets": "/export-to-sheets",
             "get_stats": "/stats",
-            "get_logs": "/logs"
+            "get_stats_history": "/stats/history",
+            "get_logs": "/logs",
+            "get_startup_report": "/startup",
+            "get_metrics": "/metrics"
         }
     }
 
-# Configuração Supabase
-supabase = create_client(
-    os.environ.get("SUPABASE_URL", "sua_url"),
-    os.environ.get("SUPABASE_KEY", "sua_key")
-)
+# Clientes do Gemini, Supabase e Google Sheets são criados sob demanda (clients.py).
+# O aquecimento roda em segundo plano depois que o servidor começa a aceitar conexões.
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "1") == "1"
+WARMUP_DELAY = float(os.environ.get("WARMUP_DELAY", "1"))
+warm_up_results = {}
 
-# Configuração Google Sheets
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-GOOGLE_SHEETS_CREDS = json.loads(os.environ.get('GOOGLE_SHEETS_CREDS', '{}'))
-credentials = service_account.Credentials.from_service_account_info(GOOGLE_SHEETS_CREDS, scopes=SCOPES)
-sheets_service = build('sheets', 'v4', credentials=credentials)
+async def warm_up_clients():
+    await asyncio.sleep(WARMUP_DELAY)
+    # Com o roteamento em camadas, o modelo rápido atende a maioria das análises: aquece os dois
+    model_names = [GEMINI_FAST_MODEL, GEMINI_MODEL] if MODEL_ROUTING == 'tiered' else [GEMINI_MODEL]
+    warm_up_results.update(await asyncio.to_thread(warm_up, model_names))
+    logger.info("Aquecimento dos clientes concluído", extra={"warm_up": warm_up_results})
+
+@app.on_event("startup")
+async def start_warm_up():
+    if WARMUP_ENABLED:
+        app.state.warm_up = asyncio.create_task(warm_up_clients())
+
+@app.get("/startup")
+async def get_startup_report():
+    """Tempo de inicialização de cada cliente externo e resultado do aquecimento"""
+    return {
+        "components": startup_report,
+        "warm_up": warm_up_results
+    }
 
 @app.post("/analyze", response_model=AnalysisResponse)
 async def analyze_shelf(
     image: UploadFile = File(None),
     file: UploadFile = File(None),
-    produtos: str = Form(...)
+    produtos: str = Form(...),
+    por_produto: bool = Form(False),
+    panorama: Optional[bool] = Form(None),
+    async_mode: bool = Form(False),
+    webhook_url: Optional[str] = Form(None)
 ):
     """
     Analisa a imagem da prateleira usando o Google Gemini.
     
     - image/file: arquivo de imagem (pode usar qualquer um dos campos)
     - produtos: string JSON no formato '[{"nome": "Produto 1", "descricao": "Descrição 1"}]'
+    - por_produto: se verdadeiro, retorna também a validação de cada produto (campo `produtos`), em uma única chamada ao modelo
+    - panorama: se verdadeiro, divide a foto (gôndola longa) em trechos analisados em paralelo e combina o resultado (campo `tiles`);
+      se omitido, a divisão é automática para fotos largas ou grandes quando TILE_AUTO=1
+    - async_mode: se verdadeiro, enfileira a análise e retorna 202 com o `job_id` imediatamente
+    - webhook_url: (modo async) URL que recebe um POST com o resultado quando o job terminar
     """
-    print("\n=== Nova Análise Iniciada ===")
-    
     # Usa o campo 'file' se 'image' não for fornecido
     upload_file = image if image is not None else file
     if upload_file is None:
         raise HTTPException(status_code=400, detail="É necessário enviar uma imagem no campo 'image' ou 'file'")
     
-    print(f"Tipo do arquivo: {upload_file.content_type}")
-    print(f"Nome do arquivo: {upload_file.filename}")
-    
-    start_time = time.time()
+    upload_buffer = None
     try:
-        # Ler a imagem uma única vez
-        image_data = await upload_file.read()
-        print(f"Tamanho do arquivo: {len(image_data)} bytes")
+        # Ler a imagem uma única vez, em blocos e com limite de tamanho (sem cópia extra)
+        with stage("upload_read"):
+            upload_buffer = await read_upload(upload_file)
+        image_data = upload_buffer.view
+        metrics.UPLOAD_BYTES.inc(len(image_data))
+        logger.info("Análise iniciada", extra={
+            "upload_filename": upload_file.filename,
+            "content_type": upload_file.content_type,
+            "bytes": len(image_data)
+        })
         
         # Validar produtos
         try:
-            produtos_list = json.loads(produtos)
-            print("\nProdutos recebidos:", json.dumps(produtos_list, indent=2, ensure_ascii=False))
-            
-            if not isinstance(produtos_list, list):
-                raise ValueError("O campo 'produtos' deve ser uma lista")
-            
-            for produto in produtos_list:
-                if not isinstance(produto, dict):
-                    raise ValueError("Cada produto deve ser um objeto")
-                if 'nome' not in produto or 'descricao' not in produto:
-                    raise ValueError("Cada produto deve ter 'nome' e 'descricao'")
-                
+            with stage("validation"):
+                produtos_list = json.loads(produtos)
+                validate_produtos(produtos_list)
+            if sample_payload(logger):
+                logger.info("Produtos recebidos", extra={"produtos": produtos_list})
         except json.JSONDecodeError:
             raise HTTPException(status_code=400, detail="Formato inválido da lista de produtos")
         except ValueError as e:
             raise HTTPException(status_code=400, detail=str(e))
         
-        # Preparar a imagem para o Gemini
-        image_parts = [{"mime_type": "image/jpeg", "data": image_data}]
+        # Modo assíncrono: enfileira e responde sem esperar o Gemini
+        if async_mode:
+            if webhook_url:
+                try:
+                    await asyncio.to_thread(validate_webhook_url, webhook_url)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+            
+            job_id = await asyncio.to_thread(job_queue.submit, image_data, produtos_list, webhook_url,
+                                             {"por_produto": por_produto, "panorama": panorama,
+                                              "request_id": request_id_var.get()})
+            job_pool.notify()
+            logger.info("Job %s enfileirado", job_id, extra={"job_id": job_id})
+            return JSONResponse(status_code=202, content={
+                "job_id": job_id,
+                "status": "queued",
+                "status_url": f"/jobs/{job_id}"
+            })
         
-        # Formatar o prompt com os produtos
-        produtos_nomes = ", ".join([p['nome'] for p in produtos_list])
-        prompt_formatado = PROMPTS['default'].format(produtos=produtos_nomes)
+        result = await run_analysis(image_data, produtos_list, por_produto=por_produto, panorama=panorama)
         
-        # Fazer a análise com timeout aumentado
-        response = await asyncio.wait_for(
-            model.generate_content_async(
-                contents=[prompt_formatado, image_parts[0]],
-                generation_config={
-                    'temperature': 0.1,
-                    'top_p': 0.8,
-                    'max_output_tokens': 300,
-                }
-            ),
-            timeout=120
-        )
+        logger.info("Análise concluída", extra={
+            "status": result["status"],
+            "cached": result.get("cached", False),
+            "execution_time": result["execution_time"]
+        })
+        return result
         
-        # Processar resposta
-        response_text = response.text
-        print("\nResposta do Gemini:", response_text)
+    except HTTPException:
+        raise
+    except Exception as e:
+        error_msg = f"Erro durante a análise: {str(e)}"
+        logger.exception(error_msg)
+        log_analysis_error(error_msg, e)
+        raise HTTPException(status_code=500, detail=error_msg)
+    finally:
+        if upload_buffer is not None:
+            upload_buffer.close()
+
+def sse_event(name: str, data: dict) -> str:
+    """Formata um evento Server-Sent Events"""
+    return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/analyze/stream")
+async def analyze_shelf_stream(
+    image: UploadFile = File(None),
+    file: UploadFile = File(None),
+    produtos: str = Form(...),
+    panorama: Optional[bool] = Form(None)
+):
+    """
+    Analisa a imagem da prateleira e transmite o resultado em Server-Sent Events.
+    
+    O veredito e os critérios são enviados assim que aparecem na resposta do Gemini, antes do
+    fim da geração:
+    - **status**: `{"status": "success" | "pending"}`
+    - **criterion**: `{"criterio": "nome_marca" | "preco" | "posicionamento" | "organizacao", "valor": bool}`
+    - **details**: `{"details": "..."}`, ao fim da geração
+    - **result**: o mesmo conteúdo da resposta de `/analyze` (definitivo)
+    - **error**: `{"status_code": int, "detail": "..."}`
+    
+    Os eventos antecipados são provisórios: se o resultado final divergir (ex.: resposta
+    reinterpretada ou pedida novamente), status e critérios são reenviados antes de `result`.
+    Com `panorama` (como em `/analyze`), os trechos são combinados antes do envio e não há
+    eventos antecipados.
+    Erros de validação da requisição (imagem ou produtos) retornam 400 sem streaming.
+    """
+    upload_file = image if image is not None else file
+    if upload_file is None:
+        raise HTTPException(status_code=400, detail="É necessário enviar uma imagem no campo 'image' ou 'file'")
+    
+    try:
+        produtos_list = json.loads(produtos)
+        validate_produtos(produtos_list)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Formato inválido da lista de produtos")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    with stage("upload_read"):
+        upload_buffer = await read_upload(upload_file)
+    metrics.UPLOAD_BYTES.inc(len(upload_buffer))
+    logger.info("Análise em streaming iniciada", extra={
+        "upload_filename": upload_file.filename,
+        "bytes": len(upload_buffer)
+    })
+    
+    async def stream_events():
+        queue: asyncio.Queue = asyncio.Queue()
+        sent = {}
         
-        # Extrair resultados da validação
-        validation_text = response_text.split("Validação dos critérios:")[1].split("Dicas para melhoria:" if "Dicas para melhoria:" in response_text else "Motivos da aprovação:")[0].strip()
+        async def run():
+            try:
+                return await run_analysis(upload_buffer.view, produtos_list, panorama=panorama,
+                                          on_event=lambda name, data: queue.put_nowait((name, data)))
+            finally:
+                queue.put_nowait(None)
         
-        # Processar cada critério
-        validation_result = ValidationResult(
-            nome_marca="Nome/marca: Verdadeiro" in validation_text,
-            preco="Etiqueta de preço: Verdadeiro" in validation_text,
-            posicionamento="Posicionamento: Verdadeiro" in validation_text,
-            organizacao="Organização: Verdadeiro" in validation_text
+        task = asyncio.create_task(run())
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                name, data = event
+                sent[data.get("criterio", name)] = data.get("valor", data.get("status"))
+                yield sse_event(name, data)
+            
+            result = AnalysisResponse(**await task)
+            # Completa (ou corrige) o que foi antecipado com o resultado definitivo
+            if sent.get("status") != result.status:
+                yield sse_event("status", {"status": result.status})
+            for criterio, valor in result.validation.model_dump().items():
+                if sent.get(criterio) != valor:
+                    yield sse_event("criterion", {"criterio": criterio, "valor": valor})
+            yield sse_event("details", {"details": result.details})
+            yield sse_event("result", json.loads(result.model_dump_json()))
+            logger.info("Análise em streaming concluída", extra={
+                "status": result.status,
+                "cached": result.cached,
+                "execution_time": result.execution_time
+            })
+        except HTTPException as e:
+            yield sse_event("error", {"status_code": e.status_code, "detail": e.detail})
+        except Exception as e:
+            error_msg = f"Erro durante a análise: {str(e) or e.__class__.__name__}"
+            logger.exception(error_msg)
+            log_analysis_error(error_msg, e)
+            yield sse_event("error", {"status_code": 500, "detail": error_msg})
+        finally:
+            # Cliente desconectado: interrompe a análise
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            upload_buffer.close()
+    
+    return StreamingResponse(stream_events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/analyze/batch")
+async def analyze_batch(
+    images: List[UploadFile] = File(...),
+    produtos: str = Form(...),
+    por_produto: bool = Form(False),
+    panorama: Optional[bool] = Form(None),
+    concurrency: int = Query(BATCH_CONCURRENCY, ge=1, le=BATCH_MAX_CONCURRENCY, description="Análises simultâneas"),
+    item_timeout: float = Query(BATCH_ITEM_TIMEOUT, gt=0, le=120, description="Tempo limite por imagem (s)")
+):
+    """
+    Analisa várias imagens de prateleira em paralelo.
+    
+    - images: arquivos de imagem (repita o campo para cada imagem)
+    - produtos: string JSON com uma lista de produtos por imagem, na mesma ordem das imagens
+      ('[[{"nome": "Produto 1", "descricao": "..."}], [...]]'), ou uma única lista usada para todas
+    - por_produto: como em `/analyze`, inclui a validação de cada produto
+    - panorama: como em `/analyze`, divide cada foto em trechos
+    
+    A resposta é NDJSON: uma linha por imagem, emitida assim que a análise termina, com
+    `index`, `filename` e `result` (no formato de `/analyze`) ou `error`/`status_code`.
+    """
+    if len(images) > BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"Máximo de {BATCH_MAX_IMAGES} imagens por lote")
+    
+    # Validar produtos
+    try:
+        produtos_batch = json.loads(produtos)
+        if not isinstance(produtos_batch, list):
+            raise ValueError("O campo 'produtos' deve ser uma lista")
+        if all(isinstance(p, dict) for p in produtos_batch):
+            produtos_batch = [produtos_batch] * len(images)
+        if len(produtos_batch) != len(images):
+            raise ValueError("O campo 'produtos' deve ter uma lista de produtos por imagem")
+        for produtos_list in produtos_batch:
+            validate_produtos(produtos_list)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Formato inválido da lista de produtos")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    logger.info("Lote iniciado: %d imagens, concorrência %d", len(images), concurrency)
+    
+    # Ler as imagens antes de iniciar o streaming da resposta
+    buffers = []
+    try:
+        with stage("upload_read"):
+            for upload in images:
+                buffers.append(await read_upload(upload))
+    except HTTPException:
+        for buffer in buffers:
+            buffer.close()
+        raise
+    items = [(upload.filename, buffer.view, produtos_list)
+             for upload, buffer, produtos_list in zip(images, buffers, produtos_batch)]
+    metrics.UPLOAD_BYTES.inc(sum(len(buffer) for buffer in buffers))
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def run_item(index: int, filename: str, image_data: ImageData, produtos_list: list) -> dict:
+        async with semaphore:
+            try:
+                result = await run_analysis(image_data, produtos_list, timeout=item_timeout,
+                                            por_produto=por_produto, panorama=panorama)
+                return {"index": index, "filename": filename,
+                        "result": AnalysisResponse(**result).model_dump()}
+            except HTTPException as e:
+                return {"index": index, "filename": filename, "error": e.detail, "status_code": e.status_code}
+            except asyncio.TimeoutError:
+                error_msg = f"Tempo limite de {item_timeout}s excedido"
+            except Exception as e:
+                error_msg = f"Erro durante a análise: {str(e)}"
+            
+            logger.error("Erro no item %d do lote: %s", index, error_msg)
+            log_analysis_error(error_msg)
+            return {"index": index, "filename": filename, "error": error_msg, "status_code": 500}
+    
+    async def stream_results():
+        tasks = [asyncio.create_task(run_item(index, *item)) for index, item in enumerate(items)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                item_result = await next_done
+                yield json.dumps(item_result, ensure_ascii=False) + "\n"
+            logger.info("Lote concluído: %d imagens", len(items))
+        finally:
+            # Cliente desconectado: cancela o que ainda estiver pendente
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for buffer in buffers:
+                buffer.close()
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+async def run_job_analysis(image_data: bytes, produtos_list: list, options: dict) -> dict:
+    """Executa a análise de um job da fila e retorna o resultado serializável"""
+    try:
+        result = await run_analysis(image_data, produtos_list, por_produto=options.get("por_produto", False),
+                                    panorama=options.get("panorama"))
+    except HTTPException:
+        raise
+    except Exception as e:
+        log_analysis_error(f"Erro durante a análise: {str(e)}", e)
+        raise
+    return AnalysisResponse(**result).model_dump()
+
+job_pool = JobWorkerPool(
+    job_queue,
+    run_job_analysis,
+    workers=int(os.environ.get("JOB_WORKERS", "2"))
+)
+
+@app.on_event("startup")
+async def start_job_workers():
+    job_pool.start()
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    await job_pool.stop()
+
+@app.get("/jobs/stats")
+async def get_job_stats():
+    """Retorna a profundidade da fila de jobs e os tempos de espera e execução recentes"""
+    stats = await asyncio.to_thread(job_queue.stats)
+    stats["workers"] = job_pool.workers
+    return stats
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Retorna o estado de um job de análise e, quando concluído, o resultado"""
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    return job
+
+def validate_produtos(produtos_list):
+    """Valida a lista de produtos recebida, lançando ValueError se inválida"""
+    if not isinstance(produtos_list, list):
+        raise ValueError("O campo 'produtos' deve ser uma lista")
+    
+    for produto in produtos_list:
+        if not isinstance(produto, dict):
+            raise ValueError("Cada produto deve ser um objeto")
+        if 'nome' not in produto or 'descricao' not in produto:
+            raise ValueError("Cada produto deve ter 'nome' e 'descricao'")
+
+async def run_analysis(image_data: ImageData, produtos_list: list, timeout: float = 120,
+                       por_produto: bool = False,
+                       on_event: Optional[Callable[[str, dict], None]] = None,
+                       panorama: Optional[bool] = None) -> dict:
+    """
+    Executa a análise de uma imagem já lida e de uma lista de produtos já validada.
+    
+    Consulta o cache, pré-processa a imagem, chama o Gemini, interpreta a resposta e salva o log.
+    Com `por_produto`, uma única chamada avalia cada produto separadamente e o resultado traz
+    a lista `produtos`; o status e a validação gerais passam a ser a combinação dos produtos.
+    Com `on_event`, a chamada ao modelo principal é feita em streaming e o status e cada
+    critério são antecipados por `on_event(nome, dados)` assim que aparecem na resposta.
+    Com `panorama` (ou, se None, com TILE_AUTO e uma foto larga ou grande), a imagem é dividida
+    em trechos analisados em paralelo e combinados em um único resultado (sem antecipação).
+    Retorna o resultado no formato de `AnalysisResponse`.
+    """
+    start_time = time.time()
+    if RESPONSE_FORMAT == 'json':
+        prompt_name = 'por_produto_json' if por_produto else 'json'
+    else:
+        prompt_name = 'por_produto' if por_produto else 'default'
+    produtos_nomes = [p['nome'] for p in produtos_list]
+    tile_mode = panorama if panorama is not None else TILE_AUTO
+    variant = "tiles" if tile_mode else ""
+    
+    # Consultar o cache antes de chamar o Gemini
+    with stage("cache_lookup"):
+        cache_key = make_cache_key(image_data, produtos_nomes, prompt_name, variant)
+        cached_result = await result_cache.get_async(cache_key) if result_cache else None
+    if cached_result is not None:
+        metrics.CACHE_HITS.inc()
+        logger.info("Resultado encontrado no cache")
+        return reuse_result(cached_result, produtos_nomes, start_time)
+    if result_cache:
+        metrics.CACHE_MISSES.inc()
+    
+    # Procurar uma foto quase igual analisada há pouco, com os mesmos produtos
+    near_duplicate = None
+    if near_dup_index:
+        try:
+            with stage("dhash"):
+                image_hash = await dhash_async(image_data)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        scope_key = make_scope_key(produtos_nomes, prompt_name, variant)
+        match = await read_shared(near_dup_index.find, scope_key, image_hash)
+        if match is not None:
+            distance, age, previous = match
+            near_duplicate = {
+                "distance": distance,
+                "age_seconds": age,
+                "request_id": previous.get("request_id"),
+                "reused": NEAR_DUP_MODE == "reuse"
+            }
+            metrics.NEAR_DUPLICATES.inc(action=NEAR_DUP_MODE)
+            logger.info("Quase duplicata de uma análise de %.0fs atrás (distância %d)", age, distance,
+                        extra={"near_duplicate_of": previous.get("request_id")})
+            if NEAR_DUP_MODE == "reuse":
+                return reuse_result(previous, produtos_nomes, start_time, near_duplicate)
+
+    record = response_recorder is not None and random.random() < RECORD_SAMPLE_RATE
+    image_sha = image_digest(image_data) if record else None
+    deadline = start_time + timeout
+    
+    # Foto panorâmica: analisa cada trecho separadamente e combina os resultados
+    tiles = []
+    if tile_mode:
+        try:
+            with stage("tiling"):
+                tiles, image_stats = await split_tiles_async(image_data, force=panorama is True)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    tile_summary = None
+    if tiles:
+        logger.info("Imagem dividida em %d trechos (%d descartados)", len(tiles), image_stats["skipped"],
+                    extra={"image": image_stats})
+        transient_memory(image_stats["decoded_bytes"] + image_stats["bytes_out"])
+        parsed, cost, model_name, escalation, tile_summary = await analyze_tiles(
+            tiles, image_stats, prompt_name, produtos_nomes, deadline, image_sha, por_produto
         )
-        
-        if "Validada com sucesso" in response_text:
-            status = "success"
-            details = response_text.split("Motivos da aprovação:")[1].strip()
-        else:
-            status = "pending"
-            details = response_text.split("Dicas para melhoria:")[1].strip()
-        
-        # Preparar resposta
-        result = {
-            "status": status,
-            "details": details,
-            "validation": validation_result,
-            "execution_time": time.time() - start_time,
-            "cost": 0.0005
-        }
-        
-        # Log do resultado
+    else:
+        # Pré-processar a imagem (formato real, orientação EXIF, redução e recodificação)
         try:
+            with stage("preprocess"):
+                image_bytes, mime_type, image_stats = await preprocess_image_async(image_data)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        logger.info("Imagem pré-processada", extra={"image": image_stats})
+        # Imagem decodificada e imagem de envio coexistem com o upload durante o pré-processamento
+        transient_memory(image_stats["decoded_bytes"] + image_stats["bytes_out"])
+        parsed, cost, model_name, escalation = await analyze_image(
+            image_bytes, mime_type, prompt_name, produtos_nomes, deadline, image_sha, por_produto, on_event
+        )
+    status, validation, details, product_results = parsed
+    validation_result = ValidationResult(**validation)
+    
+    # Preparar resposta
+    result = {
+        "status": status,
+        "details": details,
+        "validation": validation_result,
+        "execution_time": time.time() - start_time,
+        "cost": cost,
+        "model": model_name,
+        "escalation_reason": escalation,
+        "near_duplicate": near_duplicate,
+        "image": image_stats,
+        "produtos": product_results,
+        "tiles": tile_summary
+    }
+    
+    stored_result = {
+        "status": status,
+        "details": details,
+        "validation": validation,
+        "model": model_name,
+        "escalation_reason": escalation,
+        "produtos": product_results,
+        "tiles": tile_summary
+    }
+    if result_cache:
+        await result_cache.set_async(cache_key, stored_result)
+    if near_dup_index:
+        near_dup_index.add(scope_key, image_hash, {**stored_result, "request_id": request_id_var.get()})
+    
+    # Log do resultado
+    try:
+        with stage("save_log"):
             save_log(
                 status=status,
-                produtos=[p['nome'] for p in produtos_list],
+                produtos=produtos_nomes,
                 execution_time=result["execution_time"],
                 cost=result["cost"],
                 analysis_details=details,
-                validation_result=validation_result
+                validation_result=validation_result,
+                model=model_name,
+                escalation_reason=escalation
             )
-        except Exception as e:
-            print(f"\nErro ao salvar log: {str(e)}")
-        
-        print("\n=== Análise Concluída ===")
-        return result
-        
     except Exception as e:
-        error_msg = f"Erro durante a análise: {str(e)}"
-        print(f"\nERRO: {error_msg}")
+        logger.error("Erro ao salvar log: %s", e)
+    
+    return result
+
+async def analyze_image(image_bytes: bytes, mime_type: str, prompt_name: str, produtos_nomes: list,
+                        deadline: float, image_sha: Optional[str] = None, por_produto: bool = False,
+                        on_event: Optional[Callable[[str, dict], None]] = None) -> tuple:
+    """
+    Chama o Gemini para uma imagem já pré-processada e interpreta a resposta, com o roteamento
+    em camadas e um novo pedido se a resposta não puder ser interpretada. Com `image_sha`,
+    grava a resposta para replay.
+    
+    Retorna (resultado interpretado, custo, modelo, motivo da escalação).
+    """
+    image_part = {"mime_type": mime_type, "data": image_bytes}
+    
+    # Formatar o prompt com os produtos
+    prompt_formatado = PROMPTS[prompt_name].format(produtos=", ".join(produtos_nomes))
+    
+    # Um bloco de resposta por produto no modo por produto
+    max_output_tokens = min(1024, 100 + 200 * len(produtos_nomes)) if por_produto else 300
+    
+    contents = [prompt_formatado, image_part]
+    
+    def parse_call(call: ModelCall, prompt_text: str):
+        """Interpreta a resposta e, se ativado, grava a resposta bruta e o resultado para replay"""
+        try:
+            with stage("parse"):
+                parsed = parse_response(call.text, prompt_name, produtos_nomes)
+        except ResponseParseError as e:
+            if image_sha is not None:
+                response_recorder.submit(build_record(image_sha, prompt_name, prompt_text, call.model,
+                                                      produtos_nomes, call.text, parse_error=str(e)))
+            raise
+        if image_sha is not None:
+            response_recorder.submit(build_record(image_sha, prompt_name, prompt_text, call.model,
+                                                  produtos_nomes, call.text, parsed))
+        return parsed
+    cost = 0.0
+    parsed = None
+    escalation = None
+    
+    # Roteamento em camadas: o modelo rápido primeiro; o principal só se o resultado for duvidoso
+    if MODEL_ROUTING == 'tiered':
+        try:
+            call = await generate_analysis(contents, max_output_tokens,
+                                           min(GEMINI_FAST_TIMEOUT, deadline - time.time()), GEMINI_FAST_MODEL)
+        except HTTPException as e:
+            # Modelo rápido indisponível após as retentativas: escala em vez de falhar
+            if e.status_code != 503:
+                raise
+            escalation = "unavailable"
+        except asyncio.TimeoutError:
+            escalation = "timeout"
+        else:
+            cost += call.cost
+            try:
+                parsed = parse_call(call, prompt_formatado)
+                escalation = escalation_reason(*parsed, truncated=call.truncated, escalate_on_mixed=ESCALATE_ON_MIXED)
+            except ResponseParseError:
+                escalation = "malformed"
+        if escalation:
+            logger.info("Resultado de %s escalado para %s: %s", GEMINI_FAST_MODEL, GEMINI_MODEL, escalation)
+            metrics.MODEL_ESCALATIONS.inc(reason=escalation)
+            parsed = None
+        model_name = GEMINI_FAST_MODEL
+    
+    if parsed is None:
+        model_name = GEMINI_MODEL
+        on_text = None
+        if on_event is not None and not por_produto:
+            incremental_parser = IncrementalParser()
+            
+            def on_text(text: str):
+                for name, data in incremental_parser.feed(text):
+                    on_event(name, data)
+        call = await generate_analysis(contents, max_output_tokens, deadline - time.time(), model_name, on_text)
+        cost += call.cost
         
+        # Processar resposta; se não for possível interpretá-la, pede novamente uma única vez
         try:
+            parsed = parse_call(call, prompt_formatado)
+        except ResponseParseError as e:
+            logger.warning("Não foi possível interpretar a resposta (%s), solicitando novamente", e)
+            parse_stats.record("reask")
+            # O lembrete segue o formato do prompt: o parser de texto não lê uma resposta em JSON
+            reask_prompt = prompt_formatado + PROMPTS['reask_json' if prompt_name in JSON_PROMPTS else 'reask_text']
+            call = await generate_analysis(
+                [reask_prompt, image_part], max_output_tokens, deadline - time.time(), model_name
+            )
+            cost += call.cost
+            try:
+                parsed = parse_call(call, reask_prompt)
+            except ResponseParseError as e:
+                parse_stats.record("reask_failed")
+                raise HTTPException(
+                    status_code=502,
+                    detail=f"Não foi possível interpretar a resposta do modelo mesmo após solicitar novamente: {e}"
+                ) from e
+    return parsed, cost, model_name, escalation
+
+async def analyze_tiles(tiles: List[dict], image_stats: dict, prompt_name: str, produtos_nomes: list,
+                        deadline: float, image_sha: Optional[str] = None, por_produto: bool = False) -> tuple:
+    """
+    Analisa os trechos de uma foto panorâmica em paralelo (até TILE_CONCURRENCY por vez) e
+    combina os resultados (tiling.py). Os trechos mais detalhados saem primeiro; assim que o
+    veredito combinado não pode mais mudar, os trechos pendentes são cancelados.
+    
+    Retorna (resultado combinado, custo, modelo, motivo da escalação, resumo dos trechos).
+    """
+    mime_type = MIME_TYPES.get(image_stats["output_format"], "image/jpeg")
+    semaphore = asyncio.Semaphore(TILE_CONCURRENCY)
+    
+    async def run_tile(tile: dict) -> tuple:
+        async with semaphore:
+            return tile["index"], await analyze_image(tile["data"], mime_type, prompt_name, produtos_nomes,
+                                                      deadline, image_sha, por_produto)
+    
+    tasks = [asyncio.create_task(run_tile(tile)) for tile in tiles]
+    tile_results = []
+    cost = 0.0
+    models = set()
+    escalation = None
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            index, (parsed, tile_cost, model_name, tile_escalation) = await next_done
+            tile_results.append((index, parsed))
+            cost += tile_cost
+            models.add(model_name)
+            escalation = escalation or tile_escalation
+            if tile_results_decided(tile_results, len(tasks) - len(tile_results)):
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    cancelled = len(tasks) - len(tile_results)
+    if cancelled:
+        metrics.TILES.inc(cancelled, outcome="cancelled")
+        logger.info("Veredito definido com %d de %d trechos; %d cancelados", len(tile_results), len(tasks), cancelled)
+    metrics.TILES.inc(len(tile_results), outcome="analyzed")
+    metrics.TILES.inc(image_stats["skipped"], outcome="skipped")
+    
+    summary = {
+        "grid": image_stats["grid"],
+        "total": image_stats["total"],
+        "analyzed": len(tile_results),
+        "skipped": image_stats["skipped"],
+        "cancelled": cancelled
+    }
+    return merge_tile_results(tile_results), cost, "+".join(sorted(models)), escalation, summary
+
+# Agendadores das chamadas ao Gemini (um por modelo, já que a cota é por modelo):
+# limite de taxa, concorrência, retentativas e hedging
+gemini_schedulers = {}
+# O limite de chamadas simultâneas vale para todos os modelos juntos (memória e conexões do worker)
+gemini_concurrency = ConcurrencyLimit(int(os.environ.get("GEMINI_MAX_CONCURRENCY", "8")))
+
+def get_scheduler(model_name: str) -> ModelScheduler:
+    if model_name not in gemini_schedulers:
+        rate_per_minute = float(os.environ.get("GEMINI_RATE_PER_MINUTE", "60"))
+        burst = int(os.environ.get("GEMINI_BURST", "10"))
+        gemini_schedulers[model_name] = ModelScheduler(
+            rate_per_minute=rate_per_minute,
+            burst=burst,
+            concurrency=gemini_concurrency,
+            max_retries=int(os.environ.get("GEMINI_MAX_RETRIES", "3")),
+            attempt_timeout=float(os.environ.get("GEMINI_ATTEMPT_TIMEOUT", "60")),
+            hedge=os.environ.get("GEMINI_HEDGE", "0") == "1",
+            hedge_quantile=float(os.environ.get("GEMINI_HEDGE_QUANTILE", "0.95")),
+            hedge_min_delay=float(os.environ.get("GEMINI_HEDGE_MIN_DELAY", "2")),
+            # A cota é por modelo e por chave de API: com vários workers, o limite de taxa é compartilhado
+            bucket=shared_state.token_bucket(f"gemini:{model_name}", rate_per_minute / 60, burst)
+        )
+    return gemini_schedulers[model_name]
+
+def reuse_result(stored_result: dict, produtos_nomes: list, start_time: float,
+                 near_duplicate: Optional[dict] = None) -> dict:
+    """Monta a resposta a partir de uma análise anterior (cache ou quase duplicata), sem custo, e salva o log"""
+    validation_result = ValidationResult(**stored_result["validation"])
+    result = {
+        "status": stored_result["status"],
+        "details": stored_result["details"],
+        "validation": validation_result,
+        "execution_time": time.time() - start_time,
+        "cost": 0.0,
+        "cached": True,
+        "model": stored_result.get("model"),
+        "escalation_reason": stored_result.get("escalation_reason"),
+        "near_duplicate": near_duplicate,
+        "produtos": stored_result.get("produtos"),
+        "tiles": stored_result.get("tiles")
+    }
+    try:
+        with stage("save_log"):
             save_log(
-                status="error",
-                produtos=[],
-                error=error_msg,
-                analysis_details={"status": "error", "error": str(e)}
+                status=result["status"],
+                produtos=produtos_nomes,
+                execution_time=result["execution_time"],
+                cost=result["cost"],
+                analysis_details=result["details"],
+                validation_result=validation_result,
+                cache_hit=True,
+                model=result["model"],
+                escalation_reason=result["escalation_reason"]
             )
-        except Exception as log_error:
-            print(f"\nErro ao salvar log de erro: {str(log_error)}")
-        
-        raise HTTPException(status_code=500, detail=error_msg)
+    except Exception as e:
+        logger.error("Erro ao salvar log: %s", e)
+    return result
+
+async def generate_analysis(contents: list, max_output_tokens: int, timeout: float,
+                            model_name: str = GEMINI_MODEL,
+                            on_text: Optional[Callable[[str], None]] = None) -> ModelCall:
+    """
+    Chama o modelo pelo agendador, com `timeout` como prazo total (fila e retentativas incluídas).
+    Retorna o texto da resposta, o modelo, o número de chamadas cobradas e o custo estimado.
+    
+    Com `on_text`, a resposta é gerada em streaming e cada trecho é repassado assim que chega;
+    a vaga no agendador fica ocupada até o fim da leitura.
+    """
+    if timeout <= 0:
+        raise asyncio.TimeoutError()
+    # A primeira criação do modelo importa o SDK: roda em thread para não travar o event loop
+    model = await asyncio.to_thread(get_model, model_name)
+    metrics.GEMINI_UPLOAD_BYTES.inc(sum(len(part["data"]) for part in contents if isinstance(part, dict)))
+
+    def make_call():
+        return model.generate_content_async(
+            contents=contents,
+            generation_config={
+                'temperature': 0.1,
+                'top_p': 0.8,
+                'max_output_tokens': max_output_tokens,
+            },
+            stream=on_text is not None
+        )
+
+    async def consume(response):
+        return response, await read_stream(response, on_text)
+
+    try:
+        with stage("gemini"):
+            if on_text is not None:
+                (response, response_text), model_calls = await get_scheduler(model_name).call(
+                    make_call, timeout, consume)
+            else:
+                response, model_calls = await get_scheduler(model_name).call(make_call, timeout)
+                response_text = response.text
+    except ModelUnavailableError as e:
+        raise HTTPException(status_code=503, detail=f"Modelo indisponível no momento, tente novamente: {str(e)}")
+    
+    if sample_payload(logger):
+        logger.info("Resposta do Gemini", extra={"model": model_name, "response_text": response_text})
+    
+    # Cada chamada enviada (hedging ou nova tentativa após tempo limite) é cobrada como a primeira;
+    # as recusadas pelo provedor (429, 503) não entram na conta
+    cost = estimate_cost(model_name, contents, response_text, getattr(response, "usage_metadata", None)) * model_calls
+    metrics.MODEL_COST.inc(cost, model=model_name)
+    return ModelCall(response_text, model_name, model_calls, cost, is_truncated(response))
+
+async def read_stream(response, on_text: Callable[[str], None]) -> str:
+    """Consome a resposta em streaming, repassando cada trecho de texto, e retorna o texto completo"""
+    parts = []
+    async for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Trecho sem texto (ex.: apenas o motivo de término)
+            continue
+        parts.append(text)
+        on_text(text)
+    return "".join(parts)
+
+def log_analysis_error(error_msg: str, exc: Exception = None):
+    """Registra no log uma análise que terminou em erro"""
+    metrics.ANALYSIS_ERRORS.inc()
+    try:
+        save_log(
+            status="error",
+            produtos=[],
+            error=error_msg,
+            analysis_details={"status": "error", "error": str(exc) if exc else error_msg}
+        )
+    except Exception as log_error:
+        logger.error("Erro ao salvar log de erro: %s", log_error)
 
 def save_log(status: str, produtos: list, execution_time: float = 0, cost: float = 0, 
-            error: str = None, analysis_details: str = None, validation_result: ValidationResult = None):
+            error: str = None, analysis_details: str = None, validation_result: ValidationResult = None,
+            cache_hit: bool = False, model: str = None, escalation_reason: str = None):
     """Salva o log da análise no Supabase"""
     try:
         # Preparar dados para o log
@@ -257,160 +1044,265 @@ def save_log(status: str, produtos: list, execution_time: float = 0, cost: float
                 "posicionamento": validation_result.posicionamento if validation_result else None,
                 "organizacao": validation_result.organizacao if validation_result else None
             } if validation_result else None,
+            # Só nos resultados do cache: o padrão da coluna cobre os demais
+            "cache_hit": cache_hit or None,
+            "model": model,
+            "escalation_reason": escalation_reason,
             "created_at": datetime.now().isoformat()
         }
 
         # Remover campos None
         log_data = {k: v for k, v in log_data.items() if v is not None}
 
-        # Salvar no Supabase
-        supabase.table("logs").insert(log_data).execute()
-        print("\nLog salvo com sucesso!")
+        # Atualizar as estatísticas incrementais
+        stats_aggregator.record(log_data)
+
+        # Enfileirar para gravação em lote no Supabase, sem bloquear a requisição
+        log_sink.submit(log_data)
+        logger.debug("Log de análise enfileirado", extra={"log_status": status})
 
     except Exception as e:
-        print(f"\nErro ao salvar log no Supabase: {str(e)}")
+        logger.error("Erro ao salvar log no Supabase: %s", e)
         raise
 
+def insert_logs(rows: list):
+    """Grava um lote de logs no Supabase (chamado pelo LogSink, fora do event loop)"""
+    get_supabase().table("logs").insert(rows).execute()
+
+log_sink = LogSink(
+    insert_logs,
+    max_queue=int(os.environ.get("LOG_QUEUE_SIZE", "10000")),
+    batch_size=int(os.environ.get("LOG_BATCH_SIZE", "50")),
+    flush_interval=float(os.environ.get("LOG_FLUSH_INTERVAL", "2")),
+    spill_path=os.environ.get("LOG_SPILL_PATH", "logs_spill.jsonl")
+)
+
+@app.on_event("startup")
+async def start_log_sink():
+    log_sink.start()
+
+@app.on_event("shutdown")
+async def stop_log_sink():
+    await log_sink.stop()
+
+@app.on_event("startup")
+async def start_response_recorder():
+    if response_recorder:
+        response_recorder.start()
+
+@app.on_event("shutdown")
+async def stop_response_recorder():
+    if response_recorder:
+        await response_recorder.stop()
+
+export_state = ExportState(os.environ.get("EXPORT_STATE_PATH", "export_state.json"))
+
 @app.post("/export-to-sheets", response_model=dict)
-async def export_to_sheets(spreadsheet_id: str = Query(..., description="ID da planilha do Google Sheets para exportar os logs")):
+async def export_to_sheets(
+    spreadsheet_id: str = Query(..., description="ID da planilha do Google Sheets para exportar os logs"),
+    modo: Literal['incremental', 'completo'] = Query('incremental', description="'incremental' acrescenta só os logs novos; 'completo' reescreve a planilha")
+):
     """
     Exporta os logs de análise para uma planilha do Google Sheets.
     
     - **spreadsheet_id**: ID da planilha (encontrado na URL do Google Sheets)
+    - **modo**: 'incremental' (padrão) acrescenta apenas logs posteriores ao último exportado;
+      'completo' limpa e reescreve a planilha. A primeira exportação de uma planilha é sempre completa.
     
     Retorna:
     - **message**: Mensagem de sucesso
-    - **rows_updated**: Número de linhas atualizadas
+    - **rows_updated**: Número de linhas exportadas nesta chamada
+    - **mode**: Modo efetivamente usado
+    - **last_id**: ID do último log exportado
     """
     try:
-        # Buscar logs do Supabase
-        response = supabase.table('logs').select('*').order('id', desc=True).execute()
-        logs = response.data
-
-        # Preparar dados para a planilha
-        header = [['ID', 'Status', 'Produtos', 'Tempo de Execução (s)', 'Custo ($)', 'Erro']]
-        rows = []
-        for log in logs:
-            # Formatar produtos como string
-            produtos_str = log['produtos'] if isinstance(log['produtos'], str) else json.dumps(log['produtos'])
-            
-            row = [
-                str(log['id']),
-                log['status'],
-                produtos_str,
-                f"{log['execution_time']:.2f}" if log['execution_time'] else '',
-                f"${log['cost']:.4f}" if log['cost'] else '',
-                log['error'] if log['error'] else ''
-            ]
-            rows.append(row)
-
-        # Atualizar planilha
-        body = {
-            'values': header + rows
-        }
-        
-        # Limpar planilha e inserir novos dados
-        sheet = sheets_service.spreadsheets()
-        sheet.values().clear(
-            spreadsheetId=spreadsheet_id,
-            range='A1:Z'
-        ).execute()
-        
-        result = sheet.values().update(
-            spreadsheetId=spreadsheet_id,
-            range='A1',
-            valueInputOption='USER_ENTERED',
-            body=body
-        ).execute()
-
-        # Formatar cabeçalho
-        requests = [{
-            'repeatCell': {
-                'range': {
-                    'sheetId': 0,
-                    'startRowIndex': 0,
-                    'endRowIndex': 1
-                },
-                'cell': {
-                    'userEnteredFormat': {
-                        'backgroundColor': {
-                            'red': 0.2,
-                            'green': 0.2,
-                            'blue': 0.2
-                        },
-                        'textFormat': {
-                            'bold': True,
-                            'foregroundColor': {
-                                'red': 1.0,
-                                'green': 1.0,
-                                'blue': 1.0
-                            }
-                        }
-                    }
-                },
-                'fields': 'userEnteredFormat(backgroundColor,textFormat)'
-            }
-        }]
-
-        sheet.batchUpdate(
-            spreadsheetId=spreadsheet_id,
-            body={'requests': requests}
-        ).execute()
+        # As chamadas ao Supabase e ao googleapiclient são bloqueantes: rodam em thread
+        result = await asyncio.to_thread(
+            lambda: export_logs(
+                get_sheets_service(),
+                get_supabase(),
+                spreadsheet_id,
+                export_state,
+                full_rebuild=(modo == 'completo')
+            )
+        )
 
         return JSONResponse(content={
             "message": "Logs exportados com sucesso",
-            "rows_updated": len(rows)
+            **result
         })
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao exportar logs: {str(e)}")
 
+# Estatísticas incrementais
+STATS_WINDOW_MAX_MINUTES = int(os.environ.get("STATS_WINDOW_MAX_MINUTES", "1440"))
+STATS_RECONCILE_INTERVAL = float(os.environ.get("STATS_RECONCILE_INTERVAL", "600"))
+stats_aggregator = StatsAggregator(window_max_minutes=STATS_WINDOW_MAX_MINUTES, shared=cross_process_state)
+
+# Logs antigos movidos da tabela `logs` para Parquet (python log_archive.py archive)
+log_archive = LogArchive(LOG_ARCHIVE_DIR)
+
+def archived_counters():
+    """Contadores dos logs arquivados; sem o pyarrow, o /stats considera só a tabela `logs`"""
+    try:
+        return log_archive.counters()
+    except RuntimeError as e:
+        logger.warning("Logs arquivados fora das estatísticas: %s", e)
+        return None
+
+def reconcile_stats():
+    """Reconstrói as estatísticas a partir da tabela de logs e do arquivo (bloqueante, roda em thread)"""
+    archived = archived_counters()
+    cutoff = stats_aggregator.reconcile_cutoff()
+    cutoff_iso = datetime.fromtimestamp(cutoff).isoformat()
+    # Linhas até o maior id arquivado já entram pelos contadores do arquivo, mesmo que continuem na tabela
+    rows = iter_logs(
+        get_supabase(),
+        columns="id,status,cost,execution_time,produtos,created_at",
+        after_id=archived["max_id"] if archived else None,
+        apply_filters=lambda query: query.lt('created_at', cutoff_iso)
+    )
+    stats_aggregator.reconcile(rows, cutoff, archived)
+
+async def reconcile_stats_periodically():
+    while True:
+        try:
+            await asyncio.to_thread(reconcile_stats)
+            logger.info("Estatísticas reconciliadas com o Supabase")
+        except Exception as e:
+            logger.error("Erro ao reconciliar estatísticas: %s", e)
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+
+@app.on_event("startup")
+async def start_stats_reconciler():
+    app.state.stats_reconciler = asyncio.create_task(reconcile_stats_periodically())
+
+@app.on_event("shutdown")
+async def stop_stats_reconciler():
+    app.state.stats_reconciler.cancel()
+
+@app.on_event("shutdown")
+async def flush_shared_state():
+    # Grava as escritas do estado compartilhado que ainda estão na fila
+    await asyncio.to_thread(shared_state.flush, 5)
+
 @app.get("/stats")
-async def get_stats():
-    """Retorna estatísticas das análises"""
-    response = supabase.table('logs').select('*').execute()
-    logs = response.data
-    
-    total = len(logs)
-    successful = len([log for log in logs if log['status'] == 'success'])
-    total_cost = sum(log['cost'] for log in logs if log['status'] == 'success')
-    
-    successful_times = [log['execution_time'] for log in logs if log['status'] == 'success']
-    avg_time = sum(successful_times) / len(successful_times) if successful_times else 0
+async def get_stats(
+    window_minutes: Optional[int] = Query(None, ge=1, le=STATS_WINDOW_MAX_MINUTES, description="Considerar apenas os últimos N minutos"),
+    produto: Optional[str] = Query(None, description="Estatísticas de um único produto"),
+    por_produto: bool = Query(False, description="Incluir a divisão por produto")
+):
+    """
+    Retorna estatísticas das análises.
     
-    return {
-        "total_analyses": total,
-        "successful_analyses": successful,
-        "total_cost": total_cost,
-        "average_execution_time": avg_time
-    }
+    Os valores vêm de contadores mantidos a cada log gravado e reconciliados periodicamente
+    com o Supabase, sem varrer a tabela de logs a cada chamada.
+    """
+    # Com estado compartilhado, a leitura aplica os registros dos outros workers: roda em thread
+    stats = await asyncio.to_thread(stats_aggregator.get, window_minutes, produto, por_produto)
+    stats["parsing"] = await read_shared(parse_stats.to_dict)
+    return stats
 
-@app.get("/logs")
-async def get_logs(limit: int = 10):
-    """Retorna os últimos logs de análise"""
+@app.get("/stats/history")
+async def get_stats_history(
+    since: Optional[str] = Query(None, description="Data/hora ISO inicial (inclusiva) de created_at"),
+    until: Optional[str] = Query(None, description="Data/hora ISO final (exclusiva) de created_at"),
+    produto: Optional[str] = Query(None, description="Apenas análises que incluem este produto")
+):
+    """
+    Agregados históricos dos logs arquivados em Parquet (fora da tabela `logs`): taxa de sucesso
+    por produto, custo e taxa de sucesso por dia e percentis do tempo de execução.
+    """
     try:
-        query = supabase.table('logs').select('*')
-        response = query.order('id', desc=True).limit(limit).execute()
-        logs = response.data
-
-        # Formatar logs para exibição
-        formatted_logs = []
-        for log in logs:
-            produtos_str = log['produtos'] if isinstance(log['produtos'], str) else json.dumps(log['produtos'])
-            
-            formatted_log = {
-                'id': log['id'],
-                'status': log['status'],
-                'produtos': produtos_str,
-                'execution_time': f"{log['execution_time']:.2f}" if log['execution_time'] else '',
-                'cost': f"${log['cost']:.4f}" if log['cost'] else '',
-                'error': log['error'] if log['error'] else ''
-            }
-            formatted_logs.append(formatted_log)
+        return await asyncio.to_thread(log_archive.query, since, until, produto)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
 
-        return formatted_logs
+# Paginação de logs
+LOGS_MAX_PAGE = int(os.environ.get("LOGS_MAX_PAGE", "100"))
+LOGS_STREAM_MAX_ROWS = int(os.environ.get("LOGS_STREAM_MAX_ROWS", "100000"))
+
+@app.get("/logs")
+async def get_logs(
+    limit: Optional[int] = Query(None, ge=1, description=f"Logs por página (padrão: 10, máximo: {LOGS_MAX_PAGE})"),
+    after_id: Optional[int] = Query(None, description="Retorna logs com id maior que este (mais novos)"),
+    before_id: Optional[int] = Query(None, description="Retorna logs com id menor que este (mais antigos)"),
+    status: Optional[str] = Query(None, description="Filtrar por status (success, pending, error)"),
+    since: Optional[str] = Query(None, description="Data/hora ISO inicial (inclusiva) de created_at"),
+    until: Optional[str] = Query(None, description="Data/hora ISO final (exclusiva) de created_at"),
+    produto: Optional[str] = Query(None, description="Filtrar por nome de produto"),
+    fields: Optional[str] = Query(None, description="Colunas separadas por vírgula (padrão: id,status,produtos,execution_time,cost,error)"),
+    format: Literal['json', 'ndjson'] = Query('json', description="'ndjson' transmite todos os logs filtrados em ordem crescente de id")
+):
+    """
+    Retorna os logs de análise, do mais novo para o mais antigo.
+    
+    A paginação é por cursor: use `before_id` com o menor id da página para buscar a próxima
+    (o valor também vem no cabeçalho `X-Next-Before-Id`), ou `after_id` para buscar logs mais novos.
+    Com `format=ndjson`, os logs são transmitidos linha a linha (até `LOGS_STREAM_MAX_ROWS`).
+    """
+    try:
+        columns = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    apply_filters = log_filters(status=status, since=since, until=until, produto=produto, before_id=before_id)
+    
+    if format == 'ndjson':
+        max_rows = min(limit or LOGS_STREAM_MAX_ROWS, LOGS_STREAM_MAX_ROWS)
+        
+        def stream_logs():
+            # Gerador síncrono: o Starlette o percorre em uma thread, fora do event loop
+            rows = iter_logs(get_supabase(), ",".join(columns), after_id=after_id, apply_filters=apply_filters)
+            for count, log in enumerate(rows):
+                if count >= max_rows:
+                    break
+                yield json.dumps(format_log(log), ensure_ascii=False) + "\n"
+        
+        return StreamingResponse(stream_logs(), media_type="application/x-ndjson")
+    
+    limit = min(limit or 10, LOGS_MAX_PAGE)
+    
+    def fetch_page():
+        query = apply_filters(get_supabase().table('logs').select(",".join(columns)))
+        if after_id is not None:
+            # Logs mais novos que o cursor: busca os primeiros em ordem crescente e inverte
+            rows = query.gt('id', after_id).order('id').limit(limit).execute().data
+            return list(reversed(rows))
+        return query.order('id', desc=True).limit(limit).execute().data
+    
+    try:
+        logs = await asyncio.to_thread(fetch_page)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao buscar logs: {str(e)}")
+    
+    headers = {"X-Next-Before-Id": str(logs[-1]['id'])} if len(logs) == limit else {}
+    return JSONResponse(content=[format_log(log) for log in logs], headers=headers)
+
+# Métricas lidas no momento da coleta
+metrics.Gauge("smartshelf_result_cache_entries", "Entradas no cache de resultados",
+              lambda: result_cache.stats()["entries"] if result_cache else 0)
+metrics.Gauge("smartshelf_log_queue_size", "Logs aguardando gravação no Supabase",
+              lambda: log_sink.stats()["queued"])
+metrics.Gauge("smartshelf_job_queue_depth", "Jobs aguardando na fila",
+              lambda: job_queue.stats()["queue_depth"])
+metrics.Gauge("smartshelf_buffered_upload_bytes", "Bytes de upload mantidos em memória pelas requisições em andamento",
+              lambda: uploads.buffered_upload_bytes)
+metrics.Gauge("smartshelf_process_peak_rss_bytes", "Pico de memória residente do processo",
+              lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+metrics.Gauge("smartshelf_near_duplicate_entries", "Imagens no índice de quase duplicatas",
+              lambda: near_dup_index.stats()["entries"] if near_dup_index else 0)
+metrics.Gauge("smartshelf_gemini_waiting", "Chamadas ao Gemini aguardando o limite de taxa ou de concorrência",
+              lambda: sum(s.waiting for s in list(gemini_schedulers.values())))
+metrics.Gauge("smartshelf_gemini_in_flight", "Chamadas ao Gemini em andamento",
+              lambda: sum(s.in_flight for s in list(gemini_schedulers.values())))
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Métricas no formato texto do Prometheus (tempos por etapa, chamadas ao Gemini, cache, bytes)"""
+    # A profundidade da fila de jobs consulta o SQLite: coleta em thread
+    return PlainTextResponse(await asyncio.to_thread(metrics.render), media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
     import uvicorn
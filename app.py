@@ -1,13 +1,24 @@
 # app/main.py
 
 import streamlit as st
-import google.generativeai as genai
-from PIL import Image
+import threading
 import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
 import json
+import os
 from prompts import PROMPTS  # Importando os prompts do novo arquivo
+from model_routing import escalation_reason, estimate_cost, is_truncated
+from image_processing import preprocess_image
+from parsing import ResponseParseError, parse_response
+
+try:
+    import fcntl
+except ImportError:  # Windows: apenas o lock entre sessões do mesmo processo
+    fcntl = None
 
 # Configuração inicial
 st.set_page_config(
@@ -18,8 +29,44 @@ st.set_page_config(
 )
 
 # Configuração do Gemini
-genai.configure(api_key=st.secrets["GOOGLE_API_KEY"])
-model = genai.GenerativeModel('gemini-1.5-pro-latest')
+MODEL_NAME = st.secrets.get("GEMINI_MODEL", os.environ.get("GEMINI_MODEL", "gemini-1.5-pro-latest"))
+GEMINI_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", "120"))
+
+# Roteamento como na API: 'tiered' tenta o modelo rápido primeiro e só repete no MODEL_NAME
+# se o resultado não passar na heurística de confiança
+FAST_MODEL_NAME = st.secrets.get("GEMINI_FAST_MODEL", os.environ.get("GEMINI_FAST_MODEL", "gemini-1.5-flash-latest"))
+MODEL_ROUTING = st.secrets.get("MODEL_ROUTING", os.environ.get("MODEL_ROUTING", "single"))
+ESCALATE_ON_MIXED = os.environ.get("ESCALATE_ON_MIXED", "1") == "1"
+
+# Com a URL da API configurada, as análises são feitas pelo /analyze (mesmo cache e
+# pré-processamento da API); sem ela, o app chama o Gemini diretamente
+API_URL = st.secrets.get("SMART_SHELF_API_URL", os.environ.get("SMART_SHELF_API_URL", ""))
+API_TIMEOUT = float(os.environ.get("SMART_SHELF_API_TIMEOUT", "150"))
+
+CONFIG_PATH = Path(os.environ.get("CONFIG_PATH", "config.json"))
+
+# Recursos compartilhados por todas as sessões e reexecuções do script
+@st.cache_resource
+def get_model(model_name: str):
+    """Modelo do Gemini, criado uma única vez por processo"""
+    import google.generativeai as genai
+    genai.configure(api_key=st.secrets["GOOGLE_API_KEY"])
+    return genai.GenerativeModel(model_name)
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    """Threads para a chamada bloqueante ao Gemini, com tempo limite no script"""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="gemini")
+
+@st.cache_resource
+def get_api_client():
+    """Cliente HTTP da API, reaproveitando conexões entre análises"""
+    import httpx
+    return httpx.Client(base_url=API_URL, timeout=API_TIMEOUT)
+
+@st.cache_resource
+def get_config_lock() -> threading.Lock:
+    return threading.Lock()
 
 # Estilo CSS otimizado para mobile
 st.markdown("""
@@ -50,17 +97,192 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Carregar/inicializar configurações
+DEFAULT_CONFIG = {
+    'cost_per_analysis': 0.0005,
+    'total_analyses': 0,
+    'total_cost': 0.0
+}
+
 def load_config():
-    config_file = Path('config.json')
-    if config_file.exists():
-        return json.loads(config_file.read_text())
-    return {
-        'cost_per_analysis': 0.0005,
-        'total_analyses': 0,
-        'total_cost': 0.0
-    }
+    if CONFIG_PATH.exists():
+        return {**DEFAULT_CONFIG, **json.loads(CONFIG_PATH.read_text())}
+    return dict(DEFAULT_CONFIG)
+
+@contextmanager
+def config_lock():
+    """Exclusão mútua entre sessões (threads) e entre processos do Streamlit"""
+    with get_config_lock():
+        with open(CONFIG_PATH.with_name(CONFIG_PATH.name + ".lock"), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def update_config(update) -> dict:
+    """
+    Lê, altera com `update(config)` e grava o config.json sob lock, para que sessões
+    simultâneas não sobrescrevam os contadores umas das outras. A gravação é atômica
+    (arquivo temporário + os.replace): o arquivo nunca fica pela metade.
+    """
+    with config_lock():
+        config = load_config()
+        update(config)
+        temp_path = CONFIG_PATH.with_name(f".{CONFIG_PATH.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        temp_path.write_text(json.dumps(config, indent=2))
+        os.replace(temp_path, CONFIG_PATH)
+    return config
+
+def record_analysis(custo: float):
+    def update(config):
+        config['total_analyses'] += 1
+        config['total_cost'] += custo
+    update_config(update)
+
+def parse_server_timing(header: str) -> dict:
+    """Tempos (s) do cabeçalho Server-Timing da API ('etapa;dur=12.3, ...', em ms)"""
+    timings = {}
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        if params.startswith("dur="):
+            timings[name] = float(params[4:]) / 1000
+    return timings
+
+def call_gemini(model_name: str, contents: list):
+    """Chamada bloqueante ao Gemini em uma thread, com tempo limite"""
+    future = get_executor().submit(
+        get_model(model_name).generate_content,
+        contents=contents,
+        generation_config={
+            'temperature': 0.1,
+            'top_p': 0.8,
+            'max_output_tokens': 300,
+        }
+    )
+    try:
+        return future.result(timeout=GEMINI_TIMEOUT)
+    except FutureTimeoutError:
+        raise RuntimeError(f"O Gemini não respondeu em {GEMINI_TIMEOUT:.0f}s")
 
-config = load_config()
+def analyze_local(image_data: bytes, produtos_nomes: list) -> dict:
+    """Pré-processa a imagem e chama o Gemini diretamente, medindo cada etapa"""
+    timings = {}
+    start_time = time.perf_counter()
+    image_bytes, mime_type, _ = preprocess_image(image_data)
+    timings["pré-processamento"] = time.perf_counter() - start_time
+    
+    prompt = PROMPTS['default'].format(produtos=", ".join(produtos_nomes))
+    contents = [prompt, {"mime_type": mime_type, "data": image_bytes}]
+    custo = 0.0
+    parsed = None
+    escalation = None
+    
+    # Roteamento em camadas: o modelo rápido primeiro; o principal só se o resultado for duvidoso
+    if MODEL_ROUTING == 'tiered':
+        gemini_start = time.perf_counter()
+        response = call_gemini(FAST_MODEL_NAME, contents)
+        timings[f"gemini ({FAST_MODEL_NAME})"] = time.perf_counter() - gemini_start
+        custo += estimate_cost(FAST_MODEL_NAME, contents, response.text, getattr(response, "usage_metadata", None))
+        try:
+            parsed = parse_response(response.text, 'default', produtos_nomes)
+            escalation = escalation_reason(*parsed, truncated=is_truncated(response),
+                                           escalate_on_mixed=ESCALATE_ON_MIXED)
+        except ResponseParseError:
+            escalation = "malformed"
+        if escalation:
+            parsed = None
+        model_name = FAST_MODEL_NAME
+    
+    if parsed is None:
+        model_name = MODEL_NAME
+        gemini_start = time.perf_counter()
+        response = call_gemini(MODEL_NAME, contents)
+        timings[f"gemini ({MODEL_NAME})" if MODEL_ROUTING == 'tiered' else "gemini"] = time.perf_counter() - gemini_start
+        # Custo real do modelo usado
+        custo += estimate_cost(MODEL_NAME, contents, response.text, getattr(response, "usage_metadata", None))
+        try:
+            parsed = parse_response(response.text, 'default', produtos_nomes)
+        except ResponseParseError:
+            parsed = (None, None, response.text, None)
+    
+    status, validation, details, _ = parsed
+    return {"status": status, "validation": validation, "details": details, "cost": custo,
+            "cached": False, "model": model_name, "escalation_reason": escalation, "timings": timings}
+
+def analyze_api(image_data: bytes, filename: str, produtos_nomes: list) -> dict:
+    """Envia a imagem ao /analyze da API; os tempos das etapas vêm do cabeçalho Server-Timing"""
+    produtos = [{"nome": nome, "descricao": ""} for nome in produtos_nomes]
+    start_time = time.perf_counter()
+    response = get_api_client().post(
+        "/analyze",
+        files={"file": (filename, image_data)},
+        data={"produtos": json.dumps(produtos, ensure_ascii=False)}
+    )
+    elapsed = time.perf_counter() - start_time
+    if response.status_code != 200:
+        raise RuntimeError(f"API respondeu {response.status_code}: {response.text[:300]}")
+    result = response.json()
+    timings = parse_server_timing(response.headers.get("server-timing", ""))
+    server_total = timings.pop("total", None)
+    if server_total is not None:
+        timings["rede"] = max(0.0, elapsed - server_total)
+    return {"status": result["status"], "validation": result["validation"], "details": result["details"],
+            "cost": result["cost"], "cached": result.get("cached", False), "model": result.get("model"),
+            "escalation_reason": result.get("escalation_reason"), "timings": timings}
+
+# Rótulos dos critérios na tela de resultado
+CRITERIOS = {
+    "nome_marca": "Nome/marca visível",
+    "preco": "Etiqueta de preço",
+    "posicionamento": "Posicionamento",
+    "organizacao": "Organização",
+}
+
+def show_result(result: dict, total_time: float, session_cache_hit: bool):
+    if result["status"] == "success":
+        st.success(" Análise Concluída: validação aprovada")
+    elif result["status"] is not None:
+        st.warning(" Análise Concluída: validação pendente")
+    else:
+        st.success(" Análise Concluída!")
+    
+    # Resultados em cards para melhor visualização mobile
+    st.markdown("""
+        <div style='background-color: #f0f2f6; padding: 1rem; border-radius: 10px; margin: 1rem 0;'>
+    """, unsafe_allow_html=True)
+    
+    st.markdown("### Resultados:")
+    if result["validation"]:
+        for criterio, valor in result["validation"].items():
+            st.write(f"{'✅' if valor else '❌'} {CRITERIOS.get(criterio, criterio)}")
+    st.write(result["details"])
+    
+    st.markdown("</div>", unsafe_allow_html=True)
+    
+    # Métricas simplificadas
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("Custo", f"${result['cost']:.4f}")
+    with col2:
+        st.metric("Tempo", f"{total_time:.1f}s")
+    
+    if result.get("model"):
+        escalation = result.get("escalation_reason")
+        st.caption(f"Modelo: {result['model']}" + (f" (escalado do modelo rápido: {escalation})" if escalation else ""))
+    if session_cache_hit:
+        st.caption("Resultado já obtido nesta sessão para a mesma imagem e produtos (sem nova chamada)")
+    elif result["cached"]:
+        st.caption("Resultado reaproveitado do cache da API")
+    if result["timings"]:
+        with st.expander("Tempos por etapa"):
+            for etapa, segundos in result["timings"].items():
+                st.write(f"{etapa}: {segundos * 1000:.0f} ms")
+
+# Resultados desta sessão por imagem (hash do conteúdo) e produtos
+if "resultados" not in st.session_state:
+    st.session_state["resultados"] = {}
 
 # Interface principal
 st.title(" Smart Shelf")
@@ -82,68 +304,64 @@ with tab_analise:
     else:
         imagem = st.file_uploader("Selecionar foto da prateleira", type=['jpg', 'jpeg', 'png'])
 
+    produtos_texto = st.text_area("Produtos (um por linha)")
+    produtos_nomes = [linha.strip() for linha in produtos_texto.splitlines() if linha.strip()]
+
     if imagem:
         # Mostra imagem com preview responsivo
         st.image(imagem, use_container_width=True)
         
         # Botão de análise
-        if st.button(" Analisar", use_container_width=True):
-            with st.spinner("Analisando..."):
-                try:
-                    # Prepara a imagem
-                    img = Image.open(imagem)
-                    
-                    # Análise com Gemini
-                    response = model.generate_content(
-                        contents=[PROMPTS['default'], img],
-                        generation_config={
-                            'temperature': 0.1,
-                            'top_p': 0.8,
-                            'max_output_tokens': 300,
-                        }
-                    )
-                    
-                    # Atualiza estatísticas
-                    config['total_analyses'] += 1
-                    config['total_cost'] += config['cost_per_analysis']
-                    
-                    # Mostra resultados
-                    st.success(" Análise Concluída!")
-                    
-                    # Resultados em cards para melhor visualização mobile
-                    st.markdown("""
-                        <div style='background-color: #f0f2f6; padding: 1rem; border-radius: 10px; margin: 1rem 0;'>
-                    """, unsafe_allow_html=True)
-                    
-                    st.markdown("### Resultados:")
-                    st.write(response.text)
-                    
-                    st.markdown("</div>", unsafe_allow_html=True)
-                    
-                    # Métricas simplificadas
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        st.metric("Custo", f"${config['cost_per_analysis']:.4f}")
-                    with col2:
-                        st.metric("Tempo", "1.2s")
-                    
-                except Exception as e:
-                    st.error(f"Erro na análise: {str(e)}")
+        if st.button(" Analisar", use_container_width=True, disabled=not produtos_nomes):
+            start_time = time.perf_counter()
+            image_data = imagem.getvalue()
+            digest = hashlib.sha256(image_data)
+            digest.update(json.dumps([API_URL or f"{MODEL_ROUTING}:{MODEL_NAME}"] + produtos_nomes, ensure_ascii=False).encode("utf-8"))
+            cache_key = digest.hexdigest()
+            
+            result = st.session_state["resultados"].get(cache_key)
+            session_cache_hit = result is not None
+            if result is None:
+                with st.spinner("Analisando..."):
+                    try:
+                        if API_URL:
+                            result = analyze_api(image_data, imagem.name, produtos_nomes)
+                        else:
+                            result = analyze_local(image_data, produtos_nomes)
+                    except Exception as e:
+                        st.error(f"Erro na análise: {str(e)}")
+                if result is not None:
+                    st.session_state["resultados"][cache_key] = result
+                    # Atualiza as estatísticas (gravação atômica e sob lock)
+                    record_analysis(result["cost"])
+            
+            if result is not None:
+                show_result(result, time.perf_counter() - start_time, session_cache_hit)
+        elif not produtos_nomes:
+            st.caption("Informe ao menos um produto para analisar")
 
 with tab_config:
     st.markdown("### Configurações")
+    if API_URL:
+        st.caption(f"Análises pela API em {API_URL}")
+    elif MODEL_ROUTING == 'tiered':
+        st.caption(f"Análises direto no Gemini ({FAST_MODEL_NAME}, escalando para {MODEL_NAME})")
+    else:
+        st.caption(f"Análises direto no Gemini ({MODEL_NAME})")
     
     # Removendo a edição de prompts da interface, já que agora está em arquivo separado
     st.markdown("#### Estatísticas")
+    config = load_config()
     st.metric("Total de Análises", config['total_analyses'])
     st.metric("Custo Total", f"${config['total_cost']:.3f}")
     
-    if st.button("Resetar Estatísticas"):
-        if st.checkbox("Confirmar reset"):
+    confirmar = st.checkbox("Confirmar reset")
+    if st.button("Resetar Estatísticas", disabled=not confirmar):
+        def reset(config):
             config['total_analyses'] = 0
             config['total_cost'] = 0.0
-            Path('config.json').write_text(json.dumps(config, indent=2))
-            st.success("Estatísticas resetadas!")
+        update_config(reset)
+        st.success("Estatísticas resetadas!")
 
 # Footer otimizado para mobile
 st.markdown("---")
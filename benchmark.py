@@ -0,0 +1,533 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+# Benchmark e teste de carga offline da API: o Gemini, o Supabase e o Google Sheets são
+# substituídos por dublês locais (latência, taxa de erros e tamanho da tabela configuráveis)
+# e a aplicação FastAPI é chamada em processo, sem rede e sem custo.
+#
+# Uso:
+#   python benchmark.py --scenario analyze --concurrency 16 --requests 500 --output resultado.json
+#   python benchmark.py --scenario all --compare resultado.json
+#
+# O resultado (p50/p95/p99, vazão, erros e memória por cenário) é salvo em JSON; com
+# `--compare`, as latências e a vazão são comparadas com uma execução anterior.
+
+SCENARIOS = ["analyze", "stats", "logs", "export"]
+
+MODEL_RESPONSE = json.dumps({
+    "aprovado": False,
+    "criterios": {"nome_marca": True, "etiqueta_preco": False, "posicionamento": True, "organizacao": True},
+    "detalhes": ["Colocar a etiqueta de preço junto ao produto"]
+}, ensure_ascii=False)
+
+
+def _delay(mean: float, jitter: float) -> float:
+    """Latência simulada: `mean` segundos com variação uniforme de ±`jitter` (fração)"""
+    return max(0.0, mean * random.uniform(1 - jitter, 1 + jitter))
+
+
+class ServiceUnavailable(Exception):
+    """Erro transitório simulado (o agendador do Gemini repete a chamada, como no provedor real)"""
+    code = 503
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self.candidates = []
+        self.usage_metadata = None
+
+
+class FakeStreamResponse(FakeResponse):
+    """Resposta em streaming: o texto chega em `chunks` trechos, com `chunk_delay` entre eles"""
+
+    def __init__(self, text: str, chunks: int = 5, chunk_delay: float = 0.0):
+        super().__init__(text)
+        size = max(1, -(-len(text) // chunks))
+        self._chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        self._chunk_delay = chunk_delay
+
+    async def __aiter__(self):
+        for chunk in self._chunks:
+            await asyncio.sleep(self._chunk_delay)
+            yield FakeResponse(chunk)
+
+
+class FakeModel:
+    """Dublê do GenerativeModel do Gemini"""
+
+    def __init__(self, latency: float = 1.0, jitter: float = 0.3, error_rate: float = 0.0,
+                 response_text: str = MODEL_RESPONSE):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.response_text = response_text
+        self.calls = 0
+
+    async def generate_content_async(self, contents, generation_config=None, stream: bool = False, **kwargs):
+        self.calls += 1
+        # No streaming, a latência simulada se divide entre o primeiro trecho e o restante
+        delay = _delay(self.latency, self.jitter)
+        await asyncio.sleep(delay / 2 if stream else delay)
+        if random.random() < self.error_rate:
+            raise ServiceUnavailable("Erro simulado do modelo")
+        if stream:
+            return FakeStreamResponse(self.response_text, chunk_delay=delay / 10)
+        return FakeResponse(self.response_text)
+
+
+class _Result:
+    def __init__(self, data: list):
+        self.data = data
+
+
+def _like(pattern: str) -> re.Pattern:
+    """Padrão do LIKE do Postgres como expressão regular: `%`, `_` e o escape com `\\`"""
+    regex = []
+    chars = iter(pattern)
+    for char in chars:
+        if char == "\\":
+            regex.append(re.escape(next(chars, "")))
+        elif char == "%":
+            regex.append(".*")
+        elif char == "_":
+            regex.append(".")
+        else:
+            regex.append(re.escape(char))
+    return re.compile("".join(regex), re.DOTALL)
+
+
+class FakeQuery:
+    """Consulta à tabela em memória com o subconjunto da API do supabase-py usado pela aplicação"""
+
+    def __init__(self, db: "FakeSupabase", table: str):
+        self.db = db
+        self.table = table
+        self.columns: Optional[List[str]] = None
+        self.filters: List[Callable[[dict], bool]] = []
+        self.order_by = None
+        self.row_limit = None
+        self.rows_to_insert = None
+        self.deleting = False
+
+    def select(self, columns: str = "*"):
+        self.columns = None if columns == "*" else [c.strip() for c in columns.split(",")]
+        return self
+
+    def _filter(self, column: str, test: Callable):
+        self.filters.append(lambda row: row.get(column) is not None and test(row[column]))
+        return self
+
+    def eq(self, column, value):
+        return self._filter(column, lambda v: v == value)
+
+    def gt(self, column, value):
+        return self._filter(column, lambda v: v > value)
+
+    def gte(self, column, value):
+        return self._filter(column, lambda v: v >= value)
+
+    def lt(self, column, value):
+        return self._filter(column, lambda v: v < value)
+
+    def lte(self, column, value):
+        return self._filter(column, lambda v: v <= value)
+
+    def like(self, column, pattern):
+        regex = _like(pattern)
+        return self._filter(column, lambda v: regex.fullmatch(str(v)) is not None)
+
+    def order(self, column, desc=False):
+        self.order_by = (column, desc)
+        return self
+
+    def limit(self, count):
+        self.row_limit = count
+        return self
+
+    def insert(self, rows):
+        self.rows_to_insert = rows if isinstance(rows, list) else [rows]
+        return self
+
+    def delete(self):
+        self.deleting = True
+        return self
+
+    def execute(self) -> _Result:
+        time.sleep(_delay(self.db.latency, self.db.jitter))
+        if random.random() < self.db.error_rate:
+            raise RuntimeError("Erro simulado do Supabase")
+        if self.rows_to_insert is not None:
+            return _Result(self.db.insert(self.table, self.rows_to_insert))
+
+        rows = self.db.tables.get(self.table, [])
+        rows = [row for row in rows if all(test(row) for test in self.filters)]
+        if self.deleting:
+            return _Result(self.db.delete(self.table, rows))
+        if self.order_by is not None:
+            column, desc = self.order_by
+            # As linhas já estão em ordem crescente de id
+            if column != "id" or desc:
+                rows.sort(key=lambda row: row.get(column), reverse=desc)
+        if self.row_limit is not None:
+            rows = rows[:self.row_limit]
+        if self.columns is not None:
+            rows = [{c: row.get(c) for c in self.columns} for row in rows]
+        return _Result(rows)
+
+
+class FakeSupabase:
+    """Dublê do cliente do Supabase: tabelas em memória, com latência e erros por consulta"""
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.3, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tables: Dict[str, List[dict]] = {}
+        # Próximo id de cada tabela, como uma sequence do Postgres (não reutiliza ids apagados)
+        self._next_ids: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def delete(self, table: str, rows: List[dict]) -> List[dict]:
+        with self._lock:
+            ids = {id(row) for row in rows}
+            self.tables[table] = [row for row in self.tables.get(table, []) if id(row) not in ids]
+        return rows
+
+    def insert(self, table: str, rows: List[dict]) -> List[dict]:
+        with self._lock:
+            existing = self.tables.setdefault(table, [])
+            next_id = self._next_ids.get(table, existing[-1]["id"] + 1 if existing else 1)
+            inserted = [{**row, "id": next_id + i} for i, row in enumerate(rows)]
+            existing.extend(inserted)
+            self._next_ids[table] = next_id + len(inserted)
+        return inserted
+
+
+def generate_logs(count: int, seed: int = 0) -> List[dict]:
+    """Linhas sintéticas para a tabela `logs`, nas últimas 24h"""
+    rng = random.Random(seed)
+    produtos = ["Coca Cola", "Guaraná Antarctica", "Leite Ninho", "Café Pilão", "Sabão Omo"]
+    now = datetime.now(timezone.utc)
+    rows = []
+    for i in range(count):
+        status = rng.choices(["success", "pending", "error"], weights=[6, 3, 1])[0]
+        rows.append({
+            "id": i + 1,
+            "status": status,
+            # Mesmo formato de save_log (acentos escapados como \uXXXX)
+            "produtos": json.dumps(rng.sample(produtos, rng.randint(1, 3))),
+            "execution_time": rng.uniform(2, 12),
+            "cost": 0.0005 if status != "error" else 0,
+            "error": "Erro simulado" if status == "error" else None,
+            "cache_hit": rng.random() < 0.1,
+            "model": "gemini-1.5-pro-latest",
+            "escalation_reason": None,
+            "validation": json.dumps({"nome_marca": True, "etiqueta_preco": status == "success"}),
+            "analysis_details": "Detalhes simulados da análise",
+            "created_at": (now - timedelta(seconds=(count - i) * 86400 / max(count, 1))).isoformat(),
+        })
+    return rows
+
+
+class _SheetsCall:
+    def __init__(self, service: "FakeSheetsService", rows: int = 0):
+        self.service = service
+        self.rows = rows
+
+    def execute(self) -> dict:
+        time.sleep(_delay(self.service.latency, self.service.jitter))
+        self.service.rows_written += self.rows
+        return {}
+
+
+class _SheetsValues:
+    def __init__(self, service: "FakeSheetsService"):
+        self.service = service
+
+    def clear(self, **kwargs):
+        return _SheetsCall(self.service)
+
+    def update(self, **kwargs):
+        return _SheetsCall(self.service, len(kwargs["body"]["values"]))
+
+    def append(self, **kwargs):
+        return _SheetsCall(self.service, len(kwargs["body"]["values"]))
+
+
+class _Spreadsheets:
+    def __init__(self, service: "FakeSheetsService"):
+        self.service = service
+
+    def values(self):
+        return _SheetsValues(self.service)
+
+    def batchUpdate(self, **kwargs):
+        return _SheetsCall(self.service)
+
+
+class FakeSheetsService:
+    """Dublê do serviço do Google Sheets (googleapiclient)"""
+
+    def __init__(self, latency: float = 0.2, jitter: float = 0.3):
+        self.latency = latency
+        self.jitter = jitter
+        self.rows_written = 0
+
+    def spreadsheets(self):
+        return _Spreadsheets(self)
+
+
+def make_image(width: int, height: int) -> bytes:
+    """JPEG com ruído (comprime pouco, como uma foto), para o pré-processamento ter trabalho real"""
+    from PIL import Image
+    image = Image.effect_noise((width, height), 40).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss é em KB no Linux e em bytes no macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def summarize(latencies: List[float], statuses: Dict[int, int], elapsed: float,
+              request_memory: List[int], rss_before: int) -> dict:
+    latencies = sorted(latencies)
+    total = sum(statuses.values())
+    errors = sum(count for status, count in statuses.items() if status >= 400)
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0,
+        "status_codes": {str(status): count for status, count in sorted(statuses.items())},
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0,
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": ms(percentile(latencies, 0.50)),
+            "p95": ms(percentile(latencies, 0.95)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "max": ms(latencies[-1]) if latencies else None,
+        },
+        "memory": {
+            "peak_rss_bytes": peak_rss_bytes(),
+            "peak_rss_growth_bytes": peak_rss_bytes() - rss_before,
+            "request_peak_p95_bytes": percentile(sorted(request_memory), 0.95),
+            "request_peak_max_bytes": max(request_memory) if request_memory else None,
+        },
+    }
+
+
+def build_requests(args) -> Dict[str, Callable[[int], dict]]:
+    """Para cada cenário, a função que monta os argumentos da i-ésima requisição (httpx)"""
+    image = make_image(args.image_width, args.image_height)
+    produtos = json.dumps([{"nome": "Coca Cola", "descricao": "Refrigerante 2L"}], ensure_ascii=False)
+
+    def analyze(i: int) -> dict:
+        # Bytes após o fim do JPEG não mudam a imagem, mas evitam acertos no cache de resultados
+        data = image if args.repeat_images else image + i.to_bytes(8, "big")
+        return {"method": "POST", "url": "/analyze", "data": {"produtos": produtos},
+                "files": {"file": ("prateleira.jpg", data, "image/jpeg")}}
+
+    def stats(i: int) -> dict:
+        return {"method": "GET", "url": "/stats", "params": {"window_minutes": 60, "por_produto": "true"}}
+
+    def logs(i: int) -> dict:
+        return {"method": "GET", "url": "/logs", "params": {"limit": 50, "status": "success"}}
+
+    def export(i: int) -> dict:
+        # Planilhas diferentes: a exportação é serializada por planilha
+        return {"method": "POST", "url": "/export-to-sheets",
+                "params": {"spreadsheet_id": f"benchmark-{i % args.concurrency}", "modo": "completo"}}
+
+    return {"analyze": analyze, "stats": stats, "logs": logs, "export": export}
+
+
+async def run_scenario(client, make_request: Callable[[int], dict], concurrency: int,
+                       total_requests: int, duration: Optional[float]) -> dict:
+    """Dispara `total_requests` (ou o que couber em `duration` segundos) com `concurrency` clientes simultâneos"""
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    request_memory: List[int] = []
+    counter = iter(range(total_requests if duration is None else sys.maxsize))
+    rss_before = peak_rss_bytes()
+    start_time = time.perf_counter()
+    deadline = start_time + duration if duration is not None else None
+
+    async def worker():
+        for i in counter:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            request = make_request(i)
+            request_start = time.perf_counter()
+            try:
+                response = await client.request(**request)
+                status = response.status_code
+                peak = response.headers.get("x-peak-memory-bytes")
+                if peak is not None:
+                    request_memory.append(int(peak))
+            except Exception:
+                status = 599
+            latencies.append(time.perf_counter() - request_start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, statuses, time.perf_counter() - start_time, request_memory, rss_before)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Regressões em relação a uma execução anterior: latência p50/p95/p99 ou vazão piores que `tolerance`"""
+    regressions = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        for q in ("p50", "p95", "p99"):
+            before, after = previous["latency_ms"][q], current["latency_ms"][q]
+            if before and after and after > before * (1 + tolerance):
+                regressions.append(f"{name}: {q} {before:.1f}ms -> {after:.1f}ms")
+        before, after = previous["throughput_rps"], current["throughput_rps"]
+        if before and after < before * (1 - tolerance):
+            regressions.append(f"{name}: vazão {before:.1f} -> {after:.1f} req/s")
+    return regressions
+
+
+def configure_environment(args, work_dir: str):
+    """Ambiente da aplicação antes de importá-la: arquivos locais temporários e sem aquecimento"""
+    os.environ.setdefault("WARMUP_ENABLED", "0")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("JOBS_DB_PATH", os.path.join(work_dir, "jobs.db"))
+    os.environ.setdefault("EXPORT_STATE_PATH", os.path.join(work_dir, "export_state.json"))
+    os.environ.setdefault("LOG_SPILL_PATH", os.path.join(work_dir, "logs_spill.jsonl"))
+    # Sem limite de taxa próprio: o que se mede é a aplicação, não a cota do Gemini
+    os.environ.setdefault("GEMINI_RATE_PER_MINUTE", "0")
+    os.environ.setdefault("GEMINI_MAX_CONCURRENCY", str(max(8, args.concurrency)))
+
+
+def install_fakes(args, api) -> dict:
+    import clients
+
+    model = FakeModel(args.model_latency, args.jitter, args.model_error_rate)
+    supabase = FakeSupabase(args.supabase_latency, args.jitter, args.supabase_error_rate)
+    supabase.tables["logs"] = generate_logs(args.log_rows)
+    sheets = FakeSheetsService(args.sheets_latency, args.jitter)
+
+    for model_name in {api.GEMINI_MODEL, api.GEMINI_FAST_MODEL}:
+        clients.set_client(f"gemini:{model_name}", model)
+    clients.set_client("supabase", supabase)
+    clients.set_client("sheets", sheets)
+    return {"model": model, "supabase": supabase, "sheets": sheets}
+
+
+async def run(args) -> dict:
+    import httpx
+    import api
+
+    fakes = install_fakes(args, api)
+    make_requests = build_requests(args)
+    scenarios = SCENARIOS if args.scenario == "all" else [args.scenario]
+
+    await api.app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            results = {}
+            for name in scenarios:
+                if args.warmup:
+                    await run_scenario(client, make_requests[name], min(args.concurrency, args.warmup),
+                                       args.warmup, None)
+                calls_before = fakes["model"].calls
+                results[name] = await run_scenario(client, make_requests[name], args.concurrency,
+                                                   args.requests, args.duration)
+                results[name]["model_calls"] = fakes["model"].calls - calls_before
+                print(f"{name}: {results[name]['requests']} req, {results[name]['throughput_rps']} req/s, "
+                      f"p50 {results[name]['latency_ms']['p50']}ms, p95 {results[name]['latency_ms']['p95']}ms, "
+                      f"p99 {results[name]['latency_ms']['p99']}ms, erros {results[name]['errors']}", file=sys.stderr)
+    finally:
+        await api.app.router.shutdown()
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "scenarios": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline da SMART-SHELF-API com dublês do Gemini, Supabase e Sheets")
+    parser.add_argument("--scenario", choices=SCENARIOS + ["all"], default="all")
+    parser.add_argument("--concurrency", type=int, default=8, help="Clientes simultâneos")
+    parser.add_argument("--requests", type=int, default=200, help="Requisições por cenário")
+    parser.add_argument("--duration", type=float, default=None, help="Duração em segundos por cenário (ignora --requests)")
+    parser.add_argument("--warmup", type=int, default=10, help="Requisições de aquecimento descartadas")
+    parser.add_argument("--model-latency", type=float, default=1.0, help="Latência média do Gemini (s)")
+    parser.add_argument("--model-error-rate", type=float, default=0.0, help="Fração das chamadas ao Gemini com erro 503")
+    parser.add_argument("--supabase-latency", type=float, default=0.05, help="Latência média por consulta ao Supabase (s)")
+    parser.add_argument("--supabase-error-rate", type=float, default=0.0, help="Fração das consultas ao Supabase com erro")
+    parser.add_argument("--sheets-latency", type=float, default=0.2, help="Latência média por chamada ao Sheets (s)")
+    parser.add_argument("--jitter", type=float, default=0.3, help="Variação relativa das latências simuladas")
+    parser.add_argument("--log-rows", type=int, default=10000, help="Linhas na tabela de logs simulada")
+    parser.add_argument("--image-width", type=int, default=3000)
+    parser.add_argument("--image-height", type=int, default=2000)
+    parser.add_argument("--repeat-images", action="store_true", help="Reenviar a mesma imagem (mede o cache)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Arquivo JSON para salvar o resultado")
+    parser.add_argument("--compare", help="Resultado anterior (JSON) para detectar regressões")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Piora relativa tolerada na comparação")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    work_dir = tempfile.mkdtemp(prefix="smartshelf-benchmark-")
+    configure_environment(args, work_dir)
+
+    results = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regressão: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
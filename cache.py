@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Iterable, Optional, Tuple
+
+from prompts import PROMPTS
+
+logger = logging.getLogger(__name__)
+
+
+def prompt_version(prompt_name: str = 'default') -> str:
+    """Versão do template de prompt (hash do texto), para invalidar o cache quando o prompt muda"""
+    return hashlib.sha256(PROMPTS[prompt_name].encode('utf-8')).hexdigest()[:12]
+
+
+def _normalized_names(produtos_nomes: Iterable[str]) -> bytes:
+    nomes = sorted({nome.strip().casefold() for nome in produtos_nomes})
+    return json.dumps(nomes, ensure_ascii=False).encode('utf-8')
+
+
+def make_cache_key(image_data: bytes, produtos_nomes: Iterable[str], prompt_name: str = 'default',
+                   variant: str = '') -> str:
+    """
+    Gera a chave do cache a partir do conteúdo da análise.
+
+    A chave combina o hash dos bytes da imagem, os nomes dos produtos normalizados
+    (sem espaços nas pontas, minúsculos e ordenados) e a versão do prompt. `variant`
+    separa modos de análise da mesma imagem (ex.: 'tiles' para a divisão em trechos).
+    """
+    digest = hashlib.sha256()
+    digest.update(hashlib.sha256(image_data).digest())
+    digest.update(_normalized_names(produtos_nomes))
+    digest.update(prompt_version(prompt_name).encode('utf-8'))
+    if variant:
+        digest.update(variant.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def make_scope_key(produtos_nomes: Iterable[str], prompt_name: str = 'default', variant: str = '') -> str:
+    """Escopo de busca de quase duplicatas: mesmos produtos (normalizados), versão do prompt e modo"""
+    digest = hashlib.sha256(_normalized_names(produtos_nomes))
+    digest.update(prompt_version(prompt_name).encode('utf-8'))
+    if variant:
+        digest.update(variant.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class ResultCache:
+    """
+    Cache de resultados de análise em dois níveis.
+
+    - Memória: LRU limitado por número de entradas e com TTL.
+    - Disco (opcional): um arquivo JSON por chave em `disk_dir`, com o mesmo TTL.
+    - Estado compartilhado (opcional): `shared`, visto pelos outros workers, com o mesmo TTL.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 3600, disk_dir: Optional[str] = None,
+                 shared=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.shared = shared
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        """Retorna o resultado armazenado para a chave ou None"""
+        now = time.time()
+        value = self._memory_get(key, now)
+        return value if value is not None else self._lower_get(key, now)
+
+    async def get_async(self, key: str) -> Optional[dict]:
+        """Como `get`, com a leitura do disco e do estado compartilhado fora do event loop"""
+        now = time.time()
+        value = self._memory_get(key, now)
+        if value is not None:
+            return value
+        if not self._has_lower_tiers():
+            return self._lower_get(key, now)
+        return await asyncio.to_thread(self._lower_get, key, now)
+
+    def set(self, key: str, value: dict):
+        """Armazena o resultado em todos os níveis"""
+        now = time.time()
+        with self._lock:
+            self._memory_set(key, value, now)
+        self._lower_set(key, value, now)
+
+    async def set_async(self, key: str, value: dict):
+        """Como `set`, com a gravação no disco e no estado compartilhado fora do event loop"""
+        now = time.time()
+        with self._lock:
+            self._memory_set(key, value, now)
+        if self._has_lower_tiers():
+            await asyncio.to_thread(self._lower_set, key, value, now)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "disk": str(self.disk_dir) if self.disk_dir else None,
+                "shared": self.shared is not None,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+    def _has_lower_tiers(self) -> bool:
+        return self.disk_dir is not None or self.shared is not None
+
+    def _memory_get(self, key: str, now: float) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if now - stored_at <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+            return None
+
+    def _lower_get(self, key: str, now: float) -> Optional[dict]:
+        """Busca no estado compartilhado e no disco (bloqueante); o resultado volta para a memória"""
+        value = self.shared.get("result_cache", key) if self.shared else None
+        if value is None:
+            value = self._disk_get(key, now)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._memory_set(key, value, now)
+        return value
+
+    def _lower_set(self, key: str, value: dict, now: float):
+        if self.shared:
+            self.shared.set("result_cache", key, value, ttl=self.ttl_seconds)
+        self._disk_set(key, value, now)
+
+    def _memory_set(self, key: str, value: dict, now: float):
+        self._entries[key] = (now, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / f"{key}.json"
+
+    def _disk_get(self, key: str, now: float) -> Optional[dict]:
+        if not self.disk_dir:
+            return None
+
+        path = self._disk_path(key)
+        try:
+            entry = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+
+        if now - entry.get("stored_at", 0) > self.ttl_seconds:
+            path.unlink(missing_ok=True)
+            return None
+        return entry.get("value")
+
+    def _disk_set(self, key: str, value: dict, now: float):
+        if not self.disk_dir:
+            return
+
+        # Escrita atômica: grava em arquivo temporário e renomeia
+        path = self._disk_path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            tmp_path.write_text(json.dumps({"stored_at": now, "value": value}, ensure_ascii=False))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Erro ao gravar cache em disco: %s", e)
+
+
+class NearDuplicateIndex:
+    """
+    Índice em memória de hashes perceptuais de imagens analisadas recentemente.
+
+    As entradas ficam separadas por escopo (conjunto de produtos e prompt) e expiram após
+    `window_seconds`; a busca percorre apenas o escopo pedido, que é pequeno (fotos da mesma
+    gôndola em poucos minutos). Cada escopo guarda no máximo `max_per_scope` entradas e os
+    escopos menos usados são descartados além de `max_scopes`.
+
+    Com `shared` (estado compartilhado entre workers), as entradas ficam só no estado
+    compartilhado, para que uma foto enviada a um worker encontre a análise feita por outro.
+    """
+
+    def __init__(self, max_distance: int = 5, window_seconds: float = 300,
+                 max_scopes: int = 1024, max_per_scope: int = 64, shared=None):
+        self.max_distance = max_distance
+        self.window_seconds = window_seconds
+        self.max_scopes = max_scopes
+        self.max_per_scope = max_per_scope
+        self.shared = shared
+
+        # escopo -> deque de (instante, hash, valor), do mais antigo para o mais novo
+        self._scopes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def find(self, scope: str, image_hash: int) -> Optional[Tuple[int, float, dict]]:
+        """Retorna (distância, idade em segundos, valor) da entrada mais parecida no escopo, ou None"""
+        now = time.time()
+        best = None
+        with self._lock:
+            if self.shared:
+                # No estado compartilhado os itens expiram após `window_seconds`
+                entries = [tuple(entry) for _, entry in self.shared.items("near_dup", scope)]
+            else:
+                entries = self._scopes.get(scope)
+                while entries and now - entries[0][0] > self.window_seconds:
+                    entries.popleft()
+            if not entries:
+                return None
+
+            for stored_at, stored_hash, value in reversed(entries):
+                distance = hamming_distance(image_hash, stored_hash)
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, now - stored_at, value)
+                    if distance == 0:
+                        break
+        return best
+
+    def add(self, scope: str, image_hash: int, value: dict):
+        if self.shared:
+            self.shared.push("near_dup", scope, [time.time(), image_hash, value],
+                             max_items=self.max_per_scope, ttl=self.window_seconds)
+            return
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if entries is None:
+                entries = self._scopes[scope] = deque(maxlen=self.max_per_scope)
+            self._scopes.move_to_end(scope)
+            entries.append((time.time(), image_hash, value))
+            while len(self._scopes) > self.max_scopes:
+                self._scopes.popitem(last=False)
+
+    def stats(self) -> dict:
+        if self.shared:
+            return {"scopes": None, "entries": self.shared.count("near_dup")}
+        with self._lock:
+            return {
+                "scopes": len(self._scopes),
+                "entries": sum(len(entries) for entries in self._scopes.values())
+            }
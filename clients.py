@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Iterable
+
+# Clientes externos criados sob demanda (na primeira utilização) e reaproveitados.
+# As bibliotecas pesadas (Gemini, Supabase, googleapiclient) só são importadas aqui dentro,
+# para não pesar no tempo de inicialização do processo.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_NAME = 'gemini-1.5-pro-latest'
+
+_clients = {}
+_locks = defaultdict(threading.Lock)
+# Clientes que não podem ser usados por várias threads ao mesmo tempo
+_thread_local = threading.local()
+
+# Tempo (s) gasto para criar cada componente, incluindo os imports
+startup_report = {}
+
+
+def _get_or_create(name: str, factory):
+    client = _clients.get(name)
+    if client is not None:
+        return client
+
+    with _locks[name]:
+        if name not in _clients:
+            start_time = time.perf_counter()
+            _clients[name] = factory()
+            startup_report[name] = time.perf_counter() - start_time
+            logger.info("Cliente '%s' inicializado em %.3fs", name, startup_report[name])
+        return _clients[name]
+
+
+def set_client(name: str, client):
+    """Substitui um cliente (ex.: por um dublê local em benchmarks)"""
+    _clients[name] = client
+
+
+def get_model(model_name: str = DEFAULT_MODEL_NAME):
+    """Modelo do Gemini"""
+    def create():
+        import google.generativeai as genai
+        genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
+        return genai.GenerativeModel(model_name)
+
+    return _get_or_create(f"gemini:{model_name}", create)
+
+
+def get_supabase():
+    """Cliente do Supabase"""
+    def create():
+        from supabase import create_client
+        return create_client(
+            os.environ.get("SUPABASE_URL", "sua_url"),
+            os.environ.get("SUPABASE_KEY", "sua_key")
+        )
+
+    return _get_or_create("supabase", create)
+
+
+def _get_sheets_credentials():
+    def create():
+        from google.oauth2 import service_account
+
+        creds = json.loads(os.environ.get('GOOGLE_SHEETS_CREDS', '{}'))
+        if not creds:
+            raise RuntimeError("Credenciais do Google Sheets não configuradas (GOOGLE_SHEETS_CREDS)")
+        return service_account.Credentials.from_service_account_info(
+            creds, scopes=['https://www.googleapis.com/auth/spreadsheets']
+        )
+
+    return _get_or_create("sheets_credentials", create)
+
+
+def get_sheets_service():
+    """
+    Serviço do Google Sheets; falha apenas aqui (e não na inicialização) se não houver credenciais.
+
+    O httplib2.Http usado pelo googleapiclient não é thread-safe, então cada thread recebe o
+    próprio serviço (as credenciais são compartilhadas). Use o serviço só na thread que o obteve.
+    """
+    # Serviço substituído com set_client (ex.: dublê em benchmarks), usado por todas as threads
+    override = _clients.get("sheets")
+    if override is not None:
+        return override
+
+    service = getattr(_thread_local, "sheets_service", None)
+    if service is None:
+        from googleapiclient.discovery import build
+
+        # Sem cache de discovery em arquivo: evita avisos e I/O extra na criação
+        service = build('sheets', 'v4', credentials=_get_sheets_credentials(), cache_discovery=False)
+        _thread_local.sheets_service = service
+    return service
+
+
+def warm_up(model_names: Iterable[str] = (DEFAULT_MODEL_NAME,)) -> dict:
+    """
+    Cria os clientes (um por modelo em `model_names`) e abre a conexão com o Supabase antecipadamente.
+    Bloqueante: rode em uma thread. Retorna o status de cada componente.
+    """
+    results = {}
+    components = [(f"gemini:{model_name}", lambda model_name=model_name: get_model(model_name))
+                  for model_name in model_names]
+    components += [
+        ("supabase", lambda: get_supabase().table('logs').select('id').limit(1).execute()),
+        ("sheets", get_sheets_service),
+    ]
+    for name, warm in components:
+        start_time = time.perf_counter()
+        try:
+            warm()
+            results[name] = {"status": "ok", "time": time.perf_counter() - start_time}
+        except Exception as e:
+            results[name] = {"status": "error", "error": str(e), "time": time.perf_counter() - start_time}
+    return results
@@ -0,0 +1,34 @@
+import multiprocessing
+import os
+
+# Implantação com vários processos: gunicorn gerenciando workers do uvicorn.
+#
+#   gunicorn api:app -c gunicorn.conf.py
+#
+# Cada worker tem o próprio event loop, clientes e fila de jobs. O cache de resultados, as
+# quase duplicatas, as estatísticas e o limite de taxa do Gemini ficam no estado compartilhado
+# (SQLite local), ativado automaticamente quando há mais de um worker.
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Uma análise pode levar até 120s (BATCH_ITEM_TIMEOUT e timeout do Gemini)
+timeout = int(os.environ.get("WORKER_TIMEOUT", "180"))
+graceful_timeout = int(os.environ.get("WORKER_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+# Reinicia os workers periodicamente (com variação, para não reiniciarem juntos) e limita a
+# fragmentação de memória causada pelas imagens
+max_requests = int(os.environ.get("WORKER_MAX_REQUESTS", "2000"))
+max_requests_jitter = max_requests // 10
+
+# Sem preload: os clientes (Gemini, Supabase) e as conexões SQLite são criados em cada worker
+preload_app = False
+
+accesslog = None
+errorlog = "-"
+
+if workers > 1:
+    # Os workers herdam o ambiente do processo principal
+    os.environ.setdefault("SHARED_STATE_BACKEND", "sqlite")
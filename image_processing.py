@@ -0,0 +1,308 @@
+import asyncio
+import io
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Union
+
+from PIL import Image, ImageOps, ImageStat
+
+# Configuração do pré-processamento
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", "1600"))
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "85"))
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "JPEG").upper()
+
+# Divisão de fotos panorâmicas (gôndolas longas) em trechos analisados separadamente
+TILE_OVERLAP = float(os.environ.get("TILE_OVERLAP", "0.15"))
+TILE_MAX = int(os.environ.get("TILE_MAX", "6"))
+# Divisão automática: a partir desta proporção (lado maior / menor) ou deste maior lado em pixels
+TILE_AUTO_ASPECT = float(os.environ.get("TILE_AUTO_ASPECT", "2.5"))
+TILE_AUTO_MIN_EDGE = int(os.environ.get("TILE_AUTO_MIN_EDGE", str(IMAGE_MAX_EDGE * 2)))
+# Trechos descartados antes da chamada ao modelo: quase sem detalhe (desvio padrão do cinza)
+# ou quase iguais a um trecho já mantido (distância do dHash)
+TILE_MIN_STDDEV = float(os.environ.get("TILE_MIN_STDDEV", "8"))
+TILE_DUP_DISTANCE = int(os.environ.get("TILE_DUP_DISTANCE", "4"))
+
+MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+}
+
+# Imagem recebida: bytes ou um memoryview sobre o upload (sem cópia)
+ImageData = Union[bytes, bytearray, memoryview]
+
+
+class _BufferReader(io.RawIOBase):
+    """Leitura sequencial de um buffer sem copiá-lo inteiro (io.BytesIO copiaria um memoryview)"""
+
+    def __init__(self, data: ImageData):
+        self._view = memoryview(data).cast("B")
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, target) -> int:
+        size = min(len(target), len(self._view) - self._position)
+        target[:size] = self._view[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+
+def open_image(image_data: ImageData) -> Image.Image:
+    """Abre a imagem sem copiar o buffer; lança ValueError se o formato não for reconhecido"""
+    stream = io.BytesIO(image_data) if isinstance(image_data, bytes) else _BufferReader(image_data)
+    try:
+        return Image.open(stream)
+    except Exception:
+        raise ValueError("Arquivo de imagem inválido ou formato não suportado")
+
+
+# Pool dedicado para não bloquear o event loop com decodificação/codificação
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1)))),
+    thread_name_prefix="image"
+)
+
+
+def _flatten(img: Image.Image) -> Image.Image:
+    """Remove transparência sobre fundo branco (JPEG e o envio ao modelo não usam canal alfa)"""
+    if img.mode in ("RGB", "L"):
+        return img
+    background = Image.new("RGB", img.size, (255, 255, 255))
+    rgba = img.convert("RGBA")
+    background.paste(rgba, mask=rgba.split()[-1])
+    return background
+
+
+def _encode(img: Image.Image, target_format: str, quality: int) -> bytes:
+    output = io.BytesIO()
+    if target_format == "WEBP":
+        img.save(output, "WEBP", quality=quality, method=4)
+    else:
+        img.save(output, "JPEG", quality=quality)
+    return output.getvalue()
+
+
+def preprocess_image(image_data: ImageData, max_edge: int = IMAGE_MAX_EDGE,
+                     quality: int = IMAGE_QUALITY, target_format: str = IMAGE_FORMAT) -> Tuple[bytes, str, dict]:
+    """
+    Prepara a imagem para envio ao Gemini.
+
+    Detecta o formato real, aplica a orientação EXIF, reduz o maior lado para `max_edge`
+    e recodifica em `target_format` (JPEG ou WEBP). Quando nada precisa mudar, os bytes
+    originais são reaproveitados.
+
+    Retorna (bytes, mime_type, estatísticas).
+    """
+    start_time = time.perf_counter()
+
+    img = open_image(image_data)
+    source_format = img.format or "desconhecido"
+    original_size = img.size
+
+    # Para JPEG, decodifica direto em escala reduzida (bem mais rápido em fotos grandes)
+    scale = min(1.0, max_edge / max(original_size))
+    if scale < 1.0 and source_format == "JPEG":
+        img.draft("RGB", (int(original_size[0] * scale), int(original_size[1] * scale)))
+
+    rotated = img.getexif().get(0x0112, 1) != 1
+    if rotated:
+        img = ImageOps.exif_transpose(img)
+
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    resized = sorted(img.size) != sorted(original_size)
+
+    passthrough = not resized and not rotated and source_format == target_format
+    if not passthrough:
+        img = _flatten(img)
+        data = _encode(img, target_format, quality)
+
+        # Sem redução nem rotação, só vale recodificar se o arquivo ficar menor
+        passthrough = not resized and not rotated and source_format in MIME_TYPES and len(data) >= len(image_data)
+
+    if passthrough:
+        # O SDK do Gemini precisa de bytes: única cópia do upload, apenas quando ele é enviado como está
+        data = image_data if isinstance(image_data, bytes) else bytes(image_data)
+
+    stats = {
+        "source_format": source_format,
+        "output_format": source_format if passthrough else target_format,
+        "original_size": list(original_size),
+        "output_size": list(img.size),
+        "bytes_in": len(image_data),
+        "bytes_out": len(data),
+        # Memória aproximada da imagem decodificada (após a decodificação reduzida do JPEG)
+        "decoded_bytes": img.size[0] * img.size[1] * len(img.getbands()),
+        "preprocessing_time": time.perf_counter() - start_time
+    }
+    return data, MIME_TYPES.get(stats["output_format"], "image/jpeg"), stats
+
+
+def image_dhash(image_data: ImageData, hash_size: int = 8) -> int:
+    """
+    Hash perceptual (dHash) da imagem: compara o brilho de pixels vizinhos em uma miniatura
+    em tons de cinza. Fotos quase iguais (recompressão, pequenos deslocamentos) geram hashes
+    com poucos bits diferentes. Retorna um inteiro de `hash_size * hash_size` bits.
+    """
+    img = open_image(image_data)
+
+    # Para JPEG, decodifica direto em tons de cinza e em escala bem reduzida
+    img.draft("L", (hash_size * 16, hash_size * 16))
+    if img.getexif().get(0x0112, 1) != 1:
+        img = ImageOps.exif_transpose(img)
+
+    return _dhash_bits(img, hash_size)
+
+
+def _dhash_bits(img: Image.Image, hash_size: int = 8) -> int:
+    """dHash de uma imagem já decodificada (ver `image_dhash`)"""
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR, reducing_gap=2.0)
+    pixels = list(small.getdata())
+
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return bits
+
+
+def _tile_count(length: int, tile: float, overlap: float) -> int:
+    """Quantos trechos de `tile` pixels, sobrepostos em pelo menos `overlap`, cobrem `length`"""
+    if length <= tile:
+        return 1
+    return math.ceil((length - tile) / (tile * (1 - overlap))) + 1
+
+
+def _tile_starts(length: int, tile: int, count: int) -> List[int]:
+    """Início de cada trecho, distribuídos por igual (a sobreposição real é no mínimo a pedida)"""
+    if count == 1:
+        return [0]
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def split_tiles(image_data: ImageData, force: bool = False, tile_edge: int = IMAGE_MAX_EDGE,
+                overlap: float = TILE_OVERLAP, max_tiles: int = TILE_MAX,
+                quality: int = IMAGE_QUALITY, target_format: str = IMAGE_FORMAT) -> Tuple[List[dict], dict]:
+    """
+    Divide uma foto larga ou de alta resolução em trechos sobrepostos para análise separada.
+
+    Sem `force`, só divide quando a foto passa de TILE_AUTO_ASPECT ou de TILE_AUTO_MIN_EDGE.
+    Os trechos têm `tile_edge` pixels de lado (maiores, e depois reduzidos, se a grade passar
+    de `max_tiles`). Trechos quase sem detalhe ou quase iguais a um já mantido são descartados
+    antes de chegar ao modelo; os restantes vêm ordenados do mais detalhado para o menos.
+
+    Retorna (trechos, estatísticas); cada trecho tem `index` (posição na grade), `data`,
+    `box` (na imagem original já orientada) e `detail`. A lista é vazia quando não há divisão.
+    """
+    start_time = time.perf_counter()
+
+    img = open_image(image_data)
+    source_format = img.format or "desconhecido"
+    raw_size = img.size
+    orientation = img.getexif().get(0x0112, 1)
+    # Orientações EXIF 5 a 8 trocam largura e altura
+    width, height = raw_size[::-1] if orientation in (5, 6, 7, 8) else raw_size
+
+    if not force and max(width, height) / min(width, height) < TILE_AUTO_ASPECT and max(width, height) < TILE_AUTO_MIN_EDGE:
+        return [], {}
+
+    tile = float(tile_edge)
+    while _tile_count(width, tile, overlap) * _tile_count(height, tile, overlap) > max_tiles:
+        tile *= 1.25
+    cols, rows = _tile_count(width, tile, overlap), _tile_count(height, tile, overlap)
+    if cols * rows == 1:
+        return [], {}
+
+    # Trechos maiores que `tile_edge` seriam reduzidos de qualquer forma: decodifica o JPEG já reduzido
+    scale = min(1.0, tile_edge / tile)
+    if scale < 1.0 and source_format == "JPEG":
+        img.draft("RGB", (int(raw_size[0] * scale), int(raw_size[1] * scale)))
+    if orientation != 1:
+        img = ImageOps.exif_transpose(img)
+    img = _flatten(img)
+    img.load()
+
+    # Coordenadas na imagem decodificada (pode estar reduzida pelo draft)
+    factor = img.size[0] / width
+    tile_px = min(round(tile * factor), img.size[0]), min(round(tile * factor), img.size[1])
+    boxes = [(left, top, left + tile_px[0], top + tile_px[1])
+             for top in _tile_starts(img.size[1], tile_px[1], rows)
+             for left in _tile_starts(img.size[0], tile_px[0], cols)]
+
+    candidates = []
+    for index, box in enumerate(boxes):
+        crop = img.crop(box)
+        gray = crop.convert("L")
+        gray.thumbnail((64, 64))
+        candidates.append((index, box, crop, ImageStat.Stat(gray).stddev[0], _dhash_bits(crop)))
+
+    kept, hashes = [], []
+    for candidate in sorted(candidates, key=lambda c: c[3], reverse=True):
+        index, box, crop, detail, tile_hash = candidate
+        if kept and detail < TILE_MIN_STDDEV:
+            continue
+        if any(bin(tile_hash ^ other).count("1") <= TILE_DUP_DISTANCE for other in hashes):
+            continue
+        hashes.append(tile_hash)
+        if max(crop.size) > tile_edge:
+            crop.thumbnail((tile_edge, tile_edge), Image.LANCZOS)
+        kept.append({
+            "index": index,
+            "data": _encode(crop, target_format, quality),
+            "box": [round(value / factor) for value in box],
+            "size": list(crop.size),
+            "detail": round(detail, 1)
+        })
+
+    stats = {
+        "grid": [cols, rows],
+        "total": len(boxes),
+        "skipped": len(boxes) - len(kept),
+        "source_format": source_format,
+        "output_format": target_format,
+        "original_size": [width, height],
+        "output_size": max((tile["size"] for tile in kept), key=lambda size: size[0] * size[1]),
+        "bytes_in": len(image_data),
+        "bytes_out": sum(len(tile["data"]) for tile in kept),
+        "decoded_bytes": img.size[0] * img.size[1] * len(img.getbands()),
+        "preprocessing_time": time.perf_counter() - start_time
+    }
+    return kept, stats
+
+
+async def split_tiles_async(image_data: ImageData, **kwargs) -> Tuple[List[dict], dict]:
+    """Executa `split_tiles` no pool de threads de imagem"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, lambda: split_tiles(image_data, **kwargs))
+
+
+async def dhash_async(image_data: ImageData, **kwargs) -> int:
+    """Executa `image_dhash` no pool de threads de imagem"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, lambda: image_dhash(image_data, **kwargs))
+
+
+async def preprocess_image_async(image_data: ImageData, **kwargs) -> Tuple[bytes, str, dict]:
+    """Executa `preprocess_image` no pool de threads de imagem"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, lambda: preprocess_image(image_data, **kwargs))
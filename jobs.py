@@ -0,0 +1,352 @@
+import asyncio
+import ipaddress
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+from urllib.parse import urlsplit
+
+import httpx
+
+from log_config import request_id_var
+
+logger = logging.getLogger(__name__)
+
+# Destinos permitidos para os webhooks. Sem lista, qualquer host público é aceito; endereços
+# privados, de loopback e link-local (ex.: metadados da nuvem em 169.254.169.254) são sempre
+# recusados, salvo com WEBHOOK_ALLOW_PRIVATE=1 (desenvolvimento local)
+WEBHOOK_ALLOWED_HOSTS = {host.strip().lower() for host in os.environ.get("WEBHOOK_ALLOWED_HOSTS", "").split(",")
+                         if host.strip()}
+WEBHOOK_ALLOW_PRIVATE = os.environ.get("WEBHOOK_ALLOW_PRIVATE", "0") == "1"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    image BLOB,
+    produtos TEXT NOT NULL,
+    webhook_url TEXT,
+    options TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    result TEXT,
+    error TEXT,
+    webhook_status TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at);
+"""
+
+
+def validate_webhook_url(url: str):
+    """
+    Verifica se o webhook pode ser chamado: URL http(s), host na WEBHOOK_ALLOWED_HOSTS (se
+    definida) e todos os endereços do host públicos. Lança ValueError.
+    Resolve o nome no DNS (bloqueante): use a partir de uma thread.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("O campo 'webhook_url' deve ser uma URL http(s)")
+    host = parts.hostname.lower()
+    if WEBHOOK_ALLOWED_HOSTS and host not in WEBHOOK_ALLOWED_HOSTS:
+        raise ValueError(f"Host do webhook não permitido: {host}")
+    if WEBHOOK_ALLOW_PRIVATE:
+        return
+
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parts.port or None, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError):
+        raise ValueError(f"Host do webhook não encontrado: {host}")
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%", 1)[0])
+        if not ip.is_global:
+            raise ValueError(f"O webhook não pode apontar para um endereço interno: {host} ({ip})")
+
+
+class JobQueue:
+    """
+    Fila persistente de análises em SQLite.
+
+    Estados: queued -> running -> done | error. A imagem fica gravada no banco até a
+    análise terminar, então jobs enfileirados sobrevivem a reinícios do processo.
+    Todos os métodos são bloqueantes; use `asyncio.to_thread` a partir do event loop.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = 300):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            # Bancos criados antes da coluna `options`
+            columns = [row["name"] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if "options" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN options TEXT")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def submit(self, image_data: Union[bytes, memoryview], produtos_list: list, webhook_url: Optional[str] = None,
+               options: Optional[dict] = None) -> str:
+        """Enfileira uma análise e retorna o ID do job; `options` é repassado ao handler"""
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                """INSERT INTO jobs (id, status, image, produtos, webhook_url, options, created_at)
+                   VALUES (?, 'queued', ?, ?, ?, ?, ?)""",
+                (job_id, image_data, json.dumps(produtos_list, ensure_ascii=False), webhook_url,
+                 json.dumps(options or {}), time.time())
+            )
+        return job_id
+
+    def claim(self) -> Optional[dict]:
+        """
+        Reserva o job mais antigo da fila (ou um job 'running' com lease expirada,
+        de um worker que morreu) e retorna seus dados, ou None se a fila estiver vazia.
+        """
+        with self._connect() as conn:
+            # BEGIN IMMEDIATE garante que dois workers (ou processos) não reservem o mesmo job
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            try:
+                row = conn.execute(
+                    """SELECT id, image, produtos, webhook_url, options, created_at FROM jobs
+                       WHERE status = 'queued' OR (status = 'running' AND started_at < ?)
+                       ORDER BY created_at LIMIT 1""",
+                    (now - self.lease_seconds,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?", (now, row["id"]))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return None
+
+        return {
+            "id": row["id"],
+            "image": row["image"],
+            "produtos": json.loads(row["produtos"]),
+            "webhook_url": row["webhook_url"],
+            "options": json.loads(row["options"]) if row["options"] else {},
+            "created_at": row["created_at"],
+            "started_at": now
+        }
+
+    def finish(self, job_id: str, result: Optional[dict] = None, error: Optional[str] = None):
+        """Marca o job como concluído (com resultado) ou com erro, e descarta a imagem"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = ?, image = NULL WHERE id = ?",
+                ("error" if error else "done", time.time(),
+                 json.dumps(result, ensure_ascii=False) if result is not None else None, error, job_id)
+            )
+
+    def release(self, job_ids: List[str]):
+        """Devolve à fila jobs reservados que não chegaram ao fim (ex.: workers parados no encerramento)"""
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE jobs SET status = 'queued', started_at = NULL WHERE id = ? AND status = 'running'",
+                [(job_id,) for job_id in job_ids]
+            )
+
+    def set_webhook_status(self, job_id: str, webhook_status: str):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET webhook_status = ? WHERE id = ?", (webhook_status, job_id))
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """Retorna o estado público do job, ou None se não existir"""
+        with self._connect() as conn:
+            row = conn.execute(
+                """SELECT id, status, created_at, started_at, finished_at, result, error, webhook_status
+                   FROM jobs WHERE id = ?""",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["wait_time"] = (job["started_at"] - job["created_at"]) if job["started_at"] else None
+        job["run_time"] = (job["finished_at"] - job["started_at"]) if job["finished_at"] and job["started_at"] else None
+        return job
+
+    def stats(self, window_seconds: float = 3600) -> dict:
+        """Profundidade da fila e tempos médios de espera/execução dos jobs recentes"""
+        now = time.time()
+        with self._connect() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            oldest = conn.execute("SELECT MIN(created_at) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            recent = conn.execute(
+                """SELECT AVG(started_at - created_at), MAX(started_at - created_at),
+                          AVG(finished_at - started_at), MAX(finished_at - started_at), COUNT(*)
+                   FROM jobs WHERE finished_at >= ?""",
+                (now - window_seconds,)
+            ).fetchone()
+
+        return {
+            "queue_depth": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "error": counts.get("error", 0),
+            "oldest_queued_age": (now - oldest) if oldest else 0,
+            "recent_window_seconds": window_seconds,
+            "recent_finished": recent[4],
+            "avg_wait_time": recent[0] or 0,
+            "max_wait_time": recent[1] or 0,
+            "avg_run_time": recent[2] or 0,
+            "max_run_time": recent[3] or 0
+        }
+
+
+class JobWorkerPool:
+    """
+    Workers assíncronos que consomem a `JobQueue`.
+
+    `handler(image_data, produtos_list, options)` executa a análise e retorna o resultado serializável.
+    Ao terminar, o resultado é entregue ao `webhook_url` do job, se houver.
+    """
+
+    def __init__(self, queue: JobQueue, handler: Callable[[bytes, list, dict], Awaitable[dict]],
+                 workers: int = 2, poll_interval: float = 2.0, webhook_timeout: float = 10,
+                 webhook_retries: int = 3):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.webhook_timeout = webhook_timeout
+        self.webhook_retries = webhook_retries
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+        # Jobs reservados em execução, por id
+        self._running: Dict[str, dict] = {}
+
+    def start(self):
+        self._stopping = False
+        # Criado aqui para ficar associado ao event loop do servidor
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info("%d workers de jobs iniciados", self.workers)
+
+    async def stop(self):
+        self._stopping = True
+        self.notify()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        # Jobs interrompidos voltam para a fila, sem esperar a lease expirar
+        if self._running:
+            job_ids = list(self._running)
+            self._running.clear()
+            try:
+                await asyncio.to_thread(self.queue.release, job_ids)
+                logger.info("%d jobs interrompidos devolvidos à fila", len(job_ids))
+            except Exception as e:
+                logger.error("Erro ao devolver jobs interrompidos à fila: %s", e)
+
+    def notify(self):
+        """Acorda os workers após um novo job ser enfileirado"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _worker(self, worker_id: int):
+        while not self._stopping:
+            try:
+                await self._work_once()
+            except Exception:
+                # Um erro (ex.: banco travado ao gravar o resultado) não pode encerrar o worker
+                logger.exception("Erro no worker de jobs %d", worker_id)
+                await asyncio.sleep(self.poll_interval)
+
+    async def _work_once(self):
+        self._wakeup.clear()
+        try:
+            job = await asyncio.to_thread(self.queue.claim)
+        except Exception as e:
+            logger.error("Erro ao buscar job na fila: %s", e)
+            job = None
+
+        if job is None:
+            # Fila vazia: espera um novo job ou o próximo ciclo de polling
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            return
+
+        self._running[job["id"]] = job
+        try:
+            await self._run_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # O job fica como 'running' e volta para a fila quando a lease expirar
+            self._running.pop(job["id"], None)
+            raise
+
+    async def _run_job(self, job: dict):
+        job_id = job["id"]
+        # Correlaciona os logs do job com a requisição que o enfileirou
+        token = request_id_var.set(job["options"].get("request_id") or job_id)
+        try:
+            logger.info("Job %s iniciado após %.2fs na fila", job_id, job['started_at'] - job['created_at'],
+                        extra={"job_id": job_id})
+
+            result, error = None, None
+            try:
+                result = await self.handler(job["image"], job["produtos"], job["options"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = getattr(e, "detail", None) or str(e) or e.__class__.__name__
+                logger.error("Erro no job %s: %s", job_id, error, extra={"job_id": job_id})
+
+            await asyncio.to_thread(self.queue.finish, job_id, result, error)
+            self._running.pop(job_id, None)
+
+            if job["webhook_url"]:
+                await self._deliver_webhook(job_id, job["webhook_url"], result, error)
+        finally:
+            request_id_var.reset(token)
+
+    async def _deliver_webhook(self, job_id: str, url: str, result: Optional[dict], error: Optional[str]):
+        payload = {"job_id": job_id, "status": "error" if error else "done", "result": result, "error": error}
+
+        # Verificado de novo na entrega: o DNS do host pode ter mudado desde o envio do job
+        try:
+            await asyncio.to_thread(validate_webhook_url, url)
+        except ValueError as e:
+            logger.warning("Webhook do job %s recusado: %s", job_id, e)
+            await asyncio.to_thread(self.queue.set_webhook_status, job_id, "rejected")
+            return
+
+        delivered = False
+        async with httpx.AsyncClient(timeout=self.webhook_timeout, follow_redirects=False) as client:
+            for attempt in range(1, self.webhook_retries + 1):
+                try:
+                    response = await client.post(url, json=payload)
+                    response.raise_for_status()
+                    delivered = True
+                    break
+                except Exception as e:
+                    logger.warning("Erro ao entregar webhook do job %s (tentativa %d): %s", job_id, attempt, e)
+                    if attempt < self.webhook_retries:
+                        await asyncio.sleep(2 ** attempt)
+
+        await asyncio.to_thread(self.queue.set_webhook_status, job_id, "delivered" if delivered else "failed")
@@ -0,0 +1,372 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from log_store import iter_log_pages
+from stats import EXECUTION_TIME_BUCKETS, _parse_produtos, _parse_timestamp
+
+# Arquivo histórico dos logs em Parquet, fora do Supabase.
+#
+# Logs mais antigos que a retenção saem da tabela `logs` para arquivos Parquet comprimidos,
+# particionados por dia (`day=AAAA-MM-DD/part-<id>.parquet`). `status`, `model`,
+# `escalation_reason` e os nomes dos produtos são gravados com codificação de dicionário.
+# As consultas históricas (taxa de sucesso por produto, custo por dia, percentis de tempo)
+# leem só as colunas e os dias necessários, com operações vetorizadas do pyarrow:
+#
+#   python log_archive.py archive --retention-days 30
+#   python log_archive.py stats --since 2024-01-01 --produto "Coca Cola"
+#
+# O pyarrow é importado apenas quando o arquivo é usado.
+
+logger = logging.getLogger(__name__)
+
+LOG_ARCHIVE_DIR = os.environ.get("LOG_ARCHIVE_DIR", "logs_archive")
+LOG_RETENTION_DAYS = float(os.environ.get("LOG_RETENTION_DAYS", "30"))
+# Linhas lidas do Supabase antes de gravar os arquivos e apagar as linhas arquivadas
+ARCHIVE_CHUNK_ROWS = int(os.environ.get("ARCHIVE_CHUNK_ROWS", "50000"))
+
+LATENCY_QUANTILES = [0.5, 0.9, 0.95, 0.99]
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Arquivo de logs indisponível: instale o pyarrow (pip install pyarrow)")
+    return pyarrow
+
+
+def archive_schema():
+    pa = _pyarrow()
+    category = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ("id", pa.int64()),
+        ("created_at", pa.timestamp("us", tz="UTC")),
+        ("status", category),
+        ("produtos", pa.list_(category)),
+        ("execution_time", pa.float64()),
+        ("cost", pa.float64()),
+        ("cache_hit", pa.bool_()),
+        ("model", category),
+        ("escalation_reason", category),
+        ("validation", pa.struct([(campo, pa.bool_()) for campo in
+                                  ("nome_marca", "preco", "posicionamento", "organizacao")])),
+        ("error", pa.string()),
+        ("analysis_details", pa.string()),
+    ])
+
+
+def _day(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d")
+
+
+def _archive_row(row: dict) -> dict:
+    """Linha da tabela `logs` no formato do arquivo"""
+    validation = row.get("validation")
+    if isinstance(validation, str):
+        try:
+            validation = json.loads(validation)
+        except ValueError:
+            validation = None
+    return {
+        "id": row["id"],
+        "created_at": datetime.fromtimestamp(_parse_timestamp(row.get("created_at")), timezone.utc),
+        "status": row.get("status"),
+        "produtos": _parse_produtos(row.get("produtos")),
+        "execution_time": row.get("execution_time"),
+        "cost": row.get("cost"),
+        "cache_hit": row.get("cache_hit"),
+        "model": row.get("model"),
+        "escalation_reason": row.get("escalation_reason"),
+        "validation": {campo: validation.get(campo) for campo in
+                       ("nome_marca", "preco", "posicionamento", "organizacao")} if isinstance(validation, dict) else None,
+        "error": row.get("error"),
+        "analysis_details": row.get("analysis_details"),
+    }
+
+
+class LogArchive:
+    """Diretório com os logs arquivados, particionado por dia"""
+
+    def __init__(self, path: str = LOG_ARCHIVE_DIR, compression: str = "zstd"):
+        self.path = Path(path)
+        self.compression = compression
+        self._lock = threading.Lock()
+        self._counters_key = None
+        self._counters = None
+
+    def files(self) -> List[Path]:
+        return sorted(self.path.glob("day=*/*.parquet")) if self.path.is_dir() else []
+
+    def write(self, rows: List[dict]) -> List[Path]:
+        """
+        Grava as linhas (já no formato de `_archive_row`) em um arquivo por dia. O arquivo leva o
+        menor id do dia no nome: arquivar de novo as mesmas linhas (ex.: após uma falha antes de
+        apagá-las do Supabase) substitui o arquivo em vez de duplicar os logs.
+        """
+        pa = _pyarrow()
+        schema = archive_schema()
+        by_day: Dict[str, List[dict]] = {}
+        for row in rows:
+            by_day.setdefault(_day(row["created_at"].timestamp()), []).append(row)
+
+        written = []
+        for day, day_rows in sorted(by_day.items()):
+            directory = self.path / f"day={day}"
+            directory.mkdir(parents=True, exist_ok=True)
+            path = directory / f"part-{min(row['id'] for row in day_rows)}.parquet"
+            temp_path = path.with_suffix(".tmp")
+            table = pa.Table.from_pylist(day_rows, schema=schema)
+            pa.parquet.write_table(table, temp_path, compression=self.compression,
+                                   use_dictionary=["status", "produtos", "model", "escalation_reason"])
+            os.replace(temp_path, path)
+            written.append(path)
+        return written
+
+    def dataset(self):
+        pa = _pyarrow()
+        # O dia vem do nome do diretório (day=AAAA-MM-DD), não do conteúdo dos arquivos
+        return pa.dataset.dataset([str(path) for path in self.files()], format="parquet",
+                                  schema=archive_schema().append(pa.field("day", pa.string())),
+                                  partitioning=pa.dataset.partitioning(pa.schema([("day", pa.string())]), flavor="hive"),
+                                  partition_base_dir=str(self.path))
+
+    def read(self, columns: List[str], since: Optional[str] = None, until: Optional[str] = None,
+             produto: Optional[str] = None):
+        """
+        Lê `columns` dos logs arquivados no período [since, until) e, opcionalmente, só os que
+        incluem `produto`. O filtro por dia descarta partições inteiras sem abri-las.
+        """
+        pa = _pyarrow()
+        pc, ds = pa.compute, pa.dataset
+        if not self.files():
+            return pa.Table.from_pylist([], schema=archive_schema()).select(columns)
+
+        timestamp_type = pa.timestamp("us", tz="UTC")
+        expression = None
+        conditions = []
+        if since:
+            start = _parse_timestamp(since)
+            conditions += [ds.field("day") >= _day(start),
+                           ds.field("created_at") >= pa.scalar(int(start * 1e6), timestamp_type)]
+        if until:
+            end = _parse_timestamp(until)
+            conditions += [ds.field("day") <= _day(end),
+                           ds.field("created_at") < pa.scalar(int(end * 1e6), timestamp_type)]
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+
+        read_columns = list(dict.fromkeys(columns + (["produtos"] if produto else [])))
+        table = self.dataset().to_table(columns=read_columns, filter=expression)
+        if produto:
+            # Linhas (logs) em que algum dos produtos é `produto`
+            names = pc.cast(pc.list_flatten(table["produtos"]), pa.string())
+            parents = pc.filter(pc.list_parent_indices(table["produtos"]), pc.equal(names, produto))
+            table = table.take(pc.unique(parents)).select(columns)
+        return table
+
+    def query(self, since: Optional[str] = None, until: Optional[str] = None, produto: Optional[str] = None) -> dict:
+        """Agregados históricos: totais, taxa de sucesso por produto, custo por dia e percentis de tempo"""
+        pa = _pyarrow()
+        pc = pa.compute
+        start_time = time.perf_counter()
+        table = self.read(["status", "produtos", "execution_time", "cost", "created_at"], since, until, produto)
+        status = pc.cast(table["status"], pa.string())
+        success = pc.fill_null(pc.equal(status, "success"), False)
+        cost = pc.fill_null(table["cost"], 0.0)
+
+        # Uma linha por (log, produto) para agregar por produto
+        names = pc.cast(pc.list_flatten(table["produtos"]), pa.string())
+        parents = pc.list_parent_indices(table["produtos"])
+        per_product = pa.table({
+            "produto": names,
+            "success": pc.cast(pc.take(success, parents), pa.int64()),
+            "cost": pc.take(cost, parents),
+        }).group_by("produto").aggregate([("success", "count"), ("success", "sum"), ("cost", "sum")])
+        if produto:
+            per_product = per_product.filter(pc.equal(per_product["produto"], produto))
+
+        days = pc.strftime(table["created_at"], format="%Y-%m-%d")
+        per_day = pa.table({"day": days, "success": pc.cast(success, pa.int64()), "cost": cost}).group_by("day").aggregate(
+            [("success", "count"), ("success", "sum"), ("cost", "sum")]).sort_by("day")
+
+        # Tempo das análises concluídas (sucesso ou pendente), como no /stats
+        times = pc.drop_null(pc.filter(table["execution_time"], pc.fill_null(pc.not_equal(status, "error"), False)))
+        quantiles = pc.quantile(times, q=LATENCY_QUANTILES).to_pylist() if len(times) else [None] * len(LATENCY_QUANTILES)
+
+        total = table.num_rows
+        successful = pc.sum(success).as_py() or 0
+        return {
+            "total_analyses": total,
+            "successful_analyses": successful,
+            "success_rate": successful / total if total else None,
+            "total_cost": pc.sum(cost).as_py() or 0.0,
+            "execution_time_percentiles": {f"p{int(q * 100)}": value for q, value in zip(LATENCY_QUANTILES, quantiles)},
+            "products": {
+                row["produto"]: {
+                    "total_analyses": row["success_count"],
+                    "successful_analyses": row["success_sum"],
+                    "success_rate": row["success_sum"] / row["success_count"] if row["success_count"] else None,
+                    "total_cost": row["cost_sum"],
+                } for row in per_product.to_pylist()
+            },
+            "days": [
+                {
+                    "day": row["day"],
+                    "total_analyses": row["success_count"],
+                    "success_rate": row["success_sum"] / row["success_count"] if row["success_count"] else None,
+                    "total_cost": row["cost_sum"],
+                } for row in per_day.to_pylist()
+            ],
+            "files": len(self.files()),
+            "query_time": time.perf_counter() - start_time,
+        }
+
+    def counters(self) -> Optional[dict]:
+        """
+        Contadores do StatsAggregator (`_Counters`) de todos os logs arquivados, em totais e por
+        produto, para somar aos da tabela `logs` na reconciliação do /stats, e o maior id arquivado
+        (`max_id`): as linhas da tabela até esse id já estão no arquivo, mesmo que ainda não tenham
+        sido apagadas (`--keep` ou falha entre a gravação e a exclusão). O resultado fica em
+        memória até os arquivos mudarem. Retorna None se não houver arquivo.
+        """
+        files = self.files()
+        if not files:
+            return None
+        key = [(str(path), path.stat().st_mtime_ns) for path in files]
+        with self._lock:
+            if key == self._counters_key:
+                return self._counters
+
+        pa = _pyarrow()
+        pc = pa.compute
+        table = self.read(["id", "status", "produtos", "execution_time", "cost"])
+        status = pc.cast(table["status"], pa.string())
+        success = pc.fill_null(pc.equal(status, "success"), False)
+        execution_time = pc.fill_null(table["execution_time"], 0.0)
+        # Faixa do histograma como em bisect_left(EXECUTION_TIME_BUCKETS, tempo)
+        bucket = pa.array([0] * table.num_rows, pa.int64())
+        for bound in EXECUTION_TIME_BUCKETS:
+            bucket = pc.add(bucket, pc.cast(pc.greater(execution_time, bound), pa.int64()))
+        rows = pa.table({
+            "success": pc.cast(success, pa.int64()),
+            "error": pc.cast(pc.fill_null(pc.equal(status, "error"), False), pa.int64()),
+            "success_cost": pc.if_else(success, pc.fill_null(table["cost"], 0.0), 0.0),
+            "success_time": pc.if_else(success, execution_time, 0.0),
+            "bucket": pc.if_else(success, bucket, -1),
+        })
+
+        parents = pc.list_parent_indices(table["produtos"])
+        product_rows = rows.take(parents).append_column(
+            "produto", pc.cast(pc.list_flatten(table["produtos"]), pa.string()))
+        counters = {
+            "totals": _grouped_counters(pa, rows.append_column("scope", pa.array([""] * rows.num_rows)), "scope").get("", _empty_counters()),
+            "products": _grouped_counters(pa, product_rows, "produto"),
+            "max_id": pc.max(table["id"]).as_py(),
+        }
+        with self._lock:
+            self._counters_key, self._counters = key, counters
+        return counters
+
+
+def _empty_counters() -> dict:
+    return {"total": 0, "successful": 0, "errors": 0, "total_cost": 0.0, "success_time_sum": 0.0,
+            "histogram": [0] * (len(EXECUTION_TIME_BUCKETS) + 1)}
+
+
+def _grouped_counters(pa, rows, key: str) -> Dict[str, dict]:
+    """Campos de `_Counters` por valor de `key`, a partir das colunas calculadas em `counters`"""
+    pc = pa.compute
+    result: Dict[str, dict] = {}
+    aggregated = rows.group_by(key).aggregate([
+        ("success", "count"), ("success", "sum"), ("error", "sum"), ("success_cost", "sum"), ("success_time", "sum")])
+    for row in aggregated.to_pylist():
+        result[row[key]] = {
+            "total": row["success_count"],
+            "successful": row["success_sum"],
+            "errors": row["error_sum"],
+            "total_cost": row["success_cost_sum"],
+            "success_time_sum": row["success_time_sum"],
+            "histogram": [0] * (len(EXECUTION_TIME_BUCKETS) + 1),
+        }
+    successes = rows.filter(pc.greater_equal(rows["bucket"], 0))
+    for row in successes.group_by([key, "bucket"]).aggregate([("success", "count")]).to_pylist():
+        result[row[key]]["histogram"][row["bucket"]] = row["success_count"]
+    return result
+
+
+def archive_logs(supabase, archive: LogArchive, retention_days: float = LOG_RETENTION_DAYS,
+                 chunk_rows: int = ARCHIVE_CHUNK_ROWS, delete: bool = True) -> dict:
+    """
+    Move para o arquivo os logs com `created_at` anterior à retenção.
+
+    Lê a tabela em ordem de id, em blocos de `chunk_rows`; cada bloco é gravado (um arquivo por
+    dia) antes de as mesmas linhas serem apagadas do Supabase, então uma falha no meio deixa no
+    máximo linhas arquivadas que ainda não foram apagadas (e que o próximo arquivamento regrava
+    no mesmo arquivo). Com `delete=False`, só grava os arquivos.
+    Chamadas bloqueantes: use a partir de uma thread, fora do event loop.
+    """
+    _pyarrow()
+    cutoff = time.time() - retention_days * 86400
+    cutoff_iso = datetime.fromtimestamp(cutoff).isoformat()
+    report = {"cutoff": cutoff_iso, "archived": 0, "deleted": 0, "files": 0}
+
+    def flush(chunk: List[dict]):
+        report["files"] += len(archive.write(chunk))
+        report["archived"] += len(chunk)
+        if delete:
+            first_id, last_id = chunk[0]["id"], chunk[-1]["id"]
+            deleted = supabase.table('logs').delete().gte('id', first_id).lte('id', last_id) \
+                .lt('created_at', cutoff_iso).execute().data
+            report["deleted"] += len(deleted or [])
+        logger.info("Logs arquivados até o id %s", chunk[-1]["id"], extra={"archive": dict(report)})
+
+    chunk: List[dict] = []
+    for page in iter_log_pages(supabase, "*", apply_filters=lambda query: query.lt('created_at', cutoff_iso)):
+        chunk.extend(_archive_row(row) for row in page)
+        if len(chunk) >= chunk_rows:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+    return report
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Arquivo histórico dos logs de análise em Parquet")
+    parser.add_argument("--dir", default=LOG_ARCHIVE_DIR, help="Diretório do arquivo (LOG_ARCHIVE_DIR)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    archive_parser = commands.add_parser("archive", help="Move do Supabase para o arquivo os logs mais antigos que a retenção")
+    archive_parser.add_argument("--retention-days", type=float, default=LOG_RETENTION_DAYS,
+                                help="Dias mantidos na tabela logs (LOG_RETENTION_DAYS)")
+    archive_parser.add_argument("--keep", action="store_true", help="Grava os arquivos sem apagar as linhas do Supabase")
+
+    stats_parser = commands.add_parser("stats", help="Agregados históricos a partir do arquivo")
+    stats_parser.add_argument("--since", help="Data/hora ISO inicial (inclusiva)")
+    stats_parser.add_argument("--until", help="Data/hora ISO final (exclusiva)")
+    stats_parser.add_argument("--produto", help="Apenas análises que incluem este produto")
+    args = parser.parse_args(argv)
+
+    archive = LogArchive(args.dir)
+    if args.command == "archive":
+        from clients import get_supabase
+        report = archive_logs(get_supabase(), archive, args.retention_days, delete=not args.keep)
+    else:
+        report = archive.query(args.since, args.until, args.produto)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
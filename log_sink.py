@@ -0,0 +1,264 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from pathlib import Path
+from typing import Callable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class LogSink:
+    """
+    Gravação de logs em segundo plano, fora do caminho da requisição.
+
+    Os registros entram em uma fila limitada em memória e são gravados em lote por
+    `insert_batch(rows)` quando a fila atinge `batch_size` ou a cada `flush_interval`
+    segundos. Falhas são repetidas com backoff exponencial; se o destino continuar
+    indisponível, os registros vão para um arquivo JSONL local (`spill_path`) e são
+    reenviados quando o destino voltar. Linhas do arquivo que não puderem ser lidas (ex.: gravação
+    interrompida no meio) vão para um arquivo `.rejected` ao lado dele em vez de travar o reenvio.
+    Arquivos `.replay` deixados por um processo que parou no meio de um reenvio voltam para o
+    arquivo local quando o worker inicia.
+    """
+
+    def __init__(self, insert_batch: Callable[[List[dict]], None], max_queue: int = 10000,
+                 batch_size: int = 50, flush_interval: float = 2.0, max_retries: int = 4,
+                 spill_path: str = "logs_spill.jsonl", spill_retry_interval: float = 60):
+        self.insert_batch = insert_batch
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.spill_path = Path(spill_path)
+        self.spill_retry_interval = spill_retry_interval
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # Gravações bloqueantes disparadas por `submit`, fora do event loop
+        self._background: Set[asyncio.Task] = set()
+        self._stopping = False
+        self._last_spill_replay = 0.0
+        self.written = 0
+        self.spilled = 0
+        self.dropped = 0
+
+    def start(self):
+        self._stopping = False
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Para o worker e grava tudo o que ainda estiver na fila"""
+        if self._task is None:
+            await asyncio.gather(*self._background, return_exceptions=True)
+            return
+
+        # O worker termina o lote atual e sai; não cancela para não perder um lote em gravação
+        self._stopping = True
+        await asyncio.gather(self._task, *self._background, return_exceptions=True)
+        self._task = None
+
+        pending = []
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for start in range(0, len(pending), self.batch_size):
+            await self._flush(pending[start:start + self.batch_size])
+        logger.info("Logs drenados no encerramento: %d", len(pending))
+
+    def submit(self, record: dict):
+        """Enfileira um registro sem bloquear; sem worker ativo, grava direto (em uma thread)"""
+        if self._task is None:
+            self._in_background(self._insert_or_spill, [record])
+            return
+
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            logger.warning("Fila de logs cheia, gravando registro no arquivo local")
+            self._in_background(self._spill, [record])
+
+    def _in_background(self, func, *args):
+        """Executa uma gravação bloqueante fora do event loop; sem loop em execução, executa direto"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            func(*args)
+            return
+        task = loop.create_task(asyncio.to_thread(func, *args))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _insert_or_spill(self, records: List[dict]):
+        try:
+            self.insert_batch(records)
+            self.written += len(records)
+        except Exception as e:
+            logger.warning("Erro ao gravar %d logs, gravando no arquivo local: %s", len(records), e)
+            self._spill(records)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "written": self.written,
+            "spilled": self.spilled,
+            "dropped": self.dropped,
+            "spill_pending": self.spill_path.exists()
+        }
+
+    async def _run(self):
+        try:
+            await asyncio.to_thread(self._recover_replays)
+        except Exception:
+            logger.exception("Erro ao recuperar reenvios interrompidos do arquivo local de logs")
+        while not self._stopping:
+            try:
+                await self._run_once()
+            except Exception:
+                # Um erro inesperado não pode parar o worker: os próximos logs ficariam só na fila
+                logger.exception("Erro no worker de logs")
+                await asyncio.sleep(self.flush_interval)
+
+    async def _run_once(self):
+        try:
+            batch = [await asyncio.wait_for(self._queue.get(), timeout=self.flush_interval)]
+        except asyncio.TimeoutError:
+            return
+
+        # Junta mais registros até completar o lote ou estourar o intervalo
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+
+        if await self._flush(batch):
+            await self._replay_spill()
+
+    async def _flush(self, batch: List[dict]) -> bool:
+        """Grava um lote com retentativas; se todas falharem, manda para o arquivo local"""
+        for attempt in range(self.max_retries):
+            try:
+                await asyncio.to_thread(self.insert_batch, batch)
+                self.written += len(batch)
+                return True
+            except Exception as e:
+                logger.warning("Erro ao gravar lote de %d logs (tentativa %d): %s", len(batch), attempt + 1, e)
+                if attempt < self.max_retries - 1:
+                    await asyncio.sleep(min(30, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+
+        await asyncio.to_thread(self._spill, batch)
+        return False
+
+    def _append_spill(self, records: List[dict]):
+        with self.spill_path.open("a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _spill(self, records: List[dict]):
+        if not records:
+            return
+        try:
+            self._append_spill(records)
+        except OSError as e:
+            self.dropped += len(records)
+            logger.error("Erro ao gravar %d logs no arquivo local, registros perdidos: %s", len(records), e)
+            return
+        self.spilled += len(records)
+
+    def _read_replay(self, replay_path: Path) -> List[dict]:
+        """Registros do arquivo a reenviar; as linhas inválidas vão para o arquivo de rejeitados"""
+        records, rejected = [], []
+        with replay_path.open(encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if isinstance(record, dict):
+                    records.append(record)
+                else:
+                    rejected.append(line if line.endswith("\n") else line + "\n")
+        if rejected:
+            logger.warning("%d linhas inválidas no arquivo local de logs movidas para %s",
+                           len(rejected), self.spill_path.with_suffix(".rejected"))
+            try:
+                with self.spill_path.with_suffix(".rejected").open("a", encoding="utf-8") as f:
+                    f.writelines(rejected)
+            except OSError as e:
+                logger.error("Erro ao gravar as linhas inválidas do arquivo local de logs: %s", e)
+        return records
+
+    def _replay_path(self, pid: int) -> Path:
+        return self.spill_path.with_suffix(f".{pid}.replay")
+
+    def _recover_replays(self):
+        """
+        Devolve ao arquivo local os registros de reenvios interrompidos (processo encerrado no meio
+        do reenvio). Arquivos de processos ainda em execução são reenvios em andamento e ficam.
+        """
+        for path in self.spill_path.parent.glob(f"{self.spill_path.stem}.*.replay"):
+            try:
+                pid = int(path.suffixes[-2][1:])
+            except (IndexError, ValueError):
+                continue
+            if pid != os.getpid() and _process_alive(pid):
+                continue
+            # Renomear primeiro garante que só um processo recupere cada arquivo
+            claimed = path.with_suffix(f".{os.getpid()}.recover")
+            try:
+                os.replace(path, claimed)
+            except FileNotFoundError:
+                continue
+            records = self._read_replay(claimed)
+            logger.info("Recuperando %d logs de um reenvio interrompido (%s)", len(records), path.name)
+            try:
+                self._append_spill(records)
+            except OSError as e:
+                # Fica para a próxima inicialização
+                logger.error("Erro ao recuperar o reenvio interrompido %s: %s", path.name, e)
+                os.replace(claimed, path)
+                continue
+            claimed.unlink()
+
+    async def _replay_spill(self):
+        """Reenvia os registros do arquivo local, no máximo uma vez por `spill_retry_interval`"""
+        now = time.monotonic()
+        if not self.spill_path.exists() or now - self._last_spill_replay < self.spill_retry_interval:
+            return
+        self._last_spill_replay = now
+
+        # Renomeia antes de ler para que novas falhas gravem em um arquivo novo
+        replay_path = self._replay_path(os.getpid())
+        try:
+            os.replace(self.spill_path, replay_path)
+        except FileNotFoundError:
+            return
+        records = await asyncio.to_thread(self._read_replay, replay_path)
+
+        logger.info("Reenviando %d logs do arquivo local", len(records))
+        for start in range(0, len(records), self.batch_size):
+            if not await self._flush(records[start:start + self.batch_size]):
+                # Destino ainda indisponível: o restante volta para o arquivo local
+                await asyncio.to_thread(self._spill, records[start + self.batch_size:])
+                break
+        replay_path.unlink()
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Sem permissão para sinalizar: o processo existe
+        return True
+    return True
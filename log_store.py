@@ -0,0 +1,100 @@
+import json
+from typing import Callable, Iterator, List, Optional
+
+# Colunas da tabela `logs` que podem ser projetadas em consultas
+LOG_COLUMNS = [
+    'id', 'status', 'produtos', 'execution_time', 'cost', 'error',
+    'cache_hit', 'model', 'escalation_reason', 'validation', 'analysis_details', 'created_at'
+]
+DEFAULT_LOG_FIELDS = ['id', 'status', 'produtos', 'execution_time', 'cost', 'error']
+
+
+def iter_log_pages(supabase, columns: str = "*", page_size: int = 1000, after_id: Optional[int] = None,
+                   apply_filters: Optional[Callable] = None) -> Iterator[List[dict]]:
+    """
+    Percorre a tabela `logs` em páginas ordenadas por `id` crescente (paginação por chave).
+
+    Cada página é buscada com `id > último id da página anterior`, então o custo por página
+    não cresce com a posição, ao contrário de offset. `columns` deve incluir `id`.
+    `apply_filters(query)` pode acrescentar filtros à consulta.
+    Chamadas bloqueantes: use a partir de uma thread, fora do event loop.
+    """
+    last_id = after_id
+    while True:
+        query = supabase.table('logs').select(columns)
+        if last_id is not None:
+            query = query.gt('id', last_id)
+        if apply_filters:
+            query = apply_filters(query)
+
+        rows = query.order('id').limit(page_size).execute().data
+        if not rows:
+            return
+
+        yield rows
+
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1]['id']
+
+
+def iter_logs(supabase, columns: str = "*", page_size: int = 1000, after_id: Optional[int] = None,
+              apply_filters: Optional[Callable] = None) -> Iterator[dict]:
+    """Mesmo que `iter_log_pages`, mas registro a registro"""
+    for page in iter_log_pages(supabase, columns, page_size, after_id, apply_filters):
+        yield from page
+
+
+def parse_fields(fields: Optional[str]) -> List[str]:
+    """Valida a lista de colunas separadas por vírgula, lançando ValueError se houver coluna desconhecida"""
+    if not fields:
+        return list(DEFAULT_LOG_FIELDS)
+
+    selected = [f.strip() for f in fields.split(',') if f.strip()]
+    unknown = [f for f in selected if f not in LOG_COLUMNS]
+    if unknown:
+        raise ValueError(f"Campos desconhecidos: {', '.join(unknown)}. Disponíveis: {', '.join(LOG_COLUMNS)}")
+
+    # O id é sempre necessário para a paginação
+    if 'id' not in selected:
+        selected.insert(0, 'id')
+    return selected
+
+
+def like_escape(text: str) -> str:
+    """Escapa os caracteres especiais do LIKE (`\\`, `%` e `_`) para casar `text` literalmente"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def log_filters(status: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+                produto: Optional[str] = None, before_id: Optional[int] = None) -> Callable:
+    """Monta a função que aplica os filtros de status, período, produto e cursor à consulta"""
+    def apply(query):
+        if status:
+            query = query.eq('status', status)
+        if since:
+            query = query.gte('created_at', since)
+        if until:
+            query = query.lt('created_at', until)
+        if produto:
+            # `produtos` é gravado por save_log como lista JSON em texto (json.dumps): '["Produto A", "Produto B"]'.
+            # O nome entre aspas evita casar parte de outro nome; acentos viram `\u00e1` e precisam do escape
+            query = query.like('produtos', f'%{like_escape(json.dumps(produto))}%')
+        if before_id is not None:
+            query = query.lt('id', before_id)
+        return query
+    return apply
+
+
+def format_log(log: dict) -> dict:
+    """Formata os campos numéricos e de texto de um log para exibição"""
+    formatted = dict(log)
+    if 'produtos' in log:
+        formatted['produtos'] = log['produtos'] if isinstance(log['produtos'], str) else json.dumps(log['produtos'])
+    if 'execution_time' in log:
+        formatted['execution_time'] = f"{log['execution_time']:.2f}" if log['execution_time'] else ''
+    if 'cost' in log:
+        formatted['cost'] = f"${log['cost']:.4f}" if log['cost'] else ''
+    if 'error' in log:
+        formatted['error'] = log['error'] if log['error'] else ''
+    return formatted
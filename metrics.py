@@ -0,0 +1,209 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Métricas em memória no formato de exposição do Prometheus (texto), sem dependências externas.
+
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120]
+
+_registry: List["_Metric"] = []
+
+
+def _format_labels(labelnames: Tuple[str, ...], labelvalues: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Valor lido no momento da coleta por `function()`"""
+    type_name = "gauge"
+
+    def __init__(self, name: str, help_text: str, function: Callable[[], float]):
+        super().__init__(name, help_text)
+        self.function = function
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        try:
+            lines.append(f"{self.name} {float(self.function())}")
+        except Exception:
+            pass
+        return lines
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Optional[List[float]] = None):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = list(buckets or DEFAULT_BUCKETS)
+        # chave -> [contagem por faixa (+Inf no fim), soma, contagem]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            values = [(key, list(entry[0]), entry[1], entry[2]) for key, entry in self._values.items()]
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def render() -> str:
+    """Todas as métricas registradas no formato texto do Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Métricas da API
+HTTP_REQUESTS = Counter("smartshelf_http_requests_total", "Requisições HTTP por rota e status", ("path", "method", "status"))
+HTTP_DURATION = Histogram("smartshelf_http_request_duration_seconds", "Duração das requisições HTTP", ("path", "method"))
+STAGE_DURATION = Histogram("smartshelf_stage_duration_seconds", "Duração de cada etapa da análise", ("stage",))
+GEMINI_CALLS = Counter("smartshelf_gemini_calls_total", "Chamadas ao Gemini")
+GEMINI_TIMEOUTS = Counter("smartshelf_gemini_timeouts_total", "Chamadas ao Gemini que excederam o tempo limite")
+GEMINI_ERRORS = Counter("smartshelf_gemini_errors_total", "Chamadas ao Gemini que falharam")
+GEMINI_RETRIES = Counter("smartshelf_gemini_retries_total", "Novas tentativas após erros transitórios do Gemini")
+GEMINI_HEDGES = Counter("smartshelf_gemini_hedged_calls_total", "Chamadas extras disparadas por demora da primeira")
+GEMINI_HEDGE_WINS = Counter("smartshelf_gemini_hedge_wins_total", "Chamadas extras que responderam antes da primeira")
+MODEL_ESCALATIONS = Counter("smartshelf_model_escalations_total", "Análises repetidas no modelo principal, por motivo", ("reason",))
+MODEL_COST = Counter("smartshelf_model_cost_dollars_total", "Custo estimado das chamadas por modelo (US$)", ("model",))
+GEMINI_QUEUE_WAIT = Histogram("smartshelf_gemini_queue_wait_seconds", "Espera pelo limite de taxa e de concorrência do Gemini")
+ANALYSIS_ERRORS = Counter("smartshelf_analysis_errors_total", "Análises que terminaram em erro")
+CACHE_HITS = Counter("smartshelf_cache_hits_total", "Análises atendidas pelo cache de resultados")
+CACHE_MISSES = Counter("smartshelf_cache_misses_total", "Análises não encontradas no cache de resultados")
+NEAR_DUPLICATES = Counter("smartshelf_near_duplicates_total", "Imagens quase iguais a uma análise recente", ("action",))
+REQUEST_PEAK_MEMORY = Histogram(
+    "smartshelf_request_peak_memory_bytes", "Pico estimado de memória dos buffers de imagem por requisição",
+    buckets=[2 ** n for n in range(16, 31, 2)]
+)
+TILES = Counter("smartshelf_tiles_total", "Trechos de fotos panorâmicas por destino (analyzed, skipped, cancelled)", ("outcome",))
+UPLOAD_BYTES = Counter("smartshelf_upload_bytes_total", "Bytes de imagem recebidos dos clientes")
+GEMINI_UPLOAD_BYTES = Counter("smartshelf_gemini_upload_bytes_total", "Bytes de imagem enviados ao Gemini")
+
+
+# Tempos por etapa da requisição atual, para o cabeçalho Server-Timing
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+
+
+def record_stage(name: str, seconds: float):
+    """Registra a duração de uma etapa no histograma e nos tempos da requisição atual"""
+    STAGE_DURATION.observe(seconds, stage=name)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0) + seconds
+
+
+@contextmanager
+def stage(name: str):
+    """Mede o bloco como uma etapa da análise"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start_time)
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI que mede cada requisição HTTP e acrescenta o cabeçalho Server-Timing
+    com os tempos das etapas registradas durante o processamento.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        timings: Dict[str, float] = {}
+        token = _request_timings.set(timings)
+        status = {"code": 500}
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+                entries.append(f"total;dur={(time.perf_counter() - start_time) * 1000:.1f}")
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", ", ".join(entries).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            # Usa o caminho da rota (ex.: /jobs/{job_id}) para não explodir a cardinalidade
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "desconhecida"
+            HTTP_REQUESTS.inc(path=path, method=scope["method"], status=status["code"])
+            HTTP_DURATION.observe(time.perf_counter() - start_time, path=path, method=scope["method"])
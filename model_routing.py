@@ -0,0 +1,95 @@
+import json
+import os
+from typing import List, NamedTuple, Optional
+
+from parsing import MISSING_PRODUCT_DETAILS
+
+# Preço em US$ por milhão de tokens (entrada, saída), pelo prefixo do nome do modelo.
+# Pode ser sobrescrito com GEMINI_PRICES='{"gemini-1.5-pro": [1.25, 5.0]}'.
+MODEL_PRICES = {
+    "gemini-1.5-pro": (1.25, 5.00),
+    "gemini-1.5-flash-8b": (0.0375, 0.15),
+    "gemini-1.5-flash": (0.075, 0.30),
+}
+MODEL_PRICES.update({name: tuple(prices) for name, prices in json.loads(os.environ.get("GEMINI_PRICES", "{}")).items()})
+
+# Custo fixo usado para modelos sem preço conhecido (valor histórico por análise)
+FALLBACK_COST_PER_CALL = 0.0005
+
+# Tokens cobrados por imagem e aproximação de caracteres por token, quando a resposta não traz o uso
+IMAGE_TOKENS = 258
+CHARS_PER_TOKEN = 4
+
+
+class ModelCall(NamedTuple):
+    """Resultado de uma chamada ao modelo pelo agendador"""
+    text: str
+    model: str
+    calls: int
+    cost: float
+    truncated: bool
+
+
+def model_prices(model_name: str) -> Optional[tuple]:
+    name = model_name.split("/")[-1]
+    matches = [prefix for prefix in MODEL_PRICES if name.startswith(prefix)]
+    return MODEL_PRICES[max(matches, key=len)] if matches else None
+
+
+def estimate_cost(model_name: str, contents: list, response_text: str, usage=None) -> float:
+    """
+    Custo estimado de uma chamada em US$: usa o uso de tokens informado pela API (`usage_metadata`)
+    quando disponível; senão estima pelos caracteres do prompt e da resposta e pelas imagens.
+    """
+    prices = model_prices(model_name)
+    if prices is None:
+        return FALLBACK_COST_PER_CALL
+
+    input_tokens = getattr(usage, "prompt_token_count", None)
+    output_tokens = getattr(usage, "candidates_token_count", None)
+    if input_tokens is None:
+        input_tokens = sum(len(part) // CHARS_PER_TOKEN if isinstance(part, str) else IMAGE_TOKENS
+                           for part in contents)
+    if output_tokens is None:
+        output_tokens = len(response_text) // CHARS_PER_TOKEN
+
+    return (input_tokens * prices[0] + output_tokens * prices[1]) / 1_000_000
+
+
+def is_truncated(response) -> bool:
+    """Se a resposta foi cortada pelo limite de tokens de saída"""
+    candidates = getattr(response, "candidates", None) or []
+    if not candidates:
+        return False
+    reason = getattr(candidates[0], "finish_reason", None)
+    return getattr(reason, "name", reason) == "MAX_TOKENS"
+
+
+def _mixed(validation: dict) -> bool:
+    return len(set(validation.values())) > 1
+
+
+def escalation_reason(status: str, validation: dict, details: str, product_results: Optional[List[dict]],
+                      truncated: bool = False, escalate_on_mixed: bool = True) -> Optional[str]:
+    """
+    Heurística de confiança para o resultado do modelo rápido. Retorna o motivo para repetir a
+    análise no modelo principal, ou None se o resultado pode ser usado:
+
+    - truncated: a resposta foi cortada pelo limite de tokens
+    - missing_products: algum produto não apareceu na resposta
+    - mixed: critérios aprovados e reprovados ao mesmo tempo (casos limítrofes)
+    - no_details: análise pendente sem nenhuma justificativa
+    """
+    if truncated:
+        return "truncated"
+    if product_results and any(r["details"] == MISSING_PRODUCT_DETAILS for r in product_results):
+        return "missing_products"
+    if escalate_on_mixed:
+        if product_results:
+            if any(_mixed(r["validation"]) for r in product_results):
+                return "mixed"
+        elif _mixed(validation):
+            return "mixed"
+    if status != "success" and not details.strip():
+        return "no_details"
+    return None
@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Erros do provedor que valem nova tentativa (cota, indisponibilidade, erro interno, prazo)
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable",
+                    "InternalServerError", "DeadlineExceeded", "BadGateway"}
+
+
+# Resultado da chamada do hedging que respondeu depois da outra já estar sendo consumida
+_SUPERSEDED = object()
+
+
+class ModelUnavailableError(RuntimeError):
+    """O modelo continuou recusando chamadas (cota ou indisponibilidade) após as retentativas"""
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, asyncio.TimeoutError):
+        return True
+    # google.api_core.exceptions expõe o status HTTP em `code`; comparado pelo nome para não importar o SDK
+    return getattr(exc, "code", None) in RETRYABLE_CODES or type(exc).__name__ in RETRYABLE_ERRORS
+
+
+class TokenBucket:
+    """
+    Limitador de taxa: `rate` fichas por segundo, acumulando até `capacity`.
+    Usado apenas no event loop (sem locks). `rate <= 0` desativa o limite.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire_nowait(self) -> bool:
+        """Como `try_acquire`, para limitadores em que a consulta precisa sair do event loop"""
+        return self.try_acquire()
+
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ConcurrencyLimit:
+    """
+    Limite de chamadas simultâneas, que pode ser compartilhado por vários agendadores.
+    O semáforo é criado no primeiro uso para ficar associado ao event loop do servidor.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+
+class ModelScheduler:
+    """
+    Agenda as chamadas ao modelo: limite de taxa (token bucket), limite global de chamadas
+    simultâneas, retentativas com backoff exponencial e jitter em erros transitórios e,
+    opcionalmente, requisições "hedged": se a chamada passar do p95 das latências recentes,
+    dispara uma segunda e usa a que responder primeiro.
+    """
+
+    def __init__(self, rate_per_minute: float = 60, burst: int = 10, max_concurrency: int = 8,
+                 max_retries: int = 3, attempt_timeout: float = 60, base_backoff: float = 1,
+                 max_backoff: float = 20, hedge: bool = False, hedge_quantile: float = 0.95,
+                 hedge_min_delay: float = 2, hedge_min_samples: int = 20, bucket=None,
+                 concurrency: Optional[ConcurrencyLimit] = None):
+        # `bucket` permite um limitador compartilhado entre processos (mesma interface de TokenBucket)
+        self.bucket = bucket or TokenBucket(rate_per_minute / 60, burst)
+        # `concurrency` permite um limite de chamadas simultâneas comum a vários agendadores
+        self.concurrency = concurrency or ConcurrencyLimit(max_concurrency)
+        self.max_retries = max_retries
+        self.attempt_timeout = attempt_timeout
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+
+        self._latencies = deque(maxlen=200)
+        self.waiting = 0
+        self.in_flight = 0
+
+    async def call(self, make_call: Callable[[], Awaitable], timeout: float,
+                   consume: Optional[Callable[[object], Awaitable]] = None) -> Tuple[object, int]:
+        """
+        Executa `make_call()` (que cria a coroutine da chamada) respeitando os limites.
+
+        `timeout` é o prazo total, incluindo espera na fila e retentativas; cada tentativa tem no
+        máximo `attempt_timeout`. Retorna (resposta, número de chamadas cobradas): as que
+        responderam e as interrompidas depois de enviadas (tempo limite, perdedora do hedging);
+        as recusadas pelo provedor (429, 503 etc.) não são cobradas.
+        Lança asyncio.TimeoutError se o prazo acabar e ModelUnavailableError se o provedor
+        continuar recusando as chamadas.
+
+        Com `consume` (ex.: a leitura de uma resposta em streaming), a vaga só é liberada quando
+        `consume(resposta)` termina, e o resultado dele substitui a resposta. Só a primeira resposta
+        é consumida; uma falha durante o consumo não é repetida, pois parte dele já foi repassada.
+        """
+        deadline = time.monotonic() + timeout
+        billed = [0]
+        claimed: List[bool] = []
+        for attempt in range(self.max_retries + 1):
+            attempt_deadline = min(deadline, time.monotonic() + self.attempt_timeout)
+            try:
+                return await self._call_hedged(make_call, attempt_deadline, billed, consume, claimed), billed[0]
+            except Exception as e:
+                if claimed or not is_retryable(e):
+                    raise
+                backoff = min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+                if attempt == self.max_retries or time.monotonic() + backoff >= deadline:
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise
+                    raise ModelUnavailableError(str(e)) from e
+                metrics.GEMINI_RETRIES.inc()
+                logger.warning("Chamada ao modelo falhou (tentativa %d), repetindo em %.1fs: %s",
+                               attempt + 1, backoff, str(e) or e.__class__.__name__)
+                await asyncio.sleep(backoff)
+
+        raise asyncio.TimeoutError()
+
+    def hedge_delay(self) -> Optional[float]:
+        """Atraso até a chamada extra: o quantil das latências recentes, ou None sem amostras suficientes"""
+        if not self.hedge or len(self._latencies) < self.hedge_min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.hedge_quantile))
+        return max(self.hedge_min_delay, latencies[index])
+
+    async def _call_hedged(self, make_call, deadline: float, billed: List[int], consume=None,
+                           claimed: Optional[List[bool]] = None):
+        primary = asyncio.ensure_future(self._attempt(make_call, deadline, billed, consume, claimed))
+        secondary = None
+        try:
+            delay = self.hedge_delay()
+            if delay is None or time.monotonic() + delay >= deadline:
+                return await primary
+
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            # Só dispara a chamada extra se houver ficha e vaga disponíveis agora, sem esperar, e se
+            # a resposta ainda não começou a ser consumida
+            if done or claimed or self.concurrency.semaphore.locked() or not await self.bucket.acquire_nowait():
+                return await primary
+
+            metrics.GEMINI_HEDGES.inc()
+            secondary = asyncio.ensure_future(self._attempt(make_call, deadline, billed, consume, claimed,
+                                                            token_acquired=True))
+            pending = {primary, secondary}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task.result() is _SUPERSEDED:
+                            continue
+                        if task is secondary:
+                            metrics.GEMINI_HEDGE_WINS.inc()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # A chamada que perdeu (ou todas, se o chamador foi cancelado) é cancelada
+            primary.cancel()
+            if secondary is not None:
+                secondary.cancel()
+
+    async def _attempt(self, make_call, deadline: float, billed: List[int], consume=None,
+                       claimed: Optional[List[bool]] = None, token_acquired: bool = False):
+        wait_start = time.monotonic()
+        self.waiting += 1
+        try:
+            if not token_acquired:
+                await asyncio.wait_for(self.bucket.acquire(), timeout=max(0, deadline - time.monotonic()))
+            await asyncio.wait_for(self.concurrency.semaphore.acquire(), timeout=max(0, deadline - time.monotonic()))
+        finally:
+            self.waiting -= 1
+            metrics.GEMINI_QUEUE_WAIT.observe(time.monotonic() - wait_start)
+
+        self.in_flight += 1
+        # Conta como cobrada ao enviar: a perdedora do hedging e a que estoura o prazo também são
+        # cobradas pelo provedor; só as recusadas (cota, indisponibilidade) deixam de contar
+        billed[0] += 1
+        metrics.GEMINI_CALLS.inc()
+        start_time = time.monotonic()
+        response = None
+        try:
+            response = await asyncio.wait_for(make_call(), timeout=max(0, deadline - start_time))
+            if consume is not None:
+                if claimed:
+                    # A outra chamada do hedging respondeu primeiro e já está sendo consumida
+                    return _SUPERSEDED
+                claimed.append(True)
+                response = await asyncio.wait_for(consume(response), timeout=max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            metrics.GEMINI_TIMEOUTS.inc()
+            raise
+        except Exception:
+            if response is None:
+                billed[0] -= 1
+            metrics.GEMINI_ERRORS.inc()
+            raise
+        finally:
+            self.in_flight -= 1
+            self.concurrency.semaphore.release()
+
+        self._latencies.append(time.monotonic() - start_time)
+        return response
@@ -0,0 +1,340 @@
+import json
+import logging
+import re
+import threading
+from typing import Annotated, List, Optional, Tuple
+
+from pydantic import BaseModel, BeforeValidator, ValidationError
+
+logger = logging.getLogger(__name__)
+
+# Rótulo do critério na resposta do modelo -> campo de ValidationResult
+CRITERIA = {
+    "Nome/marca": "nome_marca",
+    "Etiqueta de preço": "preco",
+    "Posicionamento": "posicionamento",
+    "Organização": "organizacao",
+}
+
+CRITERION_RES = {
+    campo: re.compile(rf"{re.escape(rotulo)}\s*\**\s*:\s*\**\s*(Verdadeiro|Falso)", re.IGNORECASE)
+    for rotulo, campo in CRITERIA.items()
+}
+
+PRODUCT_BLOCK_RE = re.compile(r"^#+\s*Produto:\s*(.+?)\s*$", re.MULTILINE)
+
+# Detalhes de um produto pedido que não aparece na resposta do modelo
+MISSING_PRODUCT_DETAILS = "Produto não encontrado na resposta da análise"
+
+# Prompts que pedem a resposta em JSON, e o prompt em texto equivalente para o parser de contingência
+JSON_PROMPTS = {
+    'json': 'default',
+    'por_produto_json': 'por_produto',
+}
+
+
+class ResponseParseError(ValueError):
+    """A resposta do modelo não pôde ser interpretada"""
+
+
+def _to_bool(value):
+    if isinstance(value, str) and value.strip().lower() in ("verdadeiro", "falso"):
+        return value.strip().lower() == "verdadeiro"
+    return value
+
+
+Booleano = Annotated[bool, BeforeValidator(_to_bool)]
+
+
+class CriteriosJson(BaseModel):
+    nome_marca: Booleano
+    etiqueta_preco: Booleano
+    posicionamento: Booleano
+    organizacao: Booleano
+
+
+class AnaliseJson(BaseModel):
+    aprovado: Booleano
+    criterios: CriteriosJson
+    detalhes: List[str] = []
+
+
+class ProdutoAnaliseJson(AnaliseJson):
+    nome: str
+
+
+class AnalisePorProdutoJson(BaseModel):
+    produtos: List[ProdutoAnaliseJson]
+
+
+class ParseStats:
+    """Contadores de interpretação das respostas do modelo, para acompanhar o gasto desperdiçado"""
+
+    def __init__(self, shared=None):
+        self._lock = threading.Lock()
+        self.counts = {"json": 0, "text": 0, "text_fallback": 0, "failed": 0, "reask": 0, "reask_failed": 0}
+        # Estado compartilhado entre workers (opcional): os contadores passam a somar todos eles
+        self.shared = shared
+
+    def record(self, outcome: str):
+        if self.shared:
+            self.shared.incr("parse_stats", outcome)
+            return
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            counts = dict(self.counts)
+        if self.shared:
+            counts.update({outcome: int(value) for outcome, value in self.shared.counters("parse_stats").items()})
+        parsed = counts["json"] + counts["text"] + counts["text_fallback"]
+        attempts = parsed + counts["failed"]
+        return {
+            **counts,
+            "failure_rate": counts["failed"] / attempts if attempts else 0,
+            "fallback_rate": counts["text_fallback"] / attempts if attempts else 0
+        }
+
+
+parse_stats = ParseStats()
+
+
+def parse_default_response(response_text: str) -> Tuple[str, dict, str]:
+    """
+    Interpreta a resposta em texto do prompt 'default'.
+
+    Retorna (status, validação, detalhes), com a validação no formato de ValidationResult.
+    Lança ResponseParseError se algum critério não for encontrado.
+    """
+    validation = {}
+    for campo, criterion_re in CRITERION_RES.items():
+        match = criterion_re.search(response_text)
+        if match is None:
+            raise ResponseParseError(f"Critério '{campo}' não encontrado na resposta")
+        validation[campo] = match.group(1).lower() == "verdadeiro"
+
+    if "Validada com sucesso" in response_text:
+        status = "success"
+        marker = "Motivos da aprovação:"
+    else:
+        status = "pending"
+        marker = "Dicas para melhoria:"
+    details = response_text.split(marker, 1)[1].strip() if marker in response_text else ""
+
+    return status, validation, details
+
+
+def parse_product_blocks(response_text: str, produtos_nomes: List[str]) -> List[dict]:
+    """
+    Interpreta a resposta em texto do prompt 'por_produto', com um bloco "### Produto: <nome>" por produto.
+
+    Retorna um item por produto de `produtos_nomes`, na mesma ordem, com `nome`, `status`,
+    `validation` e `details`. Produtos sem bloco na resposta ficam pendentes com todos os
+    critérios falsos. Lança ResponseParseError se não houver nenhum bloco.
+    """
+    matches = list(PRODUCT_BLOCK_RE.finditer(response_text))
+    if not matches:
+        raise ResponseParseError("Nenhum bloco de produto encontrado na resposta")
+
+    blocks = {}
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(response_text)
+        blocks[match.group(1).strip().strip('*').strip().casefold()] = response_text[match.end():end]
+
+    results = []
+    for nome in produtos_nomes:
+        block = blocks.get(nome.strip().casefold())
+        if block is None:
+            results.append(_missing_product(nome))
+            continue
+
+        validation = {campo: bool((m := criterion_re.search(block)) and m.group(1).lower() == "verdadeiro")
+                      for campo, criterion_re in CRITERION_RES.items()}
+        details = block.split("Observações:", 1)[1].strip() if "Observações:" in block else ""
+        results.append({
+            "nome": nome,
+            "status": "success" if "Validada com sucesso" in block and all(validation.values()) else "pending",
+            "validation": validation,
+            "details": details
+        })
+
+    return results
+
+
+def extract_json(response_text: str):
+    """Extrai o objeto JSON da resposta, tolerando blocos ```json e texto ao redor"""
+    text = response_text.strip()
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        raise ResponseParseError("Nenhum objeto JSON encontrado na resposta")
+    try:
+        return json.loads(text[start:end + 1])
+    except ValueError as e:
+        raise ResponseParseError(f"JSON inválido na resposta: {str(e)}")
+
+
+def _from_json_analysis(analise: AnaliseJson) -> Tuple[str, dict, str]:
+    validation = {
+        "nome_marca": analise.criterios.nome_marca,
+        "preco": analise.criterios.etiqueta_preco,
+        "posicionamento": analise.criterios.posicionamento,
+        "organizacao": analise.criterios.organizacao
+    }
+    status = "success" if analise.aprovado and all(validation.values()) else "pending"
+    details = "\n".join(f"- {detalhe}" for detalhe in analise.detalhes)
+    return status, validation, details
+
+
+def parse_json_response(response_text: str) -> Tuple[str, dict, str]:
+    """Interpreta a resposta JSON do prompt 'json' no mesmo formato de `parse_default_response`"""
+    try:
+        analise = AnaliseJson.model_validate(extract_json(response_text))
+    except ValidationError as e:
+        raise ResponseParseError(f"JSON fora do esquema: {str(e)}")
+    return _from_json_analysis(analise)
+
+
+def parse_json_product_response(response_text: str, produtos_nomes: List[str]) -> List[dict]:
+    """Interpreta a resposta JSON do prompt 'por_produto_json' no mesmo formato de `parse_product_blocks`"""
+    try:
+        analise = AnalisePorProdutoJson.model_validate(extract_json(response_text))
+    except ValidationError as e:
+        raise ResponseParseError(f"JSON fora do esquema: {str(e)}")
+
+    por_nome = {produto.nome.strip().casefold(): produto for produto in analise.produtos}
+    results = []
+    for nome in produtos_nomes:
+        produto = por_nome.get(nome.strip().casefold())
+        if produto is None:
+            results.append(_missing_product(nome))
+            continue
+        status, validation, details = _from_json_analysis(produto)
+        results.append({"nome": nome, "status": status, "validation": validation, "details": details})
+    return results
+
+
+def parse_response(response_text: str, prompt_name: str, produtos_nomes: List[str]) -> Tuple[str, dict, str, Optional[List[dict]]]:
+    """
+    Interpreta a resposta do modelo para o prompt usado.
+
+    Para prompts JSON, tenta o JSON e, se falhar, o parser de texto equivalente (o modelo às
+    vezes ignora a instrução de formato). Retorna (status, validação, detalhes, resultados por
+    produto ou None) e registra o resultado em `parse_stats`. Lança ResponseParseError.
+    """
+    por_produto = prompt_name in ('por_produto', 'por_produto_json')
+    text_prompt = JSON_PROMPTS.get(prompt_name, prompt_name)
+
+    if prompt_name in JSON_PROMPTS:
+        try:
+            if por_produto:
+                product_results = parse_json_product_response(response_text, produtos_nomes)
+                parse_stats.record("json")
+                return (*merge_product_results(product_results), product_results)
+            result = parse_json_response(response_text)
+            parse_stats.record("json")
+            return (*result, None)
+        except ResponseParseError as e:
+            logger.warning("Resposta fora do formato JSON, usando o parser de texto: %s", e)
+            outcome = "text_fallback"
+    else:
+        outcome = "text"
+
+    try:
+        if text_prompt == 'por_produto':
+            product_results = parse_product_blocks(response_text, produtos_nomes)
+            result = (*merge_product_results(product_results), product_results)
+        else:
+            result = (*parse_default_response(response_text), None)
+    except ResponseParseError:
+        parse_stats.record("failed")
+        raise
+
+    parse_stats.record(outcome)
+    return result
+
+
+# Campo do JSON de resposta -> campo de ValidationResult
+JSON_CRITERIA = {
+    "nome_marca": "nome_marca",
+    "etiqueta_preco": "preco",
+    "posicionamento": "posicionamento",
+    "organizacao": "organizacao",
+}
+
+JSON_CRITERION_RES = {
+    campo: re.compile(rf'"{chave}"\s*:\s*"?(true|false|verdadeiro|falso)\b', re.IGNORECASE)
+    for chave, campo in JSON_CRITERIA.items()
+}
+
+JSON_APPROVED_RE = re.compile(r'"aprovado"\s*:\s*"?(true|false|verdadeiro|falso)\b', re.IGNORECASE)
+
+
+class IncrementalParser:
+    """
+    Interpreta a resposta dos prompts 'default' e 'json' enquanto ela chega do modelo (streaming).
+
+    `feed(trecho)` retorna os eventos que ficaram determinados com o novo trecho, cada um uma
+    única vez: ("status", {"status": ...}) e ("criterion", {"criterio": ..., "valor": ...}).
+    São antecipações: o resultado definitivo continua vindo de `parse_response` sobre a
+    resposta completa. Reconhece os dois formatos, já que o modelo às vezes ignora o pedido de JSON.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.status: Optional[str] = None
+        self.validation = {}
+        self.approved: Optional[bool] = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, dict]]:
+        self.text += chunk
+        criteria = []
+        for campo in CRITERIA.values():
+            if campo in self.validation:
+                continue
+            match = CRITERION_RES[campo].search(self.text) or JSON_CRITERION_RES[campo].search(self.text)
+            if match is not None:
+                self.validation[campo] = match.group(1).lower() in ("true", "verdadeiro")
+                criteria.append(("criterion", {"criterio": campo, "valor": self.validation[campo]}))
+
+        events = []
+        if self.status is None:
+            self.status = self._status()
+            if self.status is not None:
+                events.append(("status", {"status": self.status}))
+        return events + criteria
+
+    def _status(self) -> Optional[str]:
+        # Formato em texto: a primeira linha traz o veredito
+        if "Validada com sucesso" in self.text:
+            return "success"
+        if "Validação pendente" in self.text:
+            return "pending"
+        # Formato JSON: aprovado só vale como sucesso com todos os critérios verdadeiros
+        if self.approved is None:
+            match = JSON_APPROVED_RE.search(self.text)
+            if match is not None:
+                self.approved = match.group(1).lower() in ("true", "verdadeiro")
+        if self.approved is None:
+            return None
+        if not self.approved or not all(self.validation.values()):
+            return "pending"
+        return "success" if len(self.validation) == len(CRITERIA) else None
+
+
+def merge_product_results(product_results: List[dict]) -> Tuple[str, dict, str]:
+    """Resume os resultados por produto em (status, validação, detalhes) gerais"""
+    status = "success" if product_results and all(r["status"] == "success" for r in product_results) else "pending"
+    validation = {campo: all(r["validation"][campo] for r in product_results) if product_results else False
+                  for campo in CRITERIA.values()}
+    details = "\n\n".join(f"{r['nome']}:\n{r['details']}" for r in product_results if r["details"])
+    return status, validation, details
+
+
+def _missing_product(nome: str) -> dict:
+    return {
+        "nome": nome,
+        "status": "pending",
+        "validation": {campo: False for campo in CRITERIA.values()},
+        "details": MISSING_PRODUCT_DETAILS
+    }
@@ -34,5 +34,87 @@ Validação dos critérios:
 4. Organização: [Verdadeiro/Falso]
 
 Dicas para melhoria:
-- [Liste apenas as dicas relacionadas aos critérios marcados como Falso, sempre mencionando o produto específico]"""
+- [Liste apenas as dicas relacionadas aos critérios marcados como Falso, sempre mencionando o produto específico]""",
+    'por_produto': """Analise a imagem da prateleira em relação a cada um dos produtos informados: {produtos}
+
+Procure por cada produto ou similares com nome/marca parecida, mesmo que a imagem não esteja muito clara.
+
+Avalie cada produto separadamente com base nos seguintes critérios:
+
+1. Nome/marca do produto está visível na prateleira: [Verdadeiro/Falso]
+2. Presença de etiqueta de preço próxima ao produto: [Verdadeiro/Falso]
+3. O produto está bem posicionado e em destaque: [Verdadeiro/Falso]
+4. A área do produto está organizada: [Verdadeiro/Falso]
+
+Responda com um bloco para cada produto, na ordem informada, usando o nome exatamente como foi informado, no formato:
+
+### Produto: [nome do produto]
+[Validada com sucesso, se todos os critérios forem Verdadeiro, ou Validação pendente, se algum for Falso]
+
+Validação dos critérios:
+1. Nome/marca: [Verdadeiro/Falso]
+2. Etiqueta de preço: [Verdadeiro/Falso]
+3. Posicionamento: [Verdadeiro/Falso]
+4. Organização: [Verdadeiro/Falso]
+
+Observações:
+- [Se validado, liste 1-2 motivos objetivos da aprovação; se pendente, liste apenas as dicas para os critérios marcados como Falso]""",
+    'json': """Analise a imagem da prateleira em relação ao produto específico informado: {produtos}
+
+Procure por este produto ou similares com nome/marca parecida, mesmo que a imagem não esteja muito clara.
+
+Analise com base nos seguintes critérios:
+
+1. nome_marca: Nome/marca do produto específico está visível na prateleira
+2. etiqueta_preco: Presença de etiqueta de preço próxima ao produto específico
+3. posicionamento: O produto específico está bem posicionado e em destaque
+4. organizacao: A área do produto específico está organizada
+
+Responda APENAS com um objeto JSON válido, sem texto antes ou depois e sem bloco de código, no formato:
+{{
+  "aprovado": true se todos os critérios forem true, senão false,
+  "criterios": {{
+    "nome_marca": true ou false,
+    "etiqueta_preco": true ou false,
+    "posicionamento": true ou false,
+    "organizacao": true ou false
+  }},
+  "detalhes": [
+    "Se aprovado: 2-3 pontos objetivos sobre o produto analisado, mencionando seu nome/marca, a etiqueta de preço e o posicionamento em relação aos concorrentes",
+    "Se não aprovado: apenas as dicas relacionadas aos critérios false, sempre mencionando o produto específico"
+  ]
+}}""",
+    'por_produto_json': """Analise a imagem da prateleira em relação a cada um dos produtos informados: {produtos}
+
+Procure por cada produto ou similares com nome/marca parecida, mesmo que a imagem não esteja muito clara.
+
+Avalie cada produto separadamente com base nos seguintes critérios:
+
+1. nome_marca: Nome/marca do produto está visível na prateleira
+2. etiqueta_preco: Presença de etiqueta de preço próxima ao produto
+3. posicionamento: O produto está bem posicionado e em destaque
+4. organizacao: A área do produto está organizada
+
+Responda APENAS com um objeto JSON válido, sem texto antes ou depois e sem bloco de código, com um item por produto, na ordem informada e com o nome exatamente como foi informado:
+{{
+  "produtos": [
+    {{
+      "nome": "nome do produto",
+      "aprovado": true se todos os critérios forem true, senão false,
+      "criterios": {{
+        "nome_marca": true ou false,
+        "etiqueta_preco": true ou false,
+        "posicionamento": true ou false,
+        "organizacao": true ou false
+      }},
+      "detalhes": ["Se aprovado, 1-2 motivos objetivos da aprovação; se não, apenas as dicas para os critérios false"]
+    }}
+  ]
+}}""",
+    'reask_json': """
+
+ATENÇÃO: a resposta anterior não pôde ser interpretada. Responda novamente, agora APENAS com o objeto JSON no formato pedido, sem nenhum texto adicional.""",
+    'reask_text': """
+
+ATENÇÃO: a resposta anterior não pôde ser interpretada. Responda novamente seguindo EXATAMENTE o formato pedido, com a linha "Validação dos critérios:" e cada critério marcado como Verdadeiro ou Falso, sem JSON nem texto adicional."""
 }
\ No newline at end of file
@@ -0,0 +1,238 @@
+import argparse
+import hashlib
+import json
+import logging
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+
+from cache import prompt_version
+from log_config import request_id_var
+from parsing import ResponseParseError, parse_response
+
+# Gravação das respostas reais do modelo e reexecução offline do parser sobre elas.
+#
+# Com RECORD_RESPONSES=1, cada resposta do Gemini é gravada (hash da imagem, prompt, modelo,
+# texto bruto e o resultado interpretado na época). Depois de mudar o parser ou o prompt:
+#
+#   python replay.py responses.db --show 10 --output relatorio.json
+#
+# reinterpreta todas as respostas gravadas e informa quantos resultados mudaram e a
+# velocidade do parser, sem chamar o Gemini.
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    request_id TEXT,
+    image_hash TEXT,
+    prompt_name TEXT NOT NULL,
+    prompt_version TEXT,
+    prompt_text TEXT,
+    model TEXT,
+    produtos TEXT NOT NULL,
+    response_text TEXT NOT NULL,
+    parsed TEXT,
+    parse_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_responses_prompt ON responses (prompt_name, id);
+"""
+
+COLUMNS = ["created_at", "request_id", "image_hash", "prompt_name", "prompt_version", "prompt_text",
+           "model", "produtos", "response_text", "parsed", "parse_error"]
+
+
+def image_digest(image_data) -> str:
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def parsed_to_dict(parsed: tuple) -> dict:
+    """Resultado de `parse_response` como dicionário serializável"""
+    status, validation, details, product_results = parsed
+    return {"status": status, "validation": validation, "details": details, "produtos": product_results}
+
+
+def build_record(image_hash: Optional[str], prompt_name: str, prompt_text: str, model: str,
+                 produtos_nomes: List[str], response_text: str, parsed: Optional[tuple] = None,
+                 parse_error: Optional[str] = None) -> dict:
+    """Registro de uma resposta do modelo e do resultado interpretado (ou do erro de interpretação)"""
+    return {
+        "created_at": time.time(),
+        "request_id": request_id_var.get(),
+        "image_hash": image_hash,
+        "prompt_name": prompt_name,
+        "prompt_version": prompt_version(prompt_name),
+        "prompt_text": prompt_text,
+        "model": model,
+        "produtos": json.dumps(produtos_nomes, ensure_ascii=False),
+        "response_text": response_text,
+        "parsed": json.dumps(parsed_to_dict(parsed), ensure_ascii=False) if parsed is not None else None,
+        "parse_error": parse_error,
+    }
+
+
+class ResponseStore:
+    """
+    Respostas gravadas em SQLite. Métodos bloqueantes: `insert_many` é chamado pelo
+    LogSink fora do event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def insert_many(self, records: List[dict]):
+        with self._connect() as conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                f"INSERT INTO responses ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                [tuple(record.get(column) for column in COLUMNS) for record in records]
+            )
+            conn.execute("COMMIT")
+
+    def count(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def iter_records(self, prompt_name: Optional[str] = None, limit: Optional[int] = None,
+                     batch_size: int = 1000) -> Iterator[dict]:
+        """Percorre as respostas gravadas em ordem de gravação, sem carregar todas em memória"""
+        query = "SELECT * FROM responses"
+        params: list = []
+        if prompt_name:
+            query += " WHERE prompt_name = ?"
+            params.append(prompt_name)
+        query += " ORDER BY id"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._connect() as conn:
+            cursor = conn.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield dict(row)
+
+
+def _changes(before: Optional[dict], after: Optional[dict]) -> List[str]:
+    """Campos do resultado que mudaram entre a interpretação gravada e a atual"""
+    if before is None or after is None:
+        return [] if before is after else ["parse"]
+    changes = [field for field in ("status", "validation", "details") if before[field] != after[field]]
+    before_products = [(p["nome"], p["status"], p["validation"]) for p in before["produtos"] or []]
+    after_products = [(p["nome"], p["status"], p["validation"]) for p in after["produtos"] or []]
+    if before_products != after_products:
+        changes.append("produtos")
+    return changes
+
+
+def replay(records: Iterator[dict], parse: Callable = parse_response, show: int = 0) -> dict:
+    """
+    Reinterpreta as respostas gravadas com o parser atual e compara com o resultado gravado.
+
+    Um resultado muda quando status, validação (ValidationResult) ou a validação de algum
+    produto são diferentes; mudanças apenas no texto dos detalhes são contadas à parte.
+    Retorna o relatório com as contagens, o tempo do parser e até `show` exemplos de mudanças.
+    """
+    current_versions = {}
+    report = {
+        "records": 0, "unchanged": 0, "changed": 0, "details_only": 0,
+        "newly_failed": 0, "fixed": 0, "still_failed": 0,
+        "changed_fields": {}, "outdated_prompt": 0, "examples": []
+    }
+    parse_time = 0.0
+    for record in records:
+        report["records"] += 1
+        prompt_name = record["prompt_name"]
+        produtos_nomes = json.loads(record["produtos"])
+        before = json.loads(record["parsed"]) if record["parsed"] else None
+
+        if prompt_name not in current_versions:
+            current_versions[prompt_name] = prompt_version(prompt_name)
+        if record["prompt_version"] != current_versions[prompt_name]:
+            report["outdated_prompt"] += 1
+
+        start_time = time.perf_counter()
+        try:
+            after = parsed_to_dict(parse(record["response_text"], prompt_name, produtos_nomes))
+            error = None
+        except ResponseParseError as e:
+            after, error = None, str(e)
+        parse_time += time.perf_counter() - start_time
+
+        if before is None and after is None:
+            report["still_failed"] += 1
+            continue
+        if before is None:
+            report["fixed"] += 1
+        elif after is None:
+            report["newly_failed"] += 1
+
+        changes = _changes(before, after)
+        if not changes:
+            report["unchanged"] += 1
+            continue
+        for field in changes:
+            report["changed_fields"][field] = report["changed_fields"].get(field, 0) + 1
+        if changes == ["details"]:
+            report["details_only"] += 1
+            continue
+        report["changed"] += 1
+        if len(report["examples"]) < show:
+            report["examples"].append({
+                "id": record["id"], "prompt_name": prompt_name, "changes": changes,
+                "before": before, "after": after, "error": error
+            })
+
+    report["parse_seconds"] = round(parse_time, 4)
+    report["parse_us_per_record"] = round(parse_time / report["records"] * 1e6, 1) if report["records"] else None
+    report["records_per_second"] = round(report["records"] / parse_time) if parse_time else None
+    return report
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Reinterpreta offline as respostas gravadas do modelo com o parser atual")
+    parser.add_argument("db", nargs="?", default="responses.db", help="Banco com as respostas gravadas (RECORD_DB_PATH)")
+    parser.add_argument("--prompt", help="Apenas respostas deste prompt (ex.: json, por_produto_json)")
+    parser.add_argument("--limit", type=int, help="Máximo de respostas")
+    parser.add_argument("--show", type=int, default=5, help="Exemplos de resultados alterados no relatório")
+    parser.add_argument("--output", help="Arquivo JSON para salvar o relatório")
+    parser.add_argument("--fail-on-change", action="store_true", help="Termina com código 1 se algum resultado mudar")
+    args = parser.parse_args(argv)
+
+    # O parser registra um aviso a cada resposta fora do formato JSON; no replay interessa só o total
+    logging.getLogger("parsing").setLevel(logging.ERROR)
+
+    report = replay(ResponseStore(args.db).iter_records(args.prompt, args.limit), show=args.show)
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    print(f"{report['records']} respostas: {report['changed']} resultados alterados, "
+          f"{report['details_only']} só nos detalhes, {report['newly_failed']} novas falhas, "
+          f"{report['fixed']} corrigidas; parser {report['parse_us_per_record']}µs/resposta", file=sys.stderr)
+    return 1 if args.fail_on_change and (report["changed"] or report["newly_failed"]) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+import asyncio
+import json
+import logging
+import queue
+import random
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from model_scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Estado compartilhado entre os processos da API (workers do gunicorn): cache de resultados,
+# índice de quase duplicatas, contadores de estatísticas e limite de taxa do Gemini.
+#
+# - InProcessState: tudo em memória do próprio processo (padrão, um único worker)
+# - SQLiteState: um arquivo SQLite local, visível a todos os workers da mesma máquina
+#
+# Os valores são serializados em JSON. No SQLite, as escritas (set, incr, push) são enfileiradas e
+# gravadas em lote por uma thread própria, sem bloquear quem as chama; as leituras e o consumo de
+# fichas são bloqueantes e devem ser feitos fora do event loop (asyncio.to_thread).
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS counters (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS lists (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_lists_key ON lists (namespace, key, id);
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+# Fração das escritas que também removem as entradas expiradas
+PURGE_PROBABILITY = 0.01
+
+# Máximo de escritas gravadas em uma mesma transação
+WRITE_BATCH_SIZE = 256
+
+
+class InProcessState:
+    """Estado em memória do processo; não é visto por outros workers"""
+
+    multiprocess = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._kv: Dict[Tuple[str, str], Tuple[Any, Optional[float]]] = {}
+        self._counters: Dict[str, Dict[str, float]] = defaultdict(dict)
+        self._lists: Dict[Tuple[str, str], deque] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._next_id = 0
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._kv.get((namespace, key))
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._kv[(namespace, key)]
+                return None
+            return value
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._kv[(namespace, key)] = (value, time.time() + ttl if ttl else None)
+
+    def incr(self, namespace: str, key: str, amount: float = 1):
+        with self._lock:
+            counters = self._counters[namespace]
+            counters[key] = counters.get(key, 0) + amount
+
+    def counters(self, namespace: str) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._counters.get(namespace, {}))
+
+    def push(self, namespace: str, key: str, value: Any, max_items: int, ttl: Optional[float] = None):
+        """Acrescenta `value` à lista, mantendo as `max_items` mais novas"""
+        with self._lock:
+            self._next_id += 1
+            items = self._lists.get((namespace, key))
+            if items is None or items.maxlen != max_items:
+                items = self._lists[(namespace, key)] = deque(items or (), maxlen=max_items)
+            items.append((self._next_id, value, time.time() + ttl if ttl else None))
+
+    def items(self, namespace: str, key: str, after_id: int = 0) -> List[Tuple[int, Any]]:
+        """Itens da lista com id maior que `after_id`, em ordem de inserção, sem os expirados"""
+        now = time.time()
+        with self._lock:
+            return [(item_id, value) for item_id, value, expires_at in self._lists.get((namespace, key), ())
+                    if item_id > after_id and (expires_at is None or expires_at >= now)]
+
+    def count(self, namespace: str) -> int:
+        with self._lock:
+            return sum(len(items) for (ns, _), items in self._lists.items() if ns == namespace)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """As escritas já são imediatas: nada a esperar"""
+        return True
+
+    def token_bucket(self, name: str, rate: float, capacity: float) -> TokenBucket:
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = TokenBucket(rate, capacity)
+            return self._buckets[name]
+
+
+class SQLiteTokenBucket:
+    """Token bucket com o saldo no SQLite: o limite de taxa vale para todos os workers juntos"""
+
+    def __init__(self, state: "SQLiteState", name: str, rate: float, capacity: float):
+        self.state = state
+        self.name = name
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+
+    def try_acquire(self) -> bool:
+        return self.rate <= 0 or self.state.take_token(self.name, self.rate, self.capacity) == 0
+
+    async def acquire_nowait(self) -> bool:
+        if self.rate <= 0:
+            return True
+        return await asyncio.to_thread(self.state.take_token, self.name, self.rate, self.capacity) == 0
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            # A transação pode esperar pelo lock do arquivo (até `timeout`): roda fora do event loop
+            wait = await asyncio.to_thread(self.state.take_token, self.name, self.rate, self.capacity)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+
+class SQLiteState:
+    """
+    Estado em um arquivo SQLite compartilhado pelos processos da máquina. Cada thread mantém
+    a própria conexão; operações de leitura-e-escrita usam BEGIN IMMEDIATE para serem atômicas
+    entre processos.
+
+    As escritas vão para uma fila (até `max_pending_writes`; além disso são descartadas com um
+    aviso, já que o estado é reconstruível) e são gravadas em lote pela thread de escrita, então
+    aparecem para as leituras com um pequeno atraso.
+    """
+
+    multiprocess = True
+
+    def __init__(self, path: str, timeout: float = 5, max_pending_writes: int = 10000):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+        self._writes = queue.Queue(maxsize=max_pending_writes)
+        self._writer = threading.Thread(target=self._write_loop, name="shared-state-writer", daemon=True)
+        self._writer.start()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            # Estado reconstruível: não precisa de fsync a cada escrita
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, statements):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = statements(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _enqueue(self, statements):
+        try:
+            self._writes.put_nowait(statements)
+        except queue.Full:
+            logger.warning("Fila de escritas do estado compartilhado cheia; escrita descartada")
+
+    def _write_loop(self):
+        while True:
+            batch = [self._writes.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._transaction(lambda conn: [statements(conn) for statements in batch])
+            except Exception:
+                logger.exception("Erro ao gravar %d escritas no estado compartilhado", len(batch))
+            finally:
+                for _ in batch:
+                    self._writes.task_done()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Espera a gravação das escritas enfileiradas; retorna False se o prazo acabar antes"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self._writes.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def _maybe_purge(self, conn: sqlite3.Connection):
+        if random.random() < PURGE_PROBABILITY:
+            now = time.time()
+            conn.execute("DELETE FROM kv WHERE expires_at < ?", (now,))
+            conn.execute("DELETE FROM lists WHERE expires_at < ?", (now,))
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        row = self._conn().execute(
+            "SELECT value FROM kv WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at >= ?)",
+            (namespace, key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        row = (namespace, key, json.dumps(value, ensure_ascii=False), time.time() + ttl if ttl else None)
+
+        def statements(conn):
+            conn.execute("INSERT OR REPLACE INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)", row)
+            self._maybe_purge(conn)
+        self._enqueue(statements)
+
+    def incr(self, namespace: str, key: str, amount: float = 1):
+        self._enqueue(lambda conn: conn.execute(
+            """INSERT INTO counters (namespace, key, value) VALUES (?, ?, ?)
+               ON CONFLICT (namespace, key) DO UPDATE SET value = value + excluded.value""",
+            (namespace, key, amount)
+        ))
+
+    def counters(self, namespace: str) -> Dict[str, float]:
+        rows = self._conn().execute("SELECT key, value FROM counters WHERE namespace = ?", (namespace,))
+        return {key: value for key, value in rows}
+
+    def push(self, namespace: str, key: str, value: Any, max_items: int, ttl: Optional[float] = None):
+        row = (namespace, key, json.dumps(value, ensure_ascii=False), time.time() + ttl if ttl else None)
+
+        def statements(conn):
+            conn.execute("INSERT INTO lists (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)", row)
+            conn.execute(
+                """DELETE FROM lists WHERE namespace = ? AND key = ? AND id NOT IN (
+                       SELECT id FROM lists WHERE namespace = ? AND key = ? ORDER BY id DESC LIMIT ?)""",
+                (namespace, key, namespace, key, max_items)
+            )
+            self._maybe_purge(conn)
+        self._enqueue(statements)
+
+    def items(self, namespace: str, key: str, after_id: int = 0) -> List[Tuple[int, Any]]:
+        rows = self._conn().execute(
+            """SELECT id, value FROM lists WHERE namespace = ? AND key = ? AND id > ?
+               AND (expires_at IS NULL OR expires_at >= ?) ORDER BY id""",
+            (namespace, key, after_id, time.time())
+        )
+        return [(item_id, json.loads(value)) for item_id, value in rows]
+
+    def count(self, namespace: str) -> int:
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM lists WHERE namespace = ? AND (expires_at IS NULL OR expires_at >= ?)",
+            (namespace, time.time())
+        ).fetchone()[0]
+
+    def take_token(self, name: str, rate: float, capacity: float) -> float:
+        """Consome uma ficha do balde `name`; retorna 0 se conseguiu ou quantos segundos esperar"""
+        def statements(conn):
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            conn.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                         (name, tokens, now))
+            return wait
+        return self._transaction(statements)
+
+    def token_bucket(self, name: str, rate: float, capacity: float) -> SQLiteTokenBucket:
+        return SQLiteTokenBucket(self, name, rate, capacity)
+
+
+def create_shared_state(backend: str = "memory", path: str = "shared_state.db"):
+    """Cria o backend de estado: 'memory' (padrão) ou 'sqlite'"""
+    if backend == "sqlite":
+        return SQLiteState(path)
+    if backend == "memory":
+        return InProcessState()
+    raise ValueError(f"Backend de estado compartilhado desconhecido: {backend}")
@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+from collections import defaultdict
+from pathlib import Path
+from typing import Optional
+
+from log_store import iter_log_pages
+
+HEADER = ['ID', 'Status', 'Produtos', 'Tempo de Execução (s)', 'Custo ($)', 'Erro']
+EXPORT_COLUMNS = "id,status,produtos,execution_time,cost,error"
+
+HEADER_FORMAT_REQUEST = {
+    'repeatCell': {
+        'range': {
+            'sheetId': 0,
+            'startRowIndex': 0,
+            'endRowIndex': 1
+        },
+        'cell': {
+            'userEnteredFormat': {
+                'backgroundColor': {
+                    'red': 0.2,
+                    'green': 0.2,
+                    'blue': 0.2
+                },
+                'textFormat': {
+                    'bold': True,
+                    'foregroundColor': {
+                        'red': 1.0,
+                        'green': 1.0,
+                        'blue': 1.0
+                    }
+                }
+            }
+        },
+        'fields': 'userEnteredFormat(backgroundColor,textFormat)'
+    }
+}
+
+# Evita duas exportações simultâneas para a mesma planilha (linhas duplicadas)
+_spreadsheet_locks = defaultdict(threading.Lock)
+
+
+def format_row(log: dict) -> list:
+    """Converte um log em uma linha da planilha"""
+    # Formatar produtos como string
+    produtos_str = log['produtos'] if isinstance(log['produtos'], str) else json.dumps(log['produtos'])
+
+    return [
+        str(log['id']),
+        log['status'],
+        produtos_str,
+        f"{log['execution_time']:.2f}" if log['execution_time'] else '',
+        f"${log['cost']:.4f}" if log['cost'] else '',
+        log['error'] if log['error'] else ''
+    ]
+
+
+class ExportState:
+    """Último ID exportado por planilha, persistido em um arquivo JSON"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def get(self, spreadsheet_id: str) -> Optional[int]:
+        with self._lock:
+            return self._load().get(spreadsheet_id)
+
+    def set(self, spreadsheet_id: str, last_id: int):
+        with self._lock:
+            state = self._load()
+            state[spreadsheet_id] = last_id
+            tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_text(json.dumps(state, indent=2))
+            os.replace(tmp_path, self.path)
+
+    def _load(self) -> dict:
+        try:
+            return json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+
+def export_logs(sheets_service, supabase, spreadsheet_id: str, state: ExportState,
+                full_rebuild: bool = False, page_size: int = 1000, chunk_rows: int = 5000) -> dict:
+    """
+    Exporta os logs para a planilha em páginas, sem carregar a tabela inteira em memória.
+
+    No modo incremental, acrescenta apenas os logs com `id` maior que o último exportado
+    para a planilha. No modo completo (ou na primeira exportação), limpa a planilha e
+    reescreve tudo. As linhas são enviadas em blocos de `chunk_rows` e o último ID é
+    salvo após cada bloco, então uma exportação interrompida continua de onde parou.
+    Chamadas bloqueantes: use a partir de uma thread, fora do event loop.
+    """
+    with _spreadsheet_locks[spreadsheet_id]:
+        sheet = sheets_service.spreadsheets()
+        last_id = None if full_rebuild else state.get(spreadsheet_id)
+        full_rebuild = last_id is None
+
+        if full_rebuild:
+            # Limpar planilha e escrever o cabeçalho formatado
+            sheet.values().clear(
+                spreadsheetId=spreadsheet_id,
+                range='A1:Z'
+            ).execute()
+            # A partir daqui a planilha está vazia: se a exportação parar antes do primeiro bloco,
+            # a próxima não pode continuar do ID antigo
+            state.set(spreadsheet_id, 0)
+            sheet.values().update(
+                spreadsheetId=spreadsheet_id,
+                range='A1',
+                valueInputOption='USER_ENTERED',
+                body={'values': [HEADER]}
+            ).execute()
+            sheet.batchUpdate(
+                spreadsheetId=spreadsheet_id,
+                body={'requests': [HEADER_FORMAT_REQUEST]}
+            ).execute()
+
+        rows_exported = 0
+        buffer = []
+
+        def flush(buffer_last_id):
+            sheet.values().append(
+                spreadsheetId=spreadsheet_id,
+                range='A1',
+                valueInputOption='USER_ENTERED',
+                insertDataOption='INSERT_ROWS',
+                body={'values': buffer}
+            ).execute()
+            state.set(spreadsheet_id, buffer_last_id)
+
+        for page in iter_log_pages(supabase, EXPORT_COLUMNS, page_size, after_id=last_id):
+            buffer.extend(format_row(log) for log in page)
+            last_id = page[-1]['id']
+            if len(buffer) >= chunk_rows:
+                flush(last_id)
+                rows_exported += len(buffer)
+                buffer = []
+
+        if buffer:
+            flush(last_id)
+            rows_exported += len(buffer)
+
+        return {
+            "rows_updated": rows_exported,
+            "mode": "completo" if full_rebuild else "incremental",
+            "last_id": last_id
+        }
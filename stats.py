@@ -0,0 +1,234 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime
+from typing import Iterable, Optional
+
+# Limites superiores (s) das faixas do histograma de tempo de execução
+EXECUTION_TIME_BUCKETS = [0.5, 1, 2, 5, 10, 20, 30, 60, 120]
+
+
+def _parse_timestamp(value) -> float:
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value:
+        try:
+            return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            pass
+    return time.time()
+
+
+def _parse_produtos(value) -> list:
+    if isinstance(value, list):
+        return value
+    try:
+        produtos = json.loads(value) if value else []
+    except (TypeError, ValueError):
+        return []
+    return produtos if isinstance(produtos, list) else []
+
+
+class _Counters:
+    """Contadores somáveis de um conjunto de análises"""
+
+    __slots__ = ("total", "successful", "errors", "total_cost", "success_time_sum", "histogram")
+
+    def __init__(self):
+        self.total = 0
+        self.successful = 0
+        self.errors = 0
+        self.total_cost = 0.0
+        self.success_time_sum = 0.0
+        self.histogram = [0] * (len(EXECUTION_TIME_BUCKETS) + 1)
+
+    def add(self, status: str, cost: float, execution_time: float):
+        self.total += 1
+        if status == 'error':
+            self.errors += 1
+        elif status == 'success':
+            self.successful += 1
+            self.total_cost += cost
+            self.success_time_sum += execution_time
+            self.histogram[bisect_left(EXECUTION_TIME_BUCKETS, execution_time)] += 1
+
+    def merge(self, other: "_Counters"):
+        self.total += other.total
+        self.successful += other.successful
+        self.errors += other.errors
+        self.total_cost += other.total_cost
+        self.success_time_sum += other.success_time_sum
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    @classmethod
+    def from_fields(cls, fields: dict) -> "_Counters":
+        """Contadores a partir dos campos já somados (ex.: agregados do arquivo de logs)"""
+        counters = cls()
+        for name in cls.__slots__:
+            setattr(counters, name, list(fields[name]) if name == "histogram" else fields[name])
+        return counters
+
+    def to_dict(self) -> dict:
+        labels = [f"<={b}" for b in EXECUTION_TIME_BUCKETS] + [f">{EXECUTION_TIME_BUCKETS[-1]}"]
+        return {
+            "total_analyses": self.total,
+            "successful_analyses": self.successful,
+            "error_analyses": self.errors,
+            "total_cost": self.total_cost,
+            "average_execution_time": self.success_time_sum / self.successful if self.successful else 0,
+            "execution_time_histogram": dict(zip(labels, self.histogram))
+        }
+
+
+class _Snapshot:
+    """Agregados completos: totais, por produto e por minuto (janela limitada)"""
+
+    def __init__(self, window_max_minutes: int):
+        self.window_max_minutes = window_max_minutes
+        self.totals = _Counters()
+        self.products = {}
+        self.minutes = {}
+
+    def add(self, timestamp: float, status: str, cost: float, execution_time: float, produtos: list):
+        self.totals.add(status, cost, execution_time)
+        for nome in produtos:
+            self.products.setdefault(nome, _Counters()).add(status, cost, execution_time)
+
+        minute = int(timestamp // 60)
+        if minute > time.time() // 60 - self.window_max_minutes:
+            bucket = self.minutes.get(minute)
+            if bucket is None:
+                bucket = self.minutes[minute] = ({}, _Counters())
+                self._prune()
+            bucket[1].add(status, cost, execution_time)
+            for nome in produtos:
+                bucket[0].setdefault(nome, _Counters()).add(status, cost, execution_time)
+
+    def _prune(self):
+        oldest = time.time() // 60 - self.window_max_minutes
+        for minute in [m for m in self.minutes if m <= oldest]:
+            del self.minutes[minute]
+
+
+class StatsAggregator:
+    """
+    Estatísticas das análises mantidas de forma incremental.
+
+    Cada log gravado atualiza os contadores em O(1) (`record`), e `/stats` lê os contadores
+    sem consultar o banco. Janelas de tempo usam baldes por minuto, limitados a
+    `window_max_minutes`, então a consulta tem custo constante em relação ao histórico.
+
+    `reconcile(rows)` reconstrói os contadores a partir do banco. Como os logs chegam ao
+    banco com algum atraso (gravação em lote), a reconstrução considera só linhas anteriores
+    a `cutoff` e reaplica os registros recentes mantidos em memória. Os logs já movidos para
+    o arquivo histórico (log_archive.py) entram nos totais por `archived`.
+
+    Com `shared` (estado compartilhado entre workers), `record` apenas publica o registro em
+    uma lista compartilhada e cada processo aplica a mesma sequência antes de responder, então
+    todos os workers veem os logs gravados por qualquer um deles.
+    """
+
+    def __init__(self, window_max_minutes: int = 1440, reconcile_lag: float = 120, shared=None,
+                 shared_max_entries: int = 100000, shared_ttl: float = 3600):
+        self.window_max_minutes = window_max_minutes
+        self.reconcile_lag = reconcile_lag
+        self.shared = shared
+        self.shared_max_entries = shared_max_entries
+        self.shared_ttl = shared_ttl
+        self._snapshot = _Snapshot(window_max_minutes)
+        self._recent = deque()
+        self._synced_id = 0
+        self._lock = threading.Lock()
+        self.reconciled_at = None
+
+    def record(self, log_data: dict):
+        """Atualiza os contadores com um log recém-criado"""
+        entry = (
+            _parse_timestamp(log_data.get("created_at")),
+            log_data.get("status"),
+            float(log_data.get("cost") or 0),
+            float(log_data.get("execution_time") or 0),
+            _parse_produtos(log_data.get("produtos"))
+        )
+        if self.shared:
+            self.shared.push("stats", "entries", list(entry), max_items=self.shared_max_entries, ttl=self.shared_ttl)
+            return
+        with self._lock:
+            self._apply(entry)
+
+    def _apply(self, entry: tuple):
+        self._snapshot.add(*entry)
+        self._recent.append(entry)
+        while self._recent and self._recent[0][0] < entry[0] - self.reconcile_lag * 2:
+            self._recent.popleft()
+
+    def _sync(self):
+        """Aplica os registros compartilhados que este processo ainda não viu (com o lock)"""
+        if not self.shared:
+            return
+        for entry_id, entry in self.shared.items("stats", "entries", after_id=self._synced_id):
+            self._apply(tuple(entry))
+            self._synced_id = entry_id
+
+    def reconcile_cutoff(self) -> float:
+        """Instante até o qual as linhas do banco são consideradas na reconciliação"""
+        return time.time() - self.reconcile_lag
+
+    def reconcile(self, rows: Iterable[dict], cutoff: float, archived: Optional[dict] = None):
+        """
+        Substitui os contadores pelos agregados de `rows` (anteriores a `cutoff`) + registros
+        recentes. `archived` (`LogArchive.counters()`) soma os logs arquivados aos totais e aos
+        produtos; eles são antigos demais para as janelas por minuto.
+        """
+        snapshot = _Snapshot(self.window_max_minutes)
+        if archived:
+            snapshot.totals.merge(_Counters.from_fields(archived["totals"]))
+            for nome, fields in archived["products"].items():
+                snapshot.products.setdefault(nome, _Counters()).merge(_Counters.from_fields(fields))
+        for row in rows:
+            snapshot.add(
+                _parse_timestamp(row.get("created_at")),
+                row.get("status"),
+                float(row.get("cost") or 0),
+                float(row.get("execution_time") or 0),
+                _parse_produtos(row.get("produtos"))
+            )
+
+        with self._lock:
+            # Registros publicados durante a leitura do banco entram em `_recent` antes da troca
+            self._sync()
+            for entry in self._recent:
+                if entry[0] >= cutoff:
+                    snapshot.add(*entry)
+            self._snapshot = snapshot
+            self.reconciled_at = time.time()
+
+    def get(self, window_minutes: Optional[int] = None, produto: Optional[str] = None,
+            by_product: bool = False) -> dict:
+        """Retorna as estatísticas, opcionalmente em uma janela de minutos e/ou por produto"""
+        with self._lock:
+            self._sync()
+            snapshot = self._snapshot
+            if window_minutes:
+                first_minute = time.time() // 60 - window_minutes
+                counters, products = _Counters(), {}
+                for minute, (bucket_products, bucket_counters) in snapshot.minutes.items():
+                    if minute > first_minute:
+                        counters.merge(bucket_counters)
+                        for nome, product_counters in bucket_products.items():
+                            products.setdefault(nome, _Counters()).merge(product_counters)
+            else:
+                counters, products = snapshot.totals, snapshot.products
+
+            if produto is not None:
+                counters = products.get(produto, _Counters())
+
+            stats = counters.to_dict()
+            if by_product:
+                stats["products"] = {nome: c.to_dict() for nome, c in products.items()}
+
+        stats["window_minutes"] = window_minutes
+        stats["reconciled_at"] = datetime.fromtimestamp(self.reconciled_at).isoformat() if self.reconciled_at else None
+        return stats
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# Os módulos ficam na raiz do repositório
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# api.py lê a configuração na importação: sem aquecimento de clientes e sem arquivos no repositório
+_tmp = tempfile.mkdtemp(prefix="smartshelf-tests-")
+os.environ.setdefault("WARMUP_ENABLED", "0")
+os.environ.setdefault("JOBS_DB_PATH", os.path.join(_tmp, "jobs.db"))
+os.environ.setdefault("LOG_SPILL_PATH", os.path.join(_tmp, "logs_spill.jsonl"))
+os.environ.setdefault("LOG_ARCHIVE_DIR", os.path.join(_tmp, "logs_archive"))
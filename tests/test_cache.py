@@ -0,0 +1,37 @@
+import asyncio
+import threading
+
+from cache import ResultCache
+
+
+def test_disk_tier_runs_off_the_event_loop(tmp_path, monkeypatch):
+    cache = ResultCache(disk_dir=str(tmp_path))
+    threads = []
+    disk_get, disk_set = cache._disk_get, cache._disk_set
+
+    def tracking(func):
+        def wrapper(*args):
+            threads.append(threading.current_thread())
+            return func(*args)
+        return wrapper
+
+    monkeypatch.setattr(cache, "_disk_get", tracking(disk_get))
+    monkeypatch.setattr(cache, "_disk_set", tracking(disk_set))
+
+    async def run():
+        await cache.set_async("chave", {"status": "success"})
+        cache._entries.clear()
+        return await cache.get_async("chave"), await cache.get_async("outra")
+
+    assert asyncio.run(run()) == ({"status": "success"}, None)
+    assert len(threads) == 3
+    assert threading.main_thread() not in threads
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_memory_hit_does_not_touch_the_disk(tmp_path):
+    cache = ResultCache(disk_dir=str(tmp_path))
+    cache.set("chave", {"status": "success"})
+    (tmp_path / "chave.json").unlink()
+
+    assert asyncio.run(cache.get_async("chave")) == {"status": "success"}
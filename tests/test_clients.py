@@ -0,0 +1,22 @@
+import threading
+
+import googleapiclient.discovery
+
+import clients
+
+
+def test_sheets_service_is_per_thread(monkeypatch):
+    monkeypatch.setattr(clients, "_get_sheets_credentials", lambda: "credenciais")
+    monkeypatch.setattr(googleapiclient.discovery, "build", lambda *args, **kwargs: object())
+    monkeypatch.setattr(clients, "_thread_local", threading.local())
+
+    services = []
+    threads = [threading.Thread(target=lambda: services.append(
+        (clients.get_sheets_service(), clients.get_sheets_service()))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(first is second for first, second in services)
+    assert services[0][0] is not services[1][0]
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+import jobs
+from jobs import JobQueue, JobWorkerPool, validate_webhook_url
+
+
+@pytest.mark.parametrize("url", [
+    "ftp://example.com/hook",
+    "http:///sem-host",
+    "http://localhost:8000/hook",
+    "http://127.0.0.1/hook",
+    "http://10.0.0.5/hook",
+    "http://192.168.1.10/hook",
+    "http://169.254.169.254/latest/meta-data",
+    "http://[::1]/hook",
+])
+def test_webhook_rejects_internal_targets(url):
+    with pytest.raises(ValueError):
+        validate_webhook_url(url)
+
+
+def test_webhook_accepts_public_address():
+    validate_webhook_url("https://8.8.8.8/hook")
+
+
+def test_webhook_allowlist(monkeypatch):
+    monkeypatch.setattr(jobs, "WEBHOOK_ALLOWED_HOSTS", {"hooks.example.com"})
+    with pytest.raises(ValueError):
+        validate_webhook_url("https://8.8.8.8/hook")
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.db"))
+
+
+def test_worker_survives_errors_saving_the_result(queue, monkeypatch):
+    finish = queue.finish
+    failures = []
+
+    def flaky_finish(job_id, result=None, error=None):
+        if not failures:
+            failures.append(job_id)
+            raise RuntimeError("database is locked")
+        finish(job_id, result, error)
+
+    monkeypatch.setattr(queue, "finish", flaky_finish)
+
+    async def handler(image, produtos, options):
+        return {"status": "success"}
+
+    pool = JobWorkerPool(queue, handler, workers=1, poll_interval=0.01)
+    first, second = queue.submit(b"a", []), queue.submit(b"b", [])
+
+    async def run():
+        pool.start()
+        for _ in range(100):
+            if queue.get(second)["status"] == "done":
+                break
+            await asyncio.sleep(0.01)
+        await pool.stop()
+
+    asyncio.run(run())
+    assert failures == [first]
+    assert queue.get(second)["status"] == "done"
+
+
+def test_stop_requeues_running_jobs(queue):
+    started = []
+
+    async def handler(image, produtos, options):
+        started.append(1)
+        await asyncio.sleep(10)
+
+    pool = JobWorkerPool(queue, handler, workers=1, poll_interval=0.01)
+    job_id = queue.submit(b"a", [])
+
+    async def run():
+        pool.start()
+        while not started:
+            await asyncio.sleep(0.01)
+        await pool.stop()
+
+    asyncio.run(run())
+    assert queue.get(job_id)["status"] == "queued"
+    assert queue.claim()["id"] == job_id
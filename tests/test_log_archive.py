@@ -0,0 +1,64 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import api
+from benchmark import FakeSupabase, generate_logs
+from log_archive import LogArchive, archive_logs
+from stats import StatsAggregator, _parse_produtos
+
+
+@pytest.fixture
+def supabase():
+    supabase = FakeSupabase(latency=0, jitter=0)
+    supabase.insert("logs", generate_logs(200))
+    return supabase
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return LogArchive(str(tmp_path / "archive"))
+
+
+def test_archive_round_trip(supabase, archive):
+    rows = [dict(row) for row in supabase.tables["logs"]]
+    report = archive_logs(supabase, archive, retention_days=0, chunk_rows=64)
+
+    assert report["archived"] == report["deleted"] == len(rows)
+    assert supabase.tables["logs"] == []
+    table = archive.read(["id", "status", "produtos", "cost"]).sort_by("id").to_pylist()
+    assert [row["id"] for row in table] == [row["id"] for row in rows]
+    assert [row["status"] for row in table] == [row["status"] for row in rows]
+    assert [row["produtos"] for row in table] == [json.loads(row["produtos"]) for row in rows]
+
+    result = archive.query(produto="Guaraná Antarctica")
+    expected = [row for row in rows if "Guaraná Antarctica" in _parse_produtos(row["produtos"])]
+    assert result["total_analyses"] == len(expected)
+    assert result["successful_analyses"] == sum(1 for row in expected if row["status"] == "success")
+    assert result["total_cost"] == pytest.approx(sum(row["cost"] for row in expected))
+
+
+def test_archive_rewrite_does_not_duplicate(supabase, archive):
+    archive_logs(supabase, archive, retention_days=0, delete=False)
+    archive_logs(supabase, archive, retention_days=0, delete=False)
+    assert archive.read(["id"]).num_rows == 200
+
+
+@pytest.mark.parametrize("delete", [True, False])
+def test_reconcile_counts_archived_rows_once(supabase, archive, monkeypatch, delete):
+    archive_logs(supabase, archive, retention_days=0, delete=delete)
+    # Logs gravados depois do arquivamento continuam só na tabela
+    created_at = (datetime.now(timezone.utc) - timedelta(hours=1)).isoformat()
+    supabase.insert("logs", [{"status": "success", "produtos": json.dumps(["Coca Cola"]), "cost": 0.001,
+                              "execution_time": 3.0, "created_at": created_at}] * 3)
+
+    aggregator = StatsAggregator()
+    monkeypatch.setattr(api, "get_supabase", lambda: supabase)
+    monkeypatch.setattr(api, "log_archive", archive)
+    monkeypatch.setattr(api, "stats_aggregator", aggregator)
+    api.reconcile_stats()
+
+    assert aggregator.get()["total_analyses"] == 203
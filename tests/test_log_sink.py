@@ -0,0 +1,80 @@
+import asyncio
+import json
+import threading
+
+from log_sink import LogSink
+
+
+def test_replay_skips_undecodable_lines(tmp_path):
+    spill_path = tmp_path / "logs_spill.jsonl"
+    # Última linha cortada no meio da gravação
+    spill_path.write_text(json.dumps({"id": 1}) + "\n" + json.dumps({"id": 2}) + "\n" + '{"id": 3, "sta',
+                          encoding="utf-8")
+    inserted = []
+    sink = LogSink(inserted.extend, spill_path=str(spill_path), spill_retry_interval=0)
+
+    asyncio.run(sink._replay_spill())
+
+    assert inserted == [{"id": 1}, {"id": 2}]
+    assert not spill_path.exists()
+    assert (tmp_path / "logs_spill.rejected").read_text(encoding="utf-8") == '{"id": 3, "sta\n'
+
+
+def test_worker_survives_spill_errors(tmp_path):
+    calls = []
+
+    def insert_batch(rows):
+        calls.append(list(rows))
+        if len(calls) == 1:
+            raise ConnectionError("Supabase indisponível")
+
+    # O diretório do arquivo local não existe: gravar nele falha com OSError
+    sink = LogSink(insert_batch, flush_interval=0.01, max_retries=1,
+                   spill_path=str(tmp_path / "ausente" / "logs_spill.jsonl"))
+
+    async def run():
+        sink.start()
+        sink.submit({"id": 1})
+        await asyncio.sleep(0.1)
+        sink.submit({"id": 2})
+        await asyncio.sleep(0.1)
+        assert not sink._task.done()
+        await sink.stop()
+
+    asyncio.run(run())
+    assert sink.dropped == 1
+    assert calls[-1] == [{"id": 2}]
+    assert sink.written == 1
+
+
+def test_worker_recovers_interrupted_replays(tmp_path):
+    spill_path = tmp_path / "logs_spill.jsonl"
+    # Reenvio interrompido de um processo que não existe mais
+    (tmp_path / "logs_spill.999999999.replay").write_text(json.dumps({"id": 1}) + "\n", encoding="utf-8")
+    inserted = []
+    sink = LogSink(inserted.extend, flush_interval=0.01, spill_path=str(spill_path), spill_retry_interval=0)
+
+    async def run():
+        sink.start()
+        await asyncio.sleep(0.05)
+        sink.submit({"id": 2})
+        await asyncio.sleep(0.1)
+        await sink.stop()
+
+    asyncio.run(run())
+    assert inserted == [{"id": 2}, {"id": 1}]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_submit_writes_off_the_event_loop(tmp_path):
+    threads = []
+    sink = LogSink(lambda rows: threads.append(threading.get_ident()), spill_path=str(tmp_path / "spill.jsonl"))
+
+    async def run():
+        sink.submit({"id": 1})
+        await sink.stop()
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+    assert threads and threads[0] != loop_thread
+    assert sink.written == 1
@@ -0,0 +1,36 @@
+import json
+
+from benchmark import FakeSupabase
+from log_store import iter_logs, like_escape, log_filters
+
+
+def make_supabase(*produtos_por_log):
+    supabase = FakeSupabase(latency=0, jitter=0)
+    # Mesmo formato gravado por save_log
+    supabase.insert("logs", [{"status": "success", "produtos": json.dumps(produtos)} for produtos in produtos_por_log])
+    return supabase
+
+
+def ids_for(supabase, produto):
+    return [log["id"] for log in iter_logs(supabase, apply_filters=log_filters(produto=produto))]
+
+
+def test_like_escape():
+    assert like_escape('a\\b%c_d') == 'a\\\\b\\%c\\_d'
+
+
+def test_product_filter_matches_accented_names():
+    supabase = make_supabase(["Guaraná Antarctica"], ["Coca Cola"], ["Café Pilão", "Guaraná Antarctica"])
+    assert ids_for(supabase, "Guaraná Antarctica") == [1, 3]
+    assert ids_for(supabase, "Café Pilão") == [3]
+
+
+def test_product_filter_treats_wildcards_literally():
+    supabase = make_supabase(["Leite 100%"], ["Leite 1000"], ["Sabão_Omo"], ["SabãoXOmo"])
+    assert ids_for(supabase, "Leite 100%") == [1]
+    assert ids_for(supabase, "Sabão_Omo") == [3]
+
+
+def test_product_filter_matches_whole_names():
+    supabase = make_supabase(["Coca Cola Zero"], ["Coca Cola"])
+    assert ids_for(supabase, "Coca Cola") == [2]
@@ -0,0 +1,188 @@
+import asyncio
+
+import pytest
+
+import model_scheduler
+from model_scheduler import ConcurrencyLimit, ModelScheduler, ModelUnavailableError, TokenBucket
+
+
+def test_concurrency_limit_is_shared_across_schedulers():
+    limit = ConcurrencyLimit(2)
+    schedulers = [ModelScheduler(rate_per_minute=0, concurrency=limit) for _ in range(2)]
+    running, peak = [0], [0]
+
+    async def make_call():
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        await asyncio.sleep(0.01)
+        running[0] -= 1
+        return "ok"
+
+    async def run():
+        return await asyncio.gather(*(schedulers[i % 2].call(make_call, timeout=5) for i in range(8)))
+
+    results = asyncio.run(run())
+    assert results == [("ok", 1)] * 8
+    assert peak[0] == 2
+
+
+class Unavailable(Exception):
+    code = 503
+
+
+def test_token_bucket_allows_burst_then_waits(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(model_scheduler.time, "monotonic", lambda: now[0])
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    now[0] += 0.5
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+
+
+def test_token_bucket_without_rate_never_waits():
+    bucket = TokenBucket(rate=0, capacity=1)
+    assert all(bucket.try_acquire() for _ in range(100))
+
+
+def test_retries_transient_errors():
+    attempts = []
+
+    async def make_call():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise Unavailable("indisponível")
+        return "ok"
+
+    scheduler = ModelScheduler(rate_per_minute=0, base_backoff=0.001, max_backoff=0.001)
+    # As recusadas pelo provedor não são cobradas
+    assert asyncio.run(scheduler.call(make_call, timeout=5)) == ("ok", 1)
+    assert len(attempts) == 3
+
+
+def test_does_not_retry_other_errors():
+    attempts = []
+
+    async def make_call():
+        attempts.append(1)
+        raise ValueError("requisição inválida")
+
+    scheduler = ModelScheduler(rate_per_minute=0, base_backoff=0.001)
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.call(make_call, timeout=5))
+    assert len(attempts) == 1
+
+
+def test_gives_up_after_max_retries():
+    async def make_call():
+        raise Unavailable("indisponível")
+
+    scheduler = ModelScheduler(rate_per_minute=0, max_retries=2, base_backoff=0.001, max_backoff=0.001)
+    with pytest.raises(ModelUnavailableError):
+        asyncio.run(scheduler.call(make_call, timeout=5))
+
+
+def hedging_scheduler(**kwargs):
+    scheduler = ModelScheduler(rate_per_minute=0, hedge=True, hedge_min_samples=5, hedge_min_delay=0.02, **kwargs)
+    scheduler._latencies.extend([0.01] * 5)
+    return scheduler
+
+
+def test_hedge_delay_needs_samples():
+    scheduler = ModelScheduler(rate_per_minute=0, hedge=True, hedge_min_samples=5, hedge_min_delay=0.02)
+    assert scheduler.hedge_delay() is None
+    scheduler._latencies.extend([0.01, 0.01, 0.01, 0.01, 0.5])
+    assert scheduler.hedge_delay() == 0.5
+
+
+def test_hedged_call_uses_the_first_response():
+    delays = [1.0, 0.01]
+    cancelled = []
+
+    async def make_call():
+        delay = delays.pop(0)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(delay)
+            raise
+        return delay
+
+    hedges, wins = model_scheduler.metrics.GEMINI_HEDGES.value(), model_scheduler.metrics.GEMINI_HEDGE_WINS.value()
+    scheduler = hedging_scheduler()
+    assert asyncio.run(scheduler.call(make_call, timeout=5)) == (0.01, 2)
+    # A chamada lenta é cancelada
+    assert cancelled == [1.0]
+    assert model_scheduler.metrics.GEMINI_HEDGES.value() == hedges + 1
+    assert model_scheduler.metrics.GEMINI_HEDGE_WINS.value() == wins + 1
+
+
+def test_no_hedge_without_a_free_slot():
+    calls = []
+
+    async def make_call():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    scheduler = hedging_scheduler(max_concurrency=1)
+    assert asyncio.run(scheduler.call(make_call, timeout=5)) == ("ok", 1)
+
+
+def test_consume_keeps_the_slot_until_the_stream_ends():
+    scheduler = ModelScheduler(rate_per_minute=0, max_concurrency=1)
+    consuming, overlapped = [False], []
+
+    async def make_call():
+        overlapped.append(consuming[0])
+        return "stream"
+
+    async def consume(response):
+        consuming[0] = True
+        await asyncio.sleep(0.02)
+        consuming[0] = False
+        return response + " lido"
+
+    async def run():
+        return await asyncio.gather(*(scheduler.call(make_call, timeout=5, consume=consume) for _ in range(3)))
+
+    assert asyncio.run(run()) == [("stream lido", 1)] * 3
+    assert overlapped == [False] * 3
+    # A latência registrada inclui a leitura do stream
+    assert min(scheduler._latencies) >= 0.02
+
+
+def test_failure_while_consuming_is_not_retried():
+    calls = []
+
+    async def make_call():
+        calls.append(1)
+        return "stream"
+
+    async def consume(response):
+        raise Unavailable("conexão caiu no meio do stream")
+
+    scheduler = ModelScheduler(rate_per_minute=0, base_backoff=0.001, max_backoff=0.001)
+    with pytest.raises(Unavailable):
+        asyncio.run(scheduler.call(make_call, timeout=5, consume=consume))
+    assert len(calls) == 1
+
+
+def test_hedged_stream_is_consumed_once():
+    delays = [0.05, 0.01]
+    consumed = []
+
+    async def make_call():
+        delay = delays.pop(0)
+        await asyncio.sleep(delay)
+        return delay
+
+    async def consume(response):
+        consumed.append(response)
+        await asyncio.sleep(0.1)
+        return response
+
+    scheduler = hedging_scheduler()
+    assert asyncio.run(scheduler.call(make_call, timeout=5, consume=consume)) == (0.01, 2)
+    assert consumed == [0.01]
@@ -0,0 +1,105 @@
+import json
+
+import pytest
+
+from parsing import MISSING_PRODUCT_DETAILS, IncrementalParser, ResponseParseError, parse_response, parse_stats
+
+TEXT_PENDING = """Validação pendente
+
+Validação dos critérios:
+1. Nome/marca: Verdadeiro
+2. Etiqueta de preço: Falso
+3. Posicionamento: Verdadeiro
+4. Organização: Verdadeiro
+
+Dicas para melhoria:
+- Colocar a etiqueta de preço"""
+
+JSON_SUCCESS = json.dumps({
+    "aprovado": True,
+    "criterios": {"nome_marca": True, "etiqueta_preco": True, "posicionamento": True, "organizacao": True},
+    "detalhes": ["Produto na altura dos olhos"]
+})
+
+ALL_TRUE = {"nome_marca": True, "preco": True, "posicionamento": True, "organizacao": True}
+
+
+def outcome_delta(before, outcome):
+    return parse_stats.to_dict()[outcome] - before[outcome]
+
+
+def test_json_response():
+    before = parse_stats.to_dict()
+    status, validation, details, products = parse_response(f"```json\n{JSON_SUCCESS}\n```", "json", ["Coca Cola"])
+    assert (status, validation, details, products) == ("success", ALL_TRUE, "- Produto na altura dos olhos", None)
+    assert outcome_delta(before, "json") == 1
+
+
+def test_json_prompt_falls_back_to_text_parser():
+    before = parse_stats.to_dict()
+    status, validation, details, _ = parse_response(TEXT_PENDING, "json", ["Coca Cola"])
+    assert status == "pending"
+    assert validation == {**ALL_TRUE, "preco": False}
+    assert details == "- Colocar a etiqueta de preço"
+    assert outcome_delta(before, "text_fallback") == 1
+
+
+def test_json_prompt_with_invalid_schema_falls_back():
+    reply = '{"aprovado": true}\n' + TEXT_PENDING
+    assert parse_response(reply, "json", ["Coca Cola"])[0] == "pending"
+
+
+def test_unparseable_response_raises():
+    before = parse_stats.to_dict()
+    with pytest.raises(ResponseParseError):
+        parse_response("Não consegui analisar a imagem.", "json", ["Coca Cola"])
+    assert outcome_delta(before, "failed") == 1
+
+
+def test_per_product_json_marks_missing_products():
+    reply = json.dumps({"produtos": [{**json.loads(JSON_SUCCESS), "nome": "coca cola"}]})
+    status, validation, _, products = parse_response(reply, "por_produto_json", ["Coca Cola", "Guaraná"])
+    assert [p["nome"] for p in products] == ["Coca Cola", "Guaraná"]
+    assert products[0]["status"] == "success"
+    assert products[1]["details"] == MISSING_PRODUCT_DETAILS
+    assert status == "pending"
+    assert validation == {campo: False for campo in ALL_TRUE}
+
+
+def feed_in_chunks(text, size=7):
+    parser = IncrementalParser()
+    events = []
+    for start in range(0, len(text), size):
+        events.extend(parser.feed(text[start:start + size]))
+    return events
+
+
+def test_incremental_parser_text_format():
+    events = feed_in_chunks(TEXT_PENDING)
+    assert events[0] == ("status", {"status": "pending"})
+    assert events[1:] == [
+        ("criterion", {"criterio": "nome_marca", "valor": True}),
+        ("criterion", {"criterio": "preco", "valor": False}),
+        ("criterion", {"criterio": "posicionamento", "valor": True}),
+        ("criterion", {"criterio": "organizacao", "valor": True}),
+    ]
+
+
+def test_incremental_parser_json_success_waits_for_all_criteria():
+    parser = IncrementalParser()
+    head, tail = JSON_SUCCESS.split('"organizacao"')
+    events = parser.feed(head)
+    assert ("status", {"status": "success"}) not in events
+    assert len(events) == 3
+    assert parser.feed('"organizacao"' + tail) == [
+        ("status", {"status": "success"}),
+        ("criterion", {"criterio": "organizacao", "valor": True}),
+    ]
+
+
+def test_incremental_parser_json_pending_as_soon_as_a_criterion_fails():
+    parser = IncrementalParser()
+    events = parser.feed('{"aprovado": false, "criterios": {"nome_marca": true')
+    assert events[0] == ("status", {"status": "pending"})
+    # Cada evento sai uma única vez
+    assert parser.feed(', "etiqueta_preco": true') == [("criterion", {"criterio": "preco", "valor": True})]
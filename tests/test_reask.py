@@ -0,0 +1,101 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import api
+from model_routing import ModelCall
+from parsing import ResponseParseError
+from prompts import PROMPTS
+
+TEXT_REPLY = """Validação pendente
+
+Validação dos critérios:
+1. Nome/marca: Verdadeiro
+2. Etiqueta de preço: Falso
+3. Posicionamento: Verdadeiro
+4. Organização: Verdadeiro
+
+Dicas para melhoria:
+- Colocar a etiqueta de preço"""
+
+JSON_REPLY = json.dumps({
+    "aprovado": False,
+    "criterios": {"nome_marca": True, "etiqueta_preco": False, "posicionamento": True, "organizacao": True},
+    "detalhes": ["Colocar a etiqueta de preço"]
+})
+
+
+@pytest.fixture
+def model_replies(monkeypatch):
+    """Substitui a chamada ao Gemini por respostas fixas e guarda os prompts enviados"""
+    replies, prompts = [], []
+
+    async def fake_generate_analysis(contents, max_output_tokens, timeout, model_name=api.GEMINI_MODEL, on_text=None):
+        prompts.append(contents[0])
+        reply = replies.pop(0)
+        if isinstance(reply, BaseException):
+            raise reply
+        return ModelCall(reply, model_name, 1, 0.001, False)
+
+    monkeypatch.setattr(api, "generate_analysis", fake_generate_analysis)
+    monkeypatch.setattr(api, "MODEL_ROUTING", "single")
+    return replies, prompts
+
+
+def analyze(prompt_name: str):
+    return asyncio.run(api.analyze_image(b"imagem", "image/jpeg", prompt_name, ["Coca Cola"], deadline=9e12))
+
+
+def test_reask_in_text_mode_asks_for_the_text_format(model_replies):
+    replies, prompts = model_replies
+    replies.extend(["resposta sem critérios", TEXT_REPLY])
+
+    parsed, cost, _, _ = analyze("default")
+
+    assert parsed[0] == "pending"
+    assert parsed[1]["preco"] is False
+    assert cost == pytest.approx(0.002)
+    assert prompts[1].endswith(PROMPTS["reask_text"])
+    assert "JSON" not in PROMPTS["reask_text"].replace("sem JSON", "")
+
+
+def test_reask_in_json_mode_asks_for_json(model_replies):
+    replies, prompts = model_replies
+    replies.extend(["resposta sem critérios", JSON_REPLY])
+
+    parsed, _, _, _ = analyze("json")
+
+    assert parsed[1] == {"nome_marca": True, "preco": False, "posicionamento": True, "organizacao": True}
+    assert prompts[1].endswith(PROMPTS["reask_json"])
+
+
+def test_reask_fails_after_second_unreadable_reply(model_replies):
+    replies, prompts = model_replies
+    replies.extend(["lixo", "lixo de novo"])
+
+    with pytest.raises(HTTPException) as exc_info:
+        analyze("default")
+    assert exc_info.value.status_code == 502
+    assert "após solicitar novamente" in exc_info.value.detail
+    assert isinstance(exc_info.value.__cause__, ResponseParseError)
+    assert len(prompts) == 2
+
+
+@pytest.mark.parametrize("failure, reason", [
+    (HTTPException(status_code=503, detail="Modelo indisponível"), "unavailable"),
+    (asyncio.TimeoutError(), "timeout"),
+])
+def test_tiered_escalates_when_fast_model_fails(model_replies, monkeypatch, failure, reason):
+    replies, prompts = model_replies
+    monkeypatch.setattr(api, "MODEL_ROUTING", "tiered")
+    replies.extend([failure, TEXT_REPLY])
+
+    parsed, cost, model_name, escalation = analyze("default")
+
+    assert parsed[0] == "pending"
+    assert model_name == api.GEMINI_MODEL
+    assert escalation == reason
+    assert cost == pytest.approx(0.001)
+    assert len(prompts) == 2
@@ -0,0 +1,36 @@
+import asyncio
+
+from shared_state import SQLiteState
+
+
+def test_sqlite_writes_are_applied_by_the_writer_thread(tmp_path):
+    state = SQLiteState(str(tmp_path / "state.db"))
+    state.set("kv", "chave", {"valor": 1}, ttl=60)
+    state.incr("contadores", "json")
+    state.incr("contadores", "json", 2)
+    for i in range(5):
+        state.push("lista", "escopo", i, max_items=3)
+
+    assert state.flush(timeout=5)
+    assert state.get("kv", "chave") == {"valor": 1}
+    assert state.counters("contadores") == {"json": 3}
+    assert [value for _, value in state.items("lista", "escopo")] == [2, 3, 4]
+
+
+def test_sqlite_writes_are_visible_to_other_instances(tmp_path):
+    path = str(tmp_path / "state.db")
+    writer, reader = SQLiteState(path), SQLiteState(path)
+    writer.push("stats", "entries", [1, "success"], max_items=10)
+    writer.flush(timeout=5)
+
+    assert [value for _, value in reader.items("stats", "entries")] == [[1, "success"]]
+
+
+def test_sqlite_token_bucket_acquires_off_the_event_loop(tmp_path):
+    bucket = SQLiteState(str(tmp_path / "state.db")).token_bucket("gemini", rate=1000, capacity=1)
+
+    async def run():
+        assert await bucket.acquire_nowait()
+        await asyncio.wait_for(bucket.acquire(), timeout=1)
+
+    asyncio.run(run())
@@ -0,0 +1,35 @@
+import pytest
+
+from benchmark import FakeSheetsService, FakeSupabase, generate_logs
+from sheets_export import ExportState, export_logs
+
+
+class FailingAppendSheets(FakeSheetsService):
+    """Planilha que falha ao acrescentar linhas, como uma exportação interrompida"""
+
+    def spreadsheets(self):
+        spreadsheets = super().spreadsheets()
+        values = spreadsheets.values()
+
+        def append(**kwargs):
+            raise RuntimeError("quota do Sheets excedida")
+
+        values.append = append
+        spreadsheets.values = lambda: values
+        return spreadsheets
+
+
+def test_interrupted_full_rebuild_does_not_resume_from_the_old_id(tmp_path):
+    supabase = FakeSupabase(latency=0, jitter=0)
+    supabase.insert("logs", generate_logs(5))
+    state = ExportState(str(tmp_path / "export_state.json"))
+    state.set("planilha", 3)
+
+    with pytest.raises(RuntimeError):
+        export_logs(FailingAppendSheets(latency=0, jitter=0), supabase, "planilha", state, full_rebuild=True)
+
+    # A planilha foi limpa: a próxima exportação precisa reenviar desde o início
+    assert state.get("planilha") == 0
+    result = export_logs(FakeSheetsService(latency=0, jitter=0), supabase, "planilha", state)
+    assert result["rows_updated"] == 5
+    assert state.get("planilha") == 5
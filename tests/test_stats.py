@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+from stats import EXECUTION_TIME_BUCKETS, StatsAggregator
+
+
+def archived_fields(total, successful, errors, total_cost, success_time_sum, bucket=None):
+    histogram = [0] * (len(EXECUTION_TIME_BUCKETS) + 1)
+    if bucket is not None:
+        histogram[bucket] = successful
+    return {"total": total, "successful": successful, "errors": errors, "total_cost": total_cost,
+            "success_time_sum": success_time_sum, "histogram": histogram}
+
+
+def row(status, produtos, cost=0.001, execution_time=3.0, age=600):
+    return {"status": status, "produtos": produtos, "cost": cost, "execution_time": execution_time,
+            "created_at": time.time() - age}
+
+
+def test_reconcile_adds_archived_counters_to_table_rows():
+    aggregator = StatsAggregator()
+    archived = {
+        "totals": archived_fields(10, 6, 1, 0.006, 24.0, bucket=3),
+        "products": {"Coca Cola": archived_fields(4, 3, 0, 0.003, 12.0, bucket=3)},
+        "max_id": 10,
+    }
+    rows = [row("success", '["Coca Cola"]'), row("error", '["Guaraná"]', cost=0)]
+
+    aggregator.reconcile(rows, aggregator.reconcile_cutoff(), archived)
+
+    stats = aggregator.get(by_product=True)
+    assert stats["total_analyses"] == 12
+    assert stats["successful_analyses"] == 7
+    assert stats["error_analyses"] == 2
+    assert stats["total_cost"] == pytest.approx(0.007)
+    assert stats["average_execution_time"] == pytest.approx(27.0 / 7)
+    assert stats["execution_time_histogram"]["<=5"] == 7
+    assert stats["products"]["Coca Cola"]["total_analyses"] == 5
+    assert stats["products"]["Guaraná"]["total_analyses"] == 1
+
+
+def test_archived_logs_stay_out_of_minute_windows():
+    aggregator = StatsAggregator()
+    archived = {"totals": archived_fields(10, 6, 1, 0.006, 24.0, bucket=3), "products": {}, "max_id": 10}
+
+    aggregator.reconcile([row("success", '["Coca Cola"]', age=300)], aggregator.reconcile_cutoff(), archived)
+
+    assert aggregator.get(window_minutes=60)["total_analyses"] == 1
+    assert aggregator.get()["total_analyses"] == 11
+
+
+def test_reconcile_keeps_records_newer_than_the_cutoff():
+    aggregator = StatsAggregator()
+    aggregator.record({"status": "success", "produtos": '["Coca Cola"]', "cost": 0.001, "execution_time": 2.0,
+                       "created_at": time.time()})
+
+    aggregator.reconcile([], aggregator.reconcile_cutoff())
+
+    assert aggregator.get()["total_analyses"] == 1
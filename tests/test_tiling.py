@@ -0,0 +1,85 @@
+from tiling import merge_tile_results, merge_validations, tile_results_decided, validations_decided
+
+
+def validation(nome_marca=True, preco=True, posicionamento=True, organizacao=True):
+    return {"nome_marca": nome_marca, "preco": preco, "posicionamento": posicionamento, "organizacao": organizacao}
+
+
+def test_merge_any_criteria_need_a_single_tile():
+    merged = merge_validations([validation(preco=False), validation(nome_marca=False, preco=True)])
+    assert merged["nome_marca"] and merged["preco"]
+
+
+def test_merge_majority_counts_only_tiles_with_the_product():
+    tiles = [
+        validation(posicionamento=True),
+        validation(posicionamento=True),
+        validation(nome_marca=False, posicionamento=False),
+        validation(nome_marca=False, posicionamento=False),
+        validation(nome_marca=False, posicionamento=False),
+    ]
+    assert merge_validations(tiles)["posicionamento"] is True
+
+
+def test_merge_majority_tie_is_false():
+    merged = merge_validations([validation(organizacao=True), validation(organizacao=False)])
+    assert merged["organizacao"] is False
+
+
+def test_merge_without_the_product_uses_all_tiles():
+    tiles = [validation(nome_marca=False, organizacao=True)] * 2 + [validation(nome_marca=False, organizacao=False)]
+    merged = merge_validations(tiles)
+    assert merged["nome_marca"] is False
+    assert merged["organizacao"] is True
+
+
+def test_decided_when_nothing_remains():
+    assert validations_decided([], 0)
+
+
+def test_not_decided_while_the_product_was_not_seen():
+    assert not validations_decided([validation(nome_marca=False)], 3)
+
+
+def test_not_decided_while_an_any_criterion_is_false():
+    assert not validations_decided([validation(preco=False)] * 3, 1)
+
+
+def test_decided_when_the_remaining_tiles_cannot_flip_the_majority():
+    assert validations_decided([validation()] * 3, 2)
+    assert not validations_decided([validation()] * 3, 3)
+    # Empate conta como falso: 2 contra 4 não vira com 2 trechos restantes
+    assert validations_decided([validation(posicionamento=False)] * 4 + [validation()] * 2, 2)
+
+
+def test_merge_tile_results_single_verdict():
+    tiles = [
+        (1, ("pending", validation(preco=False), "Sem etiqueta", None)),
+        (0, ("success", validation(), "Tudo certo", None)),
+    ]
+    status, merged, details, products = merge_tile_results(tiles)
+    assert status == "success"
+    assert merged == validation()
+    assert details == "Trecho 1: Tudo certo\n\nTrecho 2: Sem etiqueta"
+    assert products is None
+
+
+def test_merge_tile_results_per_product():
+    def product(nome, v, details=""):
+        return {"nome": nome, "status": "success" if all(v.values()) else "pending", "validation": v, "details": details}
+
+    tiles = [
+        (0, (None, None, "", [product("Coca Cola", validation()), product("Guaraná", validation(nome_marca=False))])),
+        (1, (None, None, "", [product("Coca Cola", validation(organizacao=False)),
+                              product("Guaraná", validation(preco=True, organizacao=False), "Desalinhado")])),
+    ]
+    status, merged, _, products = merge_tile_results(tiles)
+    by_name = {p["nome"]: p for p in products}
+    # Coca Cola: empate em organização (1 x 1) conta como falso
+    assert by_name["Coca Cola"]["validation"] == validation(organizacao=False)
+    # Guaraná só aparece no segundo trecho: a maioria considera apenas ele
+    assert by_name["Guaraná"]["validation"] == validation(organizacao=False)
+    assert by_name["Guaraná"]["details"] == "Trecho 2: Desalinhado"
+    assert status == "pending"
+    assert merged == validation(organizacao=False)
+    assert not tile_results_decided(tiles, 1)
@@ -0,0 +1,13 @@
+from fastapi.testclient import TestClient
+
+import api
+
+
+def test_oversized_upload_is_rejected_with_cors_headers():
+    client = TestClient(api.app)
+    response = client.post("/analyze", content=b"x" * (api.REQUEST_MAX_BYTES + 1),
+                           headers={"Origin": "https://painel.example.com",
+                                    "Content-Type": "application/octet-stream"})
+
+    assert response.status_code == 413
+    assert response.headers["access-control-allow-origin"] == "*"
@@ -0,0 +1,121 @@
+from typing import Dict, List, Optional, Tuple
+
+from parsing import CRITERIA, merge_product_results
+
+# Combinação das análises de cada trecho de uma foto panorâmica em um único veredito.
+#
+# Cada critério tem uma regra:
+# - "any": verdadeiro se algum trecho o atende (o produto e a etiqueta de preço só precisam
+#   aparecer em um trecho da gôndola)
+# - "majority": verdadeiro se a maioria dos trechos em que o produto aparece o atende (empate
+#   conta como falso); se o produto não aparece em nenhum trecho, vale a maioria de todos
+MERGE_RULES = {
+    "nome_marca": "any",
+    "preco": "any",
+    "posicionamento": "majority",
+    "organizacao": "majority",
+}
+
+# Critério que define em quais trechos o produto aparece
+PRESENCE_CRITERION = "nome_marca"
+
+
+def _relevant(validations: List[dict]) -> List[dict]:
+    present = [v for v in validations if v[PRESENCE_CRITERION]]
+    return present or validations
+
+
+def merge_validations(validations: List[dict]) -> dict:
+    """Combina as validações (dicionários de `ValidationResult`) dos trechos pelas MERGE_RULES"""
+    relevant = _relevant(validations)
+    merged = {}
+    for campo in CRITERIA.values():
+        if MERGE_RULES[campo] == "any":
+            merged[campo] = any(v[campo] for v in validations)
+        else:
+            votes = sum(1 for v in relevant if v[campo])
+            merged[campo] = votes * 2 > len(relevant)
+    return merged
+
+
+def validations_decided(validations: List[dict], remaining: int) -> bool:
+    """
+    Indica se o veredito já não pode mudar com os `remaining` trechos ainda não analisados:
+    os critérios "any" já estão verdadeiros e a maioria dos demais já está definida.
+    """
+    if remaining == 0:
+        return True
+    present = [v for v in validations if v[PRESENCE_CRITERION]]
+    if not present:
+        return False
+    for campo in CRITERIA.values():
+        if MERGE_RULES[campo] == "any":
+            if not any(v[campo] for v in validations):
+                return False
+            continue
+        votes = sum(1 for v in present if v[campo])
+        against = len(present) - votes
+        # Cada trecho restante pode acrescentar no máximo um voto a um dos lados
+        if not (votes > against + remaining or against >= votes + remaining):
+            return False
+    return True
+
+
+def _merge_details(entries: List[Tuple[int, dict, str]]) -> str:
+    """Detalhes dos trechos relevantes, sem repetições, identificados pela posição na grade"""
+    relevant = [entry for entry in entries if entry[1][PRESENCE_CRITERION]] or entries
+    seen = set()
+    parts = []
+    for index, _, details in sorted(relevant, key=lambda entry: entry[0]):
+        text = details.strip()
+        if not text or text in seen:
+            continue
+        seen.add(text)
+        parts.append(f"Trecho {index + 1}: {text}")
+    return "\n\n".join(parts)
+
+
+def merge_tile_results(tile_results: List[Tuple[int, tuple]]) -> Tuple[str, dict, str, Optional[List[dict]]]:
+    """
+    Combina os resultados interpretados de cada trecho, `(índice, (status, validação, detalhes,
+    produtos))`, em um resultado no mesmo formato de `parse_response`.
+
+    No modo por produto, cada produto é combinado separadamente e o status e a validação gerais
+    vêm da combinação dos produtos, como em uma análise de imagem única.
+    """
+    if not tile_results[0][1][3]:
+        entries = [(index, validation, details) for index, (_, validation, details, _) in tile_results]
+        validation = merge_validations([validation for _, validation, _ in entries])
+        status = "success" if all(validation.values()) else "pending"
+        return status, validation, _merge_details(entries), None
+
+    by_product: Dict[str, List[Tuple[int, dict, str]]] = {}
+    for index, (_, _, _, product_results) in tile_results:
+        for product in product_results:
+            by_product.setdefault(product["nome"], []).append((index, product["validation"], product["details"]))
+    product_results = []
+    for nome, entries in by_product.items():
+        validation = merge_validations([validation for _, validation, _ in entries])
+        product_results.append({
+            "nome": nome,
+            "status": "success" if all(validation.values()) else "pending",
+            "validation": validation,
+            "details": _merge_details(entries)
+        })
+    status, validation, details = merge_product_results(product_results)
+    return status, validation, details, product_results
+
+
+def tile_results_decided(tile_results: List[Tuple[int, tuple]], remaining: int) -> bool:
+    """Se o resultado combinado já está definido (no modo por produto, o de cada produto)"""
+    if remaining == 0:
+        return True
+    if not tile_results:
+        return False
+    if not tile_results[0][1][3]:
+        return validations_decided([parsed[1] for _, parsed in tile_results], remaining)
+    by_product: Dict[str, List[dict]] = {}
+    for _, (_, _, _, product_results) in tile_results:
+        for product in product_results:
+            by_product.setdefault(product["nome"], []).append(product["validation"])
+    return all(validations_decided(validations, remaining) for validations in by_product.values())
@@ -0,0 +1,211 @@
+import json
+import logging
+import mmap
+import os
+from contextvars import ContextVar
+from typing import Dict, Optional, Union
+
+from fastapi import HTTPException, UploadFile
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Limites de upload
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+# Acima deste tamanho a imagem não é copiada para a memória: o arquivo temporário do upload é mapeado
+UPLOAD_SPOOL_BYTES = int(os.environ.get("UPLOAD_SPOOL_BYTES", str(2 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = int(os.environ.get("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+
+ImageBuffer = Union[bytes, memoryview]
+
+
+class RequestMemory:
+    """Memória estimada dos buffers de uma requisição (upload em memória, imagem decodificada, envio)"""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+
+    def add(self, size: int):
+        self.current += size
+        self.peak = max(self.peak, self.current)
+
+    def release(self, size: int):
+        self.current -= size
+
+
+_request_memory: ContextVar[Optional[RequestMemory]] = ContextVar("request_memory", default=None)
+
+# Bytes de upload mantidos em memória por todas as requisições em andamento
+buffered_upload_bytes = 0
+
+
+def track_memory(size: int):
+    """Soma `size` bytes à memória da requisição atual"""
+    account = _request_memory.get()
+    if account is not None:
+        account.add(size)
+
+
+def release_memory(size: int):
+    account = _request_memory.get()
+    if account is not None:
+        account.release(size)
+
+
+def transient_memory(size: int):
+    """Registra uma alocação temporária (ex.: imagem decodificada) que só conta para o pico"""
+    track_memory(size)
+    release_memory(size)
+
+
+class UploadBuffer:
+    """
+    Conteúdo de um upload: em memória (bytearray) para arquivos pequenos ou um mapeamento
+    somente leitura do arquivo temporário para os grandes. `view` é um memoryview sem cópia;
+    chame `close()` (ou use como context manager) quando não for mais usado.
+    """
+
+    def __init__(self, view: memoryview, mapped: Optional[mmap.mmap] = None):
+        self.view = view
+        self._mapped = mapped
+        self.in_memory = 0 if mapped is not None else len(view)
+
+    def __len__(self):
+        return len(self.view)
+
+    def close(self):
+        global buffered_upload_bytes
+        if self.view is None:
+            return
+        self.view.release()
+        self.view = None
+        if self._mapped is not None:
+            try:
+                self._mapped.close()
+            except BufferError:
+                # Ainda há uma fatia do buffer em uso: o mapeamento é liberado pelo coletor de lixo
+                pass
+        buffered_upload_bytes -= self.in_memory
+        release_memory(self.in_memory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+async def read_upload(upload_file: UploadFile, max_bytes: int = UPLOAD_MAX_BYTES,
+                      spool_bytes: int = UPLOAD_SPOOL_BYTES, chunk_size: int = UPLOAD_CHUNK_BYTES) -> UploadBuffer:
+    """
+    Lê o upload em blocos, recusando com 413 assim que passar de `max_bytes`.
+
+    O Starlette já guarda uploads grandes em arquivo temporário; acima de `spool_bytes` esse
+    arquivo é mapeado em vez de copiado para a memória. Abaixo, o conteúdo vai para um único
+    bytearray pré-alocado quando o tamanho é conhecido.
+    """
+    global buffered_upload_bytes
+    size = upload_file.size
+    if size is not None and size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Imagem maior que o limite de {max_bytes} bytes")
+
+    if size is not None and size > spool_bytes:
+        try:
+            upload_file.file.seek(0)
+            mapped = mmap.mmap(upload_file.file.fileno(), 0, access=mmap.ACCESS_READ)
+            return UploadBuffer(memoryview(mapped), mapped)
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning("Não foi possível mapear o upload, lendo para a memória: %s", e)
+
+    await upload_file.seek(0)
+    buffer = bytearray(size) if size is not None else bytearray()
+    position = 0
+    while True:
+        chunk = await upload_file.read(chunk_size)
+        if not chunk:
+            break
+        if position + len(chunk) > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Imagem maior que o limite de {max_bytes} bytes")
+        buffer[position:position + len(chunk)] = chunk
+        position += len(chunk)
+    del buffer[position:]
+
+    buffered_upload_bytes += position
+    track_memory(position)
+    return UploadBuffer(memoryview(buffer))
+
+
+class RequestTooLarge(HTTPException):
+    """Lançada ao receber o corpo; é uma HTTPException para virar 413 mesmo durante o parsing do formulário"""
+
+    def __init__(self, limit: int):
+        super().__init__(status_code=413, detail=f"Requisição maior que o limite de {limit} bytes")
+
+
+class UploadLimitMiddleware:
+    """
+    Middleware ASGI que limita o tamanho do corpo das requisições antes do parsing do formulário:
+    recusa com 413 pelo Content-Length ou, sem ele, assim que os bytes recebidos passam do limite.
+    Também abre a contabilidade de memória da requisição e registra o pico nas métricas e no
+    cabeçalho X-Peak-Memory-Bytes.
+    """
+
+    def __init__(self, app, max_bytes: int, path_limits: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.path_limits = path_limits or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.path_limits.get(scope["path"], self.max_bytes)
+        content_length = dict(scope.get("headers", [])).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            await self._reject(send, limit)
+            return
+
+        account = RequestMemory()
+        token = _request_memory.set(account)
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise RequestTooLarge(limit)
+            return message
+
+        async def send_with_memory(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+                headers = list(message.get("headers", []))
+                headers.append((b"x-peak-memory-bytes", str(account.peak).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, send_with_memory)
+        except RequestTooLarge:
+            if not response_started:
+                await self._reject(send, limit)
+        finally:
+            _request_memory.reset(token)
+            if account.peak:
+                metrics.REQUEST_PEAK_MEMORY.observe(account.peak)
+
+    async def _reject(self, send, limit: int):
+        body = json.dumps({"detail": f"Requisição maior que o limite de {limit} bytes"}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode("latin-1"))]
+        })
+        await send({"type": "http.response.body", "body": body})